@@ -5,6 +5,10 @@ from opsbro.compliancemgr import InterfaceComplianceDriver
 class PackageInstallDriver(InterfaceComplianceDriver):
     name = 'package-install'
     
+    # The package manager is locked during an install, so only one at a time
+    max_concurrency = 1
+    concurrency_group = 'package-manager'
+    
     
     def __init__(self):
         super(PackageInstallDriver, self).__init__()
@@ -5,6 +5,10 @@ from opsbro.compliancemgr import InterfaceComplianceDriver
 class RepositoryDriver(InterfaceComplianceDriver):
     name = 'repository'
     
+    # Repositories are changing the package manager configuration, so only one at a time
+    max_concurrency = 1
+    concurrency_group = 'package-manager'
+    
     
     def __init__(self):
         super(RepositoryDriver, self).__init__()
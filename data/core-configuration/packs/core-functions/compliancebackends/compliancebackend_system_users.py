@@ -13,6 +13,9 @@ from opsbro.systempacketmanager import get_systepacketmgr
 class SystemUserDriver(InterfaceComplianceDriver):
     name = 'system-user'
     
+    # useradd/groupadd are locking the users files
+    max_concurrency = 1
+    
     
     def __init__(self):
         super(SystemUserDriver, self).__init__()
@@ -3,12 +3,6 @@ import time
 import socket
 import hashlib
 import re
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-    
-import base64
 
 # DO NOT FORGEET:
 # sysctl -w net.core.rmem_max=26214400
@@ -17,16 +11,20 @@ import base64
 from opsbro.threadmgr import threader
 from opsbro.module import ListenerModule
 from opsbro.stop import stopper
-from opsbro.ts import tsmgr
+from opsbro.ts import tsmgr, consolidate, CONSOLIDATION_FUNCTIONS
 from opsbro.stats import STATS
 from opsbro.httpdaemon import http_export, response, request, abort
 from opsbro.util import to_best_int_float
 from opsbro.gossip import gossiper
 from opsbro.httpclient import get_http_exceptions, httper
-from opsbro.kv import kvmgr
 from opsbro.parameters import BoolParameter, IntParameter
 from opsbro.log import cprint
 from opsbro.jsonmgr import jsoner
+from opsbro.udptransport import udptransport
+
+
+# graphite consolidateBy(metric, 'max') function
+CONSOLIDATE_BY_PATTERN = re.compile(r"""^consolidateBy\(\s*([^,\s]+)\s*,\s*['"](\w+)['"]\s*\)$""")
 
 
 class GraphiteModule(ListenerModule):
@@ -210,11 +208,8 @@ class GraphiteModule(ListenerModule):
                 packets.append(buf)
             
             # UDP
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            for packet in packets:
-                # do NOT use the node['port'], it's the internal communication, not the graphite one!
-                sock.sendto(packet, (node['addr'], self.graphite_port))
-            sock.close()
+            # do NOT use the node['port'], it's the internal communication, not the graphite one!
+            udptransport.send_many([(packet, (node['addr'], self.graphite_port)) for packet in packets])
             
             '''
             # TCP mode
@@ -294,7 +289,7 @@ class GraphiteModule(ListenerModule):
         
         # really manage the render call, with real return, call by a get and
         # a post function
-        def do_render(targets, _from):
+        def do_render(targets, _from, max_points=0):
             response.content_type = 'application/json'
             
             if not targets:
@@ -346,80 +341,62 @@ class GraphiteModule(ListenerModule):
                 return abort(400, 'Invalid range')
             
             # Ok now got the good values
-            res = []
+            # The minutes we want, with the whole current hour like before
+            start = divmod(past, 60)[0] * 60
+            end = (divmod(now, 3600)[0] + 1) * 3600
+            
+            # Look at the consolidation functions asked, and the glob patterns
+            consolidate_functions = {}
+            raw_targets = []
             for target in targets:
-                
-                nuuid = gossiper.find_group_node('ts', target)
-                n = None
-                if nuuid:
+                m = CONSOLIDATE_BY_PATTERN.match(target)
+                if m:
+                    target, func = m.group(1), m.group(2).lower()
+                    if func not in CONSOLIDATION_FUNCTIONS:
+                        return abort(400, 'Invalid consolidation function %s' % func)
+                    consolidate_functions[target] = func
+                raw_targets.append(target)
+            
+            # Group the metrics by the TS node that manage them
+            local_names = []
+            by_nodes = {}
+            for target in raw_targets:
+                for name in tsmgr.tsb.expand_targets([target]):
+                    func = consolidate_functions.get(target, 'avg')
+                    hkey = hashlib.sha1(name).hexdigest()
+                    nuuid = gossiper.find_group_node('ts', hkey)
                     n = gossiper.get(nuuid)
-                nname = ''
-                if n:
-                    nname = n['name']
-                self.logger.debug('HTTP ts: target %s is managed by %s(%s)' % (target, nname, nuuid))
-                # that's me or the other is no more there?
-                if nuuid == gossiper.uuid or n is None:
-                    self.logger.debug('HTTP ts: /render, my job to manage %s' % target)
-                    
-                    # Maybe I am also the TS manager of these data? if so, get the TS backend data for this
-                    min_e = hour_e = day_e = None
-                    
-                    self.logger.debug('HTTP RENDER founded TS %s' % tsmgr.tsb.data)
-                    min_e = tsmgr.tsb.data.get('min::%s' % target, None)
-                    hour_e = tsmgr.tsb.data.get('hour::%s' % target, None)
-                    day_e = tsmgr.tsb.data.get('day::%s' % target, None)
-                    self.logger.debug('HTTP TS RENDER, FOUNDED TS data %s %s %s' % (min_e, hour_e, day_e))
-                    
-                    # Get from the past, but start at the good hours offset
-                    t = past
-                    r = []
-                    
-                    while t < now:
-                        # Maybe the time match a hour we got in memory, if so take there
-                        if hour_e and hour_e['hour'] == t:
-                            self.logger.debug('HTTP TS RENDER match memory HOUR, take this value instead')
-                            raw_values = hour_e['values'][:]  # copy instead of cherrypick, because it can move/append
-                            for i in range(60):
-                                # Get teh value and the time
-                                e = raw_values[i]
-                                tt = t + 60 * i
-                                r.append((e, tt))
-                                if e:
-                                    self.logger.debug('GOT NOT NULL VALUE from RENDER MEMORY cache %s:%s' % (e, tt))
-                        else:  # no memory match, got look in the KS part
-                            ukey = '%s::h%d' % (target, t)
-                            raw64 = kvmgr.get_key(ukey)
-                            if raw64 is None:
-                                for i in range(60):
-                                    # Get the value and the time
-                                    tt = t + 60 * i
-                                    r.append((None, tt))
-                            else:
-                                raw = base64.b64decode(raw64)
-                                v = pickle.loads(raw)
-                                raw_values = v['values']
-                                for i in range(60):
-                                    # Get teh value and the time
-                                    e = raw_values[i]
-                                    tt = t + 60 * i
-                                    r.append((e, tt))
-                        # Ok now the new hour :)
-                        t += 3600
-                    # Now build the final thing
-                    res.append({"target": target, "datapoints": r})
-                else:  # someone else job, rely the question
-                    uri = 'http://%s:%s/render/?target=%s&from=%s' % (n['addr'], n['port'], target, _from)
-                    try:
-                        self.logger.debug('TS: (get /render) relaying to %s: %s' % (n['name'], uri))
-                        r = httper.get(uri)
-                        self.logger.debug('TS: get /render founded (%d)' % len(r))
-                        v = jsoner.loads(r)
-                        self.logger.debug("TS /render relay GOT RETURN", v, "AND RES", res)
-                        res.extend(v)
-                        self.logger.debug("TS /render res is now", res)
-                    except get_http_exceptions() as exp:
-                        self.logger.debug('TS: /render relay error asking to %s: %s' % (n['name'], str(exp)))
-                        continue
+                    # that's me or the other is no more there?
+                    if nuuid == gossiper.uuid or n is None:
+                        local_names.append((name, func))
+                    else:
+                        if nuuid not in by_nodes:
+                            by_nodes[nuuid] = []
+                        by_nodes[nuuid].append((name, func))
+            
+            res = []
+            for (name, func) in local_names:
+                self.logger.debug('HTTP ts: /render, my job to manage %s' % name)
+                values = tsmgr.tsb.get_minutes_range(name, start, end)
+                res.append({"target": name, "datapoints": consolidate(values, start, 60, max_points=max_points, func=func)})
+            
+            # someone else job, rely the question, with all the targets of this node in one call
+            for (nuuid, names) in by_nodes.items():
+                n = gossiper.get(nuuid)
+                if n is None:
+                    continue
+                params = [('target', "consolidateBy(%s,'%s')" % (name, func)) for (name, func) in names]
+                params.append(('from', _from))
+                if max_points:
+                    params.append(('maxDataPoints', max_points))
+                uri = 'http://%s:%s/render/' % (n['addr'], n['port'])
+                try:
+                    self.logger.debug('TS: (get /render) relaying %d targets to %s' % (len(names), n['name']))
+                    r = httper.get(uri, params=params)
+                    res.extend(jsoner.loads(r))
+                except get_http_exceptions() as exp:
+                    self.logger.debug('TS: /render relay error asking to %s: %s' % (n['name'], str(exp)))
+                    continue
             
             self.logger.debug('TS RENDER FINALLY RETURN', res)
             return jsoner.dumps(res)
@@ -430,7 +407,8 @@ class GraphiteModule(ListenerModule):
         def get_ts_values():
             targets = request.GET.getall('target')
             _from = request.GET.get('from', '-24hours')
-            return do_render(targets, _from)
+            max_points = to_best_int_float(request.GET.get('maxDataPoints', '0')) or 0
+            return do_render(targets, _from, max_points=int(max_points))
         
         
         @http_export('/render', method='POST')
@@ -438,4 +416,5 @@ class GraphiteModule(ListenerModule):
         def get_ts_values():
             targets = request.POST.getall('target')
             _from = request.POST.get('from', '-24hours')
-            return do_render(targets, _from)
+            max_points = to_best_int_float(request.POST.get('maxDataPoints', '0')) or 0
+            return do_render(targets, _from, max_points=int(max_points))
@@ -1,56 +1,43 @@
 import os
 import sys
-import time
 
 from opsbro.collector import Collector
-from opsbro.now import NOW
+from opsbro.procfs import procfs_sampler, MIN_RATE_INTERVAL
 
 if os.name == 'nt':
     import opsbro.misc.wmi as wmi
 
 
 class CpuStats(Collector):
+    # the rates need the baseline to be old enough
+    first_run_delay = MIN_RATE_INTERVAL
+    
+    
     def __init__(self):
         super(CpuStats, self).__init__()
-        self.prev_linux_stats = {}
-        self.prev_linux_time = 0
+        self.prev_linux_sample = None
+        # A first sample now, so the first run already have stats
+        if sys.platform.startswith('linux'):
+            self.prev_linux_sample = procfs_sampler.get_baseline('stat')
     
     
-    def _get_linux_abs_stats(self):
-        r = {}
-        with open('/proc/stat') as procfile:
-            lines = procfile.readlines()
-        nb_cpus = 0
-        for line in lines:
-            # Example of line:
-            # cat /proc/stat
-            # cpu  16495 72 13812 1662977 894 0 160 0 0 0
-            # cpu0 16495 72 13812 1662977 894 0 160 0 0 0
-            
-            if not line.startswith('cpu'):
-                continue
-            elts = line.split(' ')
-            h_name = elts[0]
-            if h_name == 'cpu':
-                h_name = 'cpu_all'
-            else:
-                nb_cpus += 1
-            r[h_name] = {}
-            values = [int(v.strip()) for v in elts[1:] if v.strip()]
-            columns = (r'%user', r'%nice', r'%system', r'%idle', r'%iowait', r'%irq', r'%softirq', r'%steal', r'%guest', r'%guest_nice')
-            for i in range(0, len(columns)):  # note: beware of python3
-                r[h_name][columns[i]] = values[i]
-        # if we have multiple cpus, prepare the all in a percent way
-        if nb_cpus >= 2:
-            for (column, v) in r['cpu_all'].items():
-                r['cpu_all'][column] = int(v / float(nb_cpus))
+    # Get the cpu values of a /proc/stat sample
+    # if we have multiple cpus, prepare the all in a percent way
+    @staticmethod
+    def _get_linux_abs_stats(sample):
+        cpus = sample.values['cpus']
+        nb_cpus = len(cpus) - 1
+        if nb_cpus < 2:
+            return cpus
+        r = dict(cpus)
+        r['cpu_all'] = dict((column, int(v / float(nb_cpus))) for (column, v) in cpus['cpu_all'].items())
         return r
     
     
-    def compute_linux_cpu_stats(self, new_cpu_raw_stats, diff_time):
+    def compute_linux_cpu_stats(self, new_cpu_raw_stats, old_cpu_raw_stats, diff_time):
         r = {}
         for (k, new_stats) in new_cpu_raw_stats.items():
-            old_stats = self.prev_linux_stats.get(k, None)
+            old_stats = old_cpu_raw_stats.get(k, None)
             # A new cpu did spawn? wait a loop to compute it
             if old_stats is None:
                 continue
@@ -86,23 +73,16 @@ class CpuStats(Collector):
             # /proc/stat columns:
             # user, nice, system, idle, iowait, irq, softirq, steal, guest, guest_nice
             logger.debug('getCPUStats: linux2')
-            new_stats = self._get_linux_abs_stats()
-            new_time = NOW.monotonic()
-            # First loop: do a 1s loop an compute it, to directly have results
-            if self.prev_linux_time == 0:
-                self.prev_linux_time = NOW.monotonic()
-                self.prev_linux_stats = new_stats
-                time.sleep(1)
-                new_stats = self._get_linux_abs_stats()
-                new_time = NOW.monotonic()
+            # We did take a first /proc/stat sample when loaded, so even the first loop have results
+            new_sample, old_sample = procfs_sampler.get_samples_since('stat', self.prev_linux_sample)
+            self.prev_linux_sample = new_sample
+            if old_sample is None:
+                return {}
             
             # NOTE: thanks to monotonic time, we cannot get back in time for diff
             
             # So let's compute
-            r = self.compute_linux_cpu_stats(new_stats, new_time - self.prev_linux_time)
-            self.prev_linux_stats = new_stats
-            self.prev_linux_time = new_time
-            return r
+            return self.compute_linux_cpu_stats(self._get_linux_abs_stats(new_sample), self._get_linux_abs_stats(old_sample), new_sample.time - old_sample.time)
         else:
             logger.debug('getCPUStats: unsupported platform')
             self.set_not_eligible('This collector is not available on your system.')
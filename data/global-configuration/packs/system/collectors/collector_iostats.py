@@ -2,7 +2,6 @@
 
 import sys
 import os
-import time
 from string import digits
 
 PY3 = sys.version_info >= (3,)
@@ -10,7 +9,7 @@ if PY3:
     basestring = str
 
 from opsbro.collector import Collector
-from opsbro.now import NOW
+from opsbro.procfs import procfs_sampler, MIN_RATE_INTERVAL
 
 if os.name == 'nt':
     import opsbro.misc.wmi as wmi
@@ -19,65 +18,36 @@ BYTES_PER_SECTOR = 512
 
 
 class IoStats(Collector):
+    # the rates need the baseline to be old enough
+    first_run_delay = MIN_RATE_INTERVAL
+    
+    
     def __init__(self):
         super(IoStats, self).__init__()
-        self.previous_raw = {}
-        self.previous_time = 0
-        
-        # Columns for disk entry in /proc/diskstats
-        self.columns_disk = ['major', 'minor', 'device', 'reads', 'reads_merged', 'read_sectors', 'read_ms', 'writes', 'writes_merged', 'write_sectors', 'write_ms', 'cur_ios', 'total_io_ms', 'total_io_weighted_ms']
-        # We don't care about theses fields
-        # NOTE: write_ms and read_ms are over the sleep time, not sure about what it means
-        self.columns_to_del_in_raw = ('major', 'minor', 'cur_ios', 'total_io_weighted_ms', 'read_ms', 'write_ms')
+        self.previous_sample = None
+        # A first sample now, so the first run already have stats
+        if sys.platform.startswith('linux'):
+            self.previous_sample = procfs_sampler.get_baseline('diskstats')
     
     
-    def _get_disk_stats(self):
-        file_path = '/proc/diskstats'
+    # Get the disks of a /proc/diskstats sample
+    @staticmethod
+    def _get_disk_stats(sample):
         result = {}
-        
-        # ref: http://lxr.osuosl.org/source/Documentation/iostats.txt
-        
-        # columns_partition = ['major', 'minor', 'device', 'reads', 'rd_sectors', 'writes', 'wr_sectors']
-        
-        lines = open(file_path, 'r').readlines()
-        for line in lines:
-            if line == '':
-                continue
-            split = line.split()
-            if len(split) == len(self.columns_disk):
-                columns = self.columns_disk
-            # elif len(split) == len(columns_partition):
-            #    columns = columns_partition
-            else:
-                # No match, drop partitions too
-                continue
-            
-            data = dict(zip(columns, split))
-            
-            device_name = data['device']
-            
+        for (device_name, data) in sample.values.items():
             # If there is a number in the device, we drop (don't look at partition)
             # NOTE: car in digit is faster than regexp re.search('\d+', value)
             # (⌐■_■)==ε╦╤─   regexp
             if any(char in digits for char in device_name):
                 continue
-            
-            for key in data:
-                if key != 'device':
-                    data[key] = int(data[key])
-            # We don't care about some raw fields
-            for k in self.columns_to_del_in_raw:
-                del data[k]
-            
             result[device_name] = data
-        
         return result
     
     
-    def compute_linux_disk_stats(self, new_raw_stats, diff_time):
+    def compute_linux_disk_stats(self, new_raw_stats, old_raw_stats, diff_time):
         r = {}
         for (device, new_stats) in new_raw_stats.items():
-            old_stats = self.previous_raw.get(device, None)
+            old_stats = old_raw_stats.get(device, None)
             # A new disk did spawn? wait a loop to compute it
             if old_stats is None:
                 continue
@@ -132,21 +102,13 @@ class IoStats(Collector):
             self.set_not_eligible('Unsupported platform (%s) for this collector' % sys.platform)
             return False
         
-        new_stats = self._get_disk_stats()
-        new_time = NOW.monotonic()
-        # First loop: do a 1s loop an compute it, to directly have results
-        if self.previous_time == 0:
-            self.previous_time = NOW.monotonic()
-            self.previous_raw = new_stats
-            time.sleep(1)
-            new_stats = self._get_disk_stats()
-            new_time = NOW.monotonic()
+        # We did take a first /proc/diskstats sample when loaded, so even the first loop have results
+        new_sample, old_sample = procfs_sampler.get_samples_since('diskstats', self.previous_sample)
+        self.previous_sample = new_sample
+        if old_sample is None:
+            return {}
         
         # NOTE: Thanks to monotonic clock, we cannot get back in time
         
         # So compute the diff
-        iostats = self.compute_linux_disk_stats(new_stats, new_time - self.previous_time)
-        self.previous_raw = new_stats
-        self.previous_time = new_time
-        
-        return iostats
+        return self.compute_linux_disk_stats(self._get_disk_stats(new_sample), self._get_disk_stats(old_sample), new_sample.time - old_sample.time)
@@ -2,25 +2,43 @@ import sys
 import os
 
 from opsbro.collector import Collector
-from opsbro.now import NOW
+from opsbro.procfs import procfs_sampler, MIN_RATE_INTERVAL
 
 if os.name == 'nt':
     import opsbro.misc.wmi as wmi
 
 
 class KernelStats(Collector):
+    # the rates need the baseline to be old enough
+    first_run_delay = MIN_RATE_INTERVAL
+    
+    
     def __init__(self):
         super(KernelStats, self).__init__()
-        self.store = {}
-        self.last_launch = 0.0
+        self.last_stat_sample = None
+        self.last_vmstat_sample = None
+        # First samples now, so the first run already have rates
+        if sys.platform.startswith('linux'):
+            self.last_stat_sample = procfs_sampler.get_baseline('stat')
+            self.last_vmstat_sample = procfs_sampler.get_baseline('vmstat')
+    
+    
+    # Change the keys into their /s values since the previous sample, 0 if we do not have one
+    @staticmethod
+    def _compute_rates(data, by_sec_keys, new_sample, old_sample, get_values):
+        for k in by_sec_keys:
+            v = data.pop(k, None)
+            if v is None:
+                continue
+            if old_sample is None:
+                data['%s/s' % k] = 0
+                continue
+            old_v = get_values(old_sample).get(k, v)
+            data['%s/s' % k] = (v - old_v) / (new_sample.time - old_sample.time)
     
     
     def launch(self):
         logger = self.logger
-        now = int(NOW.monotonic())
-        diff = now - self.last_launch  # note: thanks to monotonic, diff cannot be negative
-        self.last_launch = now
-        
         logger.debug('getKernelStats: start')
         
         if os.name == 'nt':
@@ -41,42 +59,21 @@ class KernelStats(Collector):
             logger.debug('getKernelStats: linux2')
             
             try:
-                logger.debug('getKernelStats: attempting open')
-                lines = []
-                with open('/proc/stat', 'r') as stats:
-                    lines.extend(stats.readlines())
-                with open('/proc/vmstat', 'r') as vmstat:
-                    lines.extend(vmstat.readlines())
+                new_stat, old_stat = procfs_sampler.get_samples_since('stat', self.last_stat_sample)
+                new_vmstat, old_vmstat = procfs_sampler.get_samples_since('vmstat', self.last_vmstat_sample)
             except IOError as e:
                 logger.error('getKernelStat: exception = %s', e)
                 return False
-            
-            logger.debug('getKernelStat: open success, parsing')
+            self.last_stat_sample = new_stat
+            self.last_vmstat_sample = new_vmstat
             
             data = {}
-            for line in lines:
-                elts = line.split(' ', 1)
-                # only look at keys
-                if len(elts) != 2:
-                    continue
-                try:
-                    data[elts[0]] = int(elts[1])
-                except ValueError:  # not an int? skip this value
-                    continue
+            data.update(new_stat.values['counters'])
+            data.update(new_vmstat.values)
             
-            # Now loop through each interface
-            by_sec_keys = ['ctxt', 'processes', 'pgfault', 'pgmajfault']
-            to_add = {}
-            for (k, v) in data.items():
-                if k in by_sec_keys:
-                    if k in self.store:
-                        to_add['%s/s' % k] = (v - self.store[k]) / diff
-                    else:
-                        to_add['%s/s' % k] = 0
-                    self.store[k] = data[k]
-            for k in by_sec_keys:
-                del data[k]
-            data.update(to_add)
+            # Some are computed in /s, with the previous samples (if any)
+            self._compute_rates(data, ('ctxt', 'processes'), new_stat, old_stat, lambda sample: sample.values['counters'])
+            self._compute_rates(data, ('pgfault', 'pgmajfault'), new_vmstat, old_vmstat, lambda sample: sample.values)
             logger.debug('getKernelStats: completed, returning')
             
             return data
@@ -3,8 +3,8 @@ import re
 import traceback
 import os
 
-from opsbro.util import lower_dict
 from opsbro.collector import Collector
+from opsbro.procfs import procfs_sampler
 
 if os.name == 'nt':
     import opsbro.misc.wmi as wmi
@@ -38,34 +38,12 @@ class Memory(Collector):
         if sys.platform.startswith('linux'):
             # logger.debug('getMemoryUsage: linux2')
             try:
-                with open('/proc/meminfo', 'r') as meminfoProc:
-                    lines = meminfoProc.readlines()
+                # NOTE: the sample is shared with the other collectors, so we work on a copy
+                meminfo = dict(procfs_sampler.get_sample('meminfo').values)
             except IOError as e:
                 logger.error('getMemoryUsage: exception = %s', e)
                 return False
             
-            # logger.debug('getMemoryUsage: open success, parsing')
-            regexp = re.compile(r'([0-9]+)')  # We run this several times so one-time compile now
-            
-            meminfo = {}
-            
-            # Loop through and extract the numerical values
-            for line in lines:
-                values = line.split(':')
-                try:
-                    # Picks out the key (values[0]) and makes a list with the value as the meminfo value (values[1])
-                    # We are only interested in the KB data so regexp that out
-                    match = re.search(regexp, values[1])
-                    
-                    if match is not None:
-                        meminfo[str(values[0])] = int(match.group(0))
-                except IndexError:
-                    break
-            
-            # logger.debug('getMemoryUsage: parsing, looped')
-            
-            # put all keys in lower case
-            meminfo = lower_dict(meminfo)
             memData = {}
             memData['phys_free'] = 0
             memData['phys_used'] = 0
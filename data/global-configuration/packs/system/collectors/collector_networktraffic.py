@@ -8,25 +8,28 @@ if PY3:
     long = int
 
 from opsbro.collector import Collector
-from opsbro.now import NOW
+from opsbro.procfs import procfs_sampler, MIN_RATE_INTERVAL
 
 if os.name == 'nt':
     import opsbro.misc.wmi as wmi
 
 
 class NetworkTraffic(Collector):
+    # the rates need the baseline to be old enough
+    first_run_delay = MIN_RATE_INTERVAL
+    
+    
     def __init__(self):
         super(NetworkTraffic, self).__init__()
-        self.networkTrafficStore = {}
-        self.last_launch = 0.0
+        self.networkTrafficStore = {}  # for freebsd
+        self.last_sample = None  # for linux
+        # A first sample now, so the first run already have stats
+        if sys.platform.startswith('linux'):
+            self.last_sample = procfs_sampler.get_baseline('net_dev')
     
     
     def launch(self):
         logger = self.logger
-        now = int(NOW.monotonic())
-        diff = now - self.last_launch  # note: thanks to monotonic clock, we cannot have a negative diff
-        self.last_launch = now
-        
         logger.debug('getNetworkTraffic: start')
         if os.name == 'nt':
             data = {}
@@ -45,78 +48,41 @@ class NetworkTraffic(Collector):
             logger.debug('getNetworkTraffic: linux2')
             
             try:
-                logger.debug('getNetworkTraffic: attempting open')
-                proc = open('/proc/net/dev', 'r')
-                lines = proc.readlines()
-                proc.close()
-            
+                new_sample, old_sample = procfs_sampler.get_samples_since('net_dev', self.last_sample)
             except IOError as e:
                 logger.error('getNetworkTraffic: exception = %s', e)
                 return False
+            self.last_sample = new_sample
             
-            logger.debug('getNetworkTraffic: open success, parsing')
-            
-            columnLine = lines[1]
-            _, receiveCols, transmitCols = columnLine.split('|')
-            receiveCols = list(map(lambda a: 'recv_' + a, receiveCols.split()))
-            transmitCols = list(map(lambda a: 'trans_' + a, transmitCols.split()))
-            
-            cols = receiveCols + transmitCols
-            
-            logger.debug('getNetworkTraffic: parsing, looping')
-            
-            faces = {}
-            for line in lines[2:]:
-                if line.find(':') < 0:
-                    continue
-                face, data = line.split(':')
-                # skipping lo because we just don't care about it :)
-                if face.strip() == 'lo':
-                    continue
-                faceData = dict(zip(cols, data.split()))
-                faces[face] = faceData
-            
-            logger.debug('getNetworkTraffic: parsed, looping')
+            # We need to work out the traffic since the last check so first time we only store the current value
+            # then the next time we can calculate the difference
+            if old_sample is None:
+                return {}
+            diff = new_sample.time - old_sample.time
             
             interfaces = {}
-            
+            by_sec_keys = ('recv_bytes', 'trans_bytes', 'recv_packets', 'trans_packets')
             # Now loop through each interface
-            for face in faces:
-                key = face.strip()
-                
-                # We need to work out the traffic since the last check so first time we store the current value
-                # then the next time we can calculate the difference
-                try:
-                    list_of_keys = faces[face].keys()
-                    by_sec_keys = ['recv_bytes', 'trans_bytes', 'recv_packets', 'trans_packets']
-                    if key in self.networkTrafficStore:
-                        interfaces[key] = {}
-                        for k in list_of_keys:
-                            interfaces[key][k] = long(faces[face][k]) - long(self.networkTrafficStore[key][k])
-                            
-                            if interfaces[key][k] < 0:
-                                interfaces[key][k] = long(faces[face][k])
-                            
-                            # Only 'recv_bytes', 'trans_bytes' need /s metrics
-                            if k in by_sec_keys:
-                                interfaces[key]['%s/s' % k] = interfaces[key][k] / diff
-                            
-                            interfaces[key][k] = long(interfaces[key][k])
-                            self.networkTrafficStore[key][k] = long(faces[face][k])
+            for (key, face_data) in new_sample.values.items():
+                # skipping lo because we just don't care about it :)
+                if key == 'lo':
+                    continue
+                old_face_data = old_sample.values.get(key, None)
+                # A new interface, wait a loop to compute it
+                if old_face_data is None:
+                    continue
+                interfaces[key] = {}
+                for (k, v) in face_data.items():
+                    value = v - old_face_data.get(k, v)
+                    # Counter did reset
+                    if value < 0:
+                        value = v
                     
-                    else:
-                        self.networkTrafficStore[key] = {}
-                        for k in list_of_keys:
-                            self.networkTrafficStore[key][k] = long(faces[face][k])
-                            
-                            # Logging
-                    logger.debug('getNetworkTraffic: %s = %s' % (key, self.networkTrafficStore[key]['recv_bytes']))
-                    logger.debug('getNetworkTraffic: %s = %s' % (key, self.networkTrafficStore[key]['trans_bytes']))
-                
-                except KeyError as ex:
-                    logger.error('getNetworkTraffic: no data for %s' % key)
-                except ValueError as ex:
-                    logger.error('getNetworkTraffic: invalid data for %s' % key)
+                    # Only some keys need /s metrics
+                    if k in by_sec_keys:
+                        interfaces[key]['%s/s' % k] = value / diff
+                    
+                    interfaces[key][k] = long(value)
             
             logger.debug('getNetworkTraffic: completed, returning')
             return interfaces
@@ -1,10 +1,9 @@
-import glob
 import threading
 import os
 import time
 
 from .util import make_dir
-from .jsonmgr import jsoner
+from .historystore import HistoryStore
 
 
 # This class is an abstract for various manager
@@ -14,6 +13,7 @@ class BaseManager(object):
     
     def __init__(self):
         self.history_directory = None
+        self.history_store = None
         self._current_history_entry = []
         self._current_history_entry_lock = threading.RLock()
     
@@ -26,6 +26,8 @@ class BaseManager(object):
         self.logger.debug('Asserting existence of the history directory: %s' % self.history_directory)
         if not os.path.exists(self.history_directory):
             make_dir(self.history_directory)
+        self.history_store = HistoryStore(self.history_directory)
+        self.history_store.open()
     
     
     def add_history_entry(self, history_entry):
@@ -40,39 +42,17 @@ class BaseManager(object):
         # We must lock because checks can exit in others threads
         with self._current_history_entry_lock:
             now = int(time.time())
-            pth = os.path.join(self.history_directory, '%d.json' % now)
-            self.logger.debug('Saving new collector history entry to %s' % pth)
-            buf = jsoner.dumps(self._current_history_entry)
-            with open(pth, 'w') as f:
-                f.write(buf)
+            self.logger.debug('Saving new history entry in %s' % self.history_directory)
+            self.history_store.append(now, self._current_history_entry)
             # Now we can reset it
             self._current_history_entry = []
     
     
+    # The last entries (at least 1MB of them if available), older first
     def get_history(self):
-        r = []
-        current_size = 0
-        max_size = 1024 * 1024
-        reg = self.history_directory + '/*.json'
-        history_files = glob.glob(reg)
-        # Get from the more recent to the older
-        history_files.sort()
-        history_files.reverse()
-        
-        # Do not send more than 1MB, but always a bit more, not less
-        for history_file in history_files:
-            epoch_time = int(os.path.splitext(os.path.basename(history_file))[0])
-            with open(history_file, 'r') as f:
-                e = jsoner.loads(f.read())
-            r.append({'date': epoch_time, 'entries': e})
-            
-            # If we are now too big, return directly
-            size = os.path.getsize(history_file)
-            current_size += size
-            if current_size > max_size:
-                # Give older first
-                r.reverse()
-                return r
-        # give older first
-        r.reverse()
-        return r
+        return self.history_store.get_tail(max_size=1024 * 1024)
+    
+    
+    # The entries between the start and end times, older first
+    def get_history_range(self, start, end):
+        return self.history_store.get_range(start, end)
@@ -1,38 +1,171 @@
+import time
 import threading
+from collections import deque
 
-from .util import my_sort, my_cmp
+from .jsonmgr import jsoner
+from .wirecodec import encode_binary_item, make_binary_packet, BINARY_HEADER, BINARY_END
 
-
-# TODO: use the lock for every call
 # TODO: when stacking a message for a specific group, first check if there is a node which such a group
 
+# Max size of a gossip UDP packet (before encryption)
+MAX_PACKET_SIZE = 1400
+
+# We do not want to have an infinite queue, like when there are a lot of nodes changes, so
+# we drop the oldest messages when we are over this
+MAX_BROADCASTS = 5000
+
+# A message that is still there after this time is not useful anymore
+BROADCAST_MAX_AGE = 120
+
+# A prioritary message is sent before others for its first sends (maybe the first did miss)
+PRIORITARY_SENDS = 2
+
+# Binary packets have a header, the array size (max 3 bytes) and an end marker
+BINARY_PACKET_OVERHEAD = len(BINARY_HEADER) + 3 + len(BINARY_END)
+
+
+# One message to broadcast, with its json already computed
+class Broadcast(object):
+    __slots__ = ('msg', 'send', 'prioritary', 'group', 'ctime', 'encoded', 'binary_encoded')
+    
+    
+    def __init__(self, msg, send=0, prioritary=False, group=None):
+        self.msg = msg
+        self.send = send
+        self.prioritary = prioritary
+        self.group = group
+        self.ctime = time.time()
+        self.encoded = jsoner.dumps(msg)
+        self.binary_encoded = None  # only computed if a node want it
+    
+    
+    def get_binary_encoded(self):
+        if self.binary_encoded is None:
+            self.binary_encoded = encode_binary_item(self.msg)
+        return self.binary_encoded
+    
+    
+    # The bucket where the message is:
+    # * prioritary messages with few sends
+    # * then less send first
+    def get_bucket_key(self):
+        if self.prioritary and self.send <= PRIORITARY_SENDS:
+            return (0, self.send)
+        return (1, self.send)
+
+
 # This will manage all broadcasts
+# Messages are stored in buckets by priority and number of sends, so we never need to sort them
 class Broadcaster(object):
     def __init__(self):
-        self.broadcasts = []
+        self.buckets = {}  # bucket key -> deque of Broadcast, oldest first
+        self.nb_broadcasts = 0
         self.broadcasts_lock = threading.RLock()
     
     
-    def __sort_function(self, b1, b2):
-        b1_send = b1['send']
-        b2_send = b2['send']
-        # if there is a prioritaty with 0 or 1 send (maybe the first did miss), send it in priority
-        if b1.get('prioritary', False) and b1_send <= 2:
-            return -1
-        if b2.get('prioritary', False) and b2_send <= 2:
-            return 1
-        # Less send first
-        return my_cmp(b1_send, b2_send)
+    def __len__(self):
+        return self.nb_broadcasts
+    
     
+    def __add_in_bucket(self, b):
+        k = b.get_bucket_key()
+        bucket = self.buckets.get(k, None)
+        if bucket is None:
+            bucket = self.buckets[k] = deque()
+        bucket.append(b)
+        self.nb_broadcasts += 1
     
+    
+    def __drop_oldest(self):
+        oldest_key = None
+        oldest_ctime = None
+        for (k, bucket) in self.buckets.items():
+            if bucket and (oldest_ctime is None or bucket[0].ctime < oldest_ctime):
+                oldest_key = k
+                oldest_ctime = bucket[0].ctime
+        if oldest_key is None:
+            return
+        bucket = self.buckets[oldest_key]
+        bucket.popleft()
+        self.nb_broadcasts -= 1
+        if not bucket:
+            del self.buckets[oldest_key]
+    
+    
+    # msg is a dict like {'send': 0, 'msg': msg, 'prioritary': True, 'group': 'xxx'}
     def append(self, msg):
+        b = Broadcast(msg['msg'], send=msg.get('send', 0), prioritary=msg.get('prioritary', False), group=msg.get('group', None))
         with self.broadcasts_lock:
-            self.broadcasts.append(msg)
+            self.__add_in_bucket(b)
+            while self.nb_broadcasts > MAX_BROADCASTS:
+                self.__drop_oldest()
     
     
-    def sort(self):
+    # Get the json packets (list of messages) to send to a node with such groups, with the prioritary
+    # and less send messages first.
+    # If consume, the messages send number is increased, and the ones that are send more than max_send
+    # are removed
+    # If binary, the packets are in the binary wire codec instead of json
+    def get_packets(self, groups, consume=True, max_send=10, max_size=MAX_PACKET_SIZE, binary=False):
+        packets = []
+        current = []
+        current_size = 0
+        if binary:
+            make_packet = make_binary_packet
+            packet_overhead = BINARY_PACKET_OVERHEAD
+            separator_size = 0
+        else:
+            make_packet = self.__make_json_packet
+            packet_overhead = 2  # '[' + ', '.join(messages) + ']'
+            separator_size = 2
+        too_old = time.time() - BROADCAST_MAX_AGE
+        # the consumed messages are put in their new bucket only at the end, so we do not see them twice
+        changed = []
         with self.broadcasts_lock:
-            self.broadcasts = my_sort(self.broadcasts, cmp_f=self.__sort_function)
+            for k in sorted(self.buckets.keys()):
+                bucket = self.buckets[k]
+                kept = deque()
+                for b in bucket:
+                    if b.ctime < too_old:
+                        self.nb_broadcasts -= 1
+                        continue
+                    # not a valid node for this message, skip it
+                    if b.group is not None and b.group not in groups:
+                        kept.append(b)
+                        continue
+                    encoded = b.get_binary_encoded() if binary else b.encoded
+                    size = len(encoded) + (separator_size if current else 0)
+                    if current and current_size + size > max_size:
+                        packets.append(make_packet(current))
+                        current = []
+                        size = len(encoded)
+                    if not current:
+                        current_size = packet_overhead
+                    current.append(encoded)
+                    current_size += size
+                    
+                    # Increase message send number but only if we need to consume it (our zone send)
+                    if consume:
+                        b.send += 1
+                        self.nb_broadcasts -= 1
+                        if b.send < max_send:
+                            changed.append(b)
+                    else:
+                        kept.append(b)
+                if kept:
+                    self.buckets[k] = kept
+                else:
+                    del self.buckets[k]
+            for b in changed:
+                self.__add_in_bucket(b)
+        if current:
+            packets.append(make_packet(current))
+        return packets
+    
+    
+    @staticmethod
+    def __make_json_packet(encoded_messages):
+        return '[%s]' % ', '.join(encoded_messages)
 
 
 broadcaster = Broadcaster()
@@ -28,7 +28,7 @@ from .httpclient import get_http_exceptions, httper
 from .gossip import gossiper
 from .raft import get_rafter
 from .configurationmanager import configmgr
-from .kv import kvmgr
+from .kv import kvmgr, CHANGES_PAGE_SIZE
 from .dockermanager import dockermgr
 from .library import libstore
 from .collectormanager import collectormgr
@@ -38,6 +38,7 @@ from .evaluater import evaluater
 from .detectormgr import detecter
 from .generatormgr import generatormgr
 from .ts import tsmgr
+from .stats import STATS
 from .jsonmgr import jsoner
 from .modulemanager import modulemanager
 from .executer import executer
@@ -50,6 +51,7 @@ from .packer import packer
 from .agentstates import AGENT_STATES
 from .udplistener import get_udp_listener
 from .zonemanager import zonemgr
+from .retention import RetentionLog
 
 # Global logger for this part
 logger = LoggerFactory.create_logger(DEFAULT_LOG_PART)
@@ -119,6 +121,12 @@ class Cluster(object):
         
         self.log_level = 'INFO'
         
+        # When the key/value update log is synced on the disk: always, interval or never
+        self.kv_fsync_policy = 'interval'
+        
+        # Should the agent metrics (/agent/metrics) be saved in the time series
+        self.agent_metrics_in_ts = False
+        
         # now we read them, set it in our object
         parameters_from_local_configuration = configmgr.get_parameters_for_cluster_from_configuration()
         
@@ -135,6 +143,7 @@ class Cluster(object):
         
         # open the log file
         raw_logger.load(self.log_dir, self.name)
+        raw_logger.launch_writer()
         raw_logger.export_http()
         
         topiker.set_topic_state(TOPIC_SERVICE_DISCOVERY, self.service_discovery_topic_enabled)
@@ -190,9 +199,10 @@ class Cluster(object):
             os.mkdir(self.agent_instance_dir)
         self.incarnation_file = os.path.join(self.agent_instance_dir, 'incarnation')
         self.nodes_file = os.path.join(self.agent_instance_dir, 'nodes.json')
-        self.check_retention = os.path.join(self.agent_instance_dir, 'checks.dat')
-        self.service_retention = os.path.join(self.agent_instance_dir, 'services.dat')
-        self.collector_retention = os.path.join(self.agent_instance_dir, 'collectors.dat')
+        # Only the changed checks, services and collectors are written, the .dat files are the full dumps of previous versions
+        self.check_retention = RetentionLog(os.path.join(self.agent_instance_dir, 'checks.retention'), old_path=os.path.join(self.agent_instance_dir, 'checks.dat'))
+        self.service_retention = RetentionLog(os.path.join(self.agent_instance_dir, 'services.retention'), old_path=os.path.join(self.agent_instance_dir, 'services.dat'))
+        self.collector_retention = RetentionLog(os.path.join(self.agent_instance_dir, 'collectors.retention'), old_path=os.path.join(self.agent_instance_dir, 'collectors.dat'))
         
         # Now load nodes to do not start from zero, but not ourselves (we will regenerate it with a new incarnation number and
         # up to date info)
@@ -220,13 +230,17 @@ class Cluster(object):
         # We can give the cfg dir to the monitoring part, to allow it to manage/update
         # json files
         monitoringmgr.load(self.cfg_dir, self.cfg_data)
-        monitoringmgr.load_check_retention(self.check_retention)
-        monitoringmgr.load_service_retention(self.service_retention)
+        logger.info('Loading checks and services retention')
+        monitoringmgr.load_check_retention(self.check_retention.load())
+        monitoringmgr.load_service_retention(self.service_retention.load())
         
         # Now init the kv backend and allow it to load its database
-        kvmgr.init(self.data_dir)
+        kvmgr.init(self.data_dir, fsync_policy=self.kv_fsync_policy)
         
         self.last_retention_write = time.time()
+        # the nodes and incarnation are only written if they did change
+        self.last_retention_nodes_version = None
+        self.last_retention_incarnation = None
         
         # we keep the data about the last time we were launch, to detect crash and such things
         if os.path.exists(self.last_alive_file):
@@ -271,6 +285,11 @@ class Cluster(object):
         tsmgr.tsb.load(self.data_dir)
         tsmgr.tsb.export_http()
         
+        # Our own metrics, and maybe in the time series too
+        STATS.export_http()
+        if self.agent_metrics_in_ts:
+            STATS.launch_ts_push_thread()
+        
         # Executore interface
         executer.export_http()
         
@@ -335,14 +354,9 @@ class Cluster(object):
     # Load raw results of collectors, and give them to the
     # collectormgr that will know how to load them :)
     def load_collector_retention(self):
-        if not os.path.exists(self.collector_retention):
-            return
-        
-        logger.info('Collectors loading collector retention file %s' % self.collector_retention)
-        with open(self.collector_retention, 'r') as f:
-            loaded = jsoner.loads(f.read())
-            collectormgr.load_retention(loaded)
-        logger.info('Collectors loaded retention file %s' % self.collector_retention)
+        logger.info('Collectors loading collector retention file %s' % self.collector_retention.path)
+        collectormgr.load_retention(self.collector_retention.load())
+        logger.info('Collectors loaded retention file %s' % self.collector_retention.path)
     
     
     # What to do when we receive a signal from the system
@@ -691,17 +705,25 @@ class Cluster(object):
                 port = repl['port']
                 logger.info('SYNC try to sync from %s since the time %s' % (repl['name'], self.last_alive))
                 uri = 'http://%s:%s/kv-meta/changed/%d' % (addr, port, self.last_alive)
+                # The changes are asked by pages, and merged page after page
+                params = {'limit': CHANGES_PAGE_SIZE}
                 try:
-                    r = httper.get(uri)
-                    logger.debug("SYNC kv-changed response from %s " % repl['name'], len(r))
-                    try:
-                        to_merge = jsoner.loads(r)
-                    except (ValueError, TypeError) as exp:
-                        logger.debug('SYNC : error asking to %s: %s' % (repl['name'], str(exp)))
-                        continue
-                    kvmgr.do_merge(to_merge)
-                    logger.debug("SYNC thread done, bailing out")
-                    return
+                    while True:
+                        r = httper.get(uri, params=params)
+                        logger.debug("SYNC kv-changed response from %s " % repl['name'], len(r))
+                        try:
+                            page = jsoner.loads(r)
+                        except (ValueError, TypeError) as exp:
+                            logger.debug('SYNC : error asking to %s: %s' % (repl['name'], str(exp)))
+                            break
+                        # Old nodes do not manage the pages and give all the changes
+                        if isinstance(page, list):
+                            page = {'entries': page, 'next': None}
+                        kvmgr.do_merge(page['entries'])
+                        if page['next'] is None:
+                            logger.debug("SYNC thread done, bailing out")
+                            return
+                        params = {'limit': CHANGES_PAGE_SIZE, 'after': page['next']}
                 except get_http_exceptions() as exp:
                     logger.debug('SYNC : error asking to %s: %s' % (repl['name'], str(exp)))
                     continue
@@ -715,40 +737,35 @@ class Cluster(object):
         
         now = int(time.time())
         if force or (now - 60 > self.last_retention_write):
-            with open(self.nodes_file + '.tmp', 'w') as f:
-                with gossiper.nodes_lock:
-                    nodes = copy.copy(gossiper.nodes)
-                f.write(jsoner.dumps(nodes))
-            # now more the tmp file into the real one
-            shutil.move(self.nodes_file + '.tmp', self.nodes_file)
+            nodes_version = gossiper.get_nodes_version()
+            if nodes_version != self.last_retention_nodes_version:
+                with open(self.nodes_file + '.tmp', 'w') as f:
+                    with gossiper.nodes_lock:
+                        nodes = copy.copy(gossiper.nodes)
+                    f.write(jsoner.dumps(nodes))
+                # now more the tmp file into the real one
+                shutil.move(self.nodes_file + '.tmp', self.nodes_file)
+                self.last_retention_nodes_version = nodes_version
             
             # Same for the incarnation data!
-            with open(self.incarnation_file + '.tmp', 'w') as f:
-                f.write(jsoner.dumps(gossiper.incarnation))
-            # now more the tmp file into the real one
-            shutil.move(self.incarnation_file + '.tmp', self.incarnation_file)
+            incarnation = gossiper.incarnation
+            if incarnation != self.last_retention_incarnation:
+                with open(self.incarnation_file + '.tmp', 'w') as f:
+                    f.write(jsoner.dumps(incarnation))
+                # now more the tmp file into the real one
+                shutil.move(self.incarnation_file + '.tmp', self.incarnation_file)
+                self.last_retention_incarnation = incarnation
             
-            with open(self.check_retention + '.tmp', 'w') as f:
-                f.write(jsoner.dumps(monitoringmgr.checks))
-            # now move the tmp into the real one
-            shutil.move(self.check_retention + '.tmp', self.check_retention)
-            
-            with open(self.service_retention + '.tmp', 'w') as f:
-                f.write(jsoner.dumps(monitoringmgr.services))
-            # now move the tmp into the real one
-            shutil.move(self.service_retention + '.tmp', self.service_retention)
+            # Only the changed checks, services and collectors are appended
+            self.check_retention.write(monitoringmgr.pop_check_retention_changes(), monitoringmgr.get_check_retention)
+            self.service_retention.write(monitoringmgr.pop_service_retention_changes(), monitoringmgr.get_service_retention)
+            self.collector_retention.write(collectormgr.pop_retention_changes(), collectormgr.get_retention)
             
             with open(self.last_alive_file + '.tmp', 'w') as f:
                 f.write(jsoner.dumps(int(time.time())))
             # now move the tmp into the real one
             shutil.move(self.last_alive_file + '.tmp', self.last_alive_file)
             
-            with open(self.collector_retention + '.tmp', 'w') as f:
-                data = collectormgr.get_retention()
-                f.write(jsoner.dumps(data))
-            # now move the tmp into the real one
-            shutil.move(self.collector_retention + '.tmp', self.collector_retention)
-            
             self.last_retention_write = now
     
     
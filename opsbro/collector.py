@@ -35,6 +35,14 @@ class CollectorMetaclass(type):
 
 @add_metaclass(CollectorMetaclass)
 class Collector(ParameterBasedType):
+    # Default time between two runs, and max time for a run. Can be changed by the pack
+    # parameters <collector name>_interval and <collector name>_timeout
+    interval = 10
+    timeout = 30
+    # Time after the load before the first run, like for the collectors that compute rates
+    # and need their first samples to be far enough
+    first_run_delay = 0
+    
     
     @classmethod
     def get_sub_class(cls):
@@ -58,6 +66,20 @@ class Collector(ParameterBasedType):
         self.__did_state_change = False
     
     
+    def get_parameters_from_pack(self):
+        from .configurationmanager import configmgr
+        ParameterBasedType.get_parameters_from_pack(self)
+        pack_parameters = configmgr.get_parameters_from_pack(self.pack_name)
+        for prop in ('interval', 'timeout'):
+            value = pack_parameters.get('%s_%s' % (self.name, prop), None)
+            if value is None:
+                continue
+            if not isinstance(value, (int, long, float)) or value <= 0:
+                self.set_configuration_error('The value %s for parameter %s_%s is not valid, should be a positive number' % (value, self.name, prop))
+                continue
+            setattr(self, prop, value)
+    
+    
     def is_in_group(self, group):
         from opsbro.gossip import gossiper
         return gossiper.is_in_group(group)
@@ -109,8 +131,13 @@ class Collector(ParameterBasedType):
         # Get output from a command
         self.logger.debug('execute_shell:: %s' % cmd)
         try:
-            rc, output, err = exec_command(cmd)
+            rc, output, err = exec_command(cmd, timeout=self.timeout)
             self.logger.debug('OUTPUT, ERR', output, err)
+            # killed by a signal, like our timeout
+            if rc < 0:
+                if if_fail_set_error:
+                    self.set_error('The command [%s] was killed (signal %d), maybe by the %ss timeout' % (cmd, -rc, self.timeout))
+                return False
             if err:
                 if if_fail_set_error:
                     self.set_error('Error in sub process: %s' % err)
@@ -126,7 +153,7 @@ class Collector(ParameterBasedType):
         # Get output from a command
         self.logger.debug('execute_shell:: %s' % cmd)
         try:
-            exit_status, output, err = exec_command(cmd)
+            exit_status, output, err = exec_command(cmd, timeout=self.timeout)
         except Exception as exp:
             return 'Cannot execute command %s: %s' % (cmd, 2)
         return exit_status, output
@@ -7,6 +7,12 @@ import glob
 import imp
 import copy
 import json
+import heapq
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
 from .log import LoggerFactory
 from .threadmgr import threader
@@ -26,6 +32,33 @@ logger = LoggerFactory.create_logger('collector')
 COLLECTORS_STATE_COLORS = {'OK': 'green', 'ERROR': 'red', 'NOT-ELIGIBLE': 'grey', 'RUNNING': 'grey', 'PENDING': 'grey'}
 COLLECTORS_STATES = ['PENDING', 'OK', 'NOT-ELIGIBLE', 'RUNNING', 'ERROR']
 
+# Number of threads that are running the collectors
+NB_COLLECTOR_WORKERS = 4
+
+try:
+    _string_types = basestring
+except NameError:  # python3
+    _string_types = str
+
+
+# Get all the paths of a collector results, like memory.phys_used, and their values
+# NOTE: as with the dotted path walk, only the string keys without dots can be reached
+def _flatten_results(cname, results):
+    r = {cname: results}
+    if not isinstance(results, dict):
+        return r
+    todo = [(cname, results)]
+    while todo:
+        prefix, d = todo.pop()
+        for (k, v) in d.items():
+            if not isinstance(k, _string_types) or '.' in k:
+                continue
+            path = prefix + '.' + k
+            r[path] = v
+            if isinstance(v, dict):
+                todo.append((path, v))
+    return r
+
 
 def get_collectors(self):
     collector_dir = os.path.dirname(__file__)
@@ -57,9 +90,29 @@ class CollectorManager(BaseManager):
         self.results_lock = threading.RLock()
         self.results = {}
         
+        # collector name -> (path -> value of its results), for the evaluations lookups. The index
+        # of a collector is never modified, but replaced (copy on write) when it has new results,
+        # so the other collectors ones are not copied
+        self.data_indexes = {}
+        # increased each time a collector results did change, so others can skip work if not
+        self.data_version = 0
+        
+        # collectors that did change since the last retention write
+        self.retention_dirty = set()
+        
+        # Increased each time a collector entry did change, so the http responses can be cached
+        self.collectors_version = 0
+        
         self.logger = logger
         
-        self.cur_launchs = {}
+        # heap of (next_check, collector name), so we only look at the collectors we need to launch
+        self.schedule = []
+        # collectors names to run, for the workers
+        self.work_queue = Queue()
+        self.workers_launched = False
+        self.nb_workers = 0  # all the workers we did launch, only for their names
+        # protect the overrun flag between the workers and the overruns look
+        self.workers_lock = threading.RLock()
     
     
     def load_directory(self, directory, pack_name='', pack_level=''):
@@ -107,17 +160,28 @@ class CollectorManager(BaseManager):
             logger.error('Cannot load the %s collector: %s' % (cls, traceback.format_exc()))
             return
         
+        # NOTE: all collectors are launched at start (after their first_run_delay), so we have our
+        # data, but then the next runs are set randomly, so they are not all launched at the same time
         e = {
-            'name'      : colname,
-            'inst'      : inst,
-            'last_check': 0,
-            'next_check': int(time.time()) + int(random.random()) * 10,
-            'results'   : None,
-            'metrics'   : None,
-            'active'    : False,
-            'log'       : '',
+            'name'           : colname,
+            'inst'           : inst,
+            'last_check'     : 0,
+            'next_check'     : time.time() + inst.first_run_delay,
+            'results'        : None,
+            'metrics'        : None,
+            'active'         : False,
+            'log'            : '',
+            'queued'         : False,
+            'running_since'  : 0,
+            'overrun'        : False,
+            'nb_overruns'    : 0,
+            # (state, old_state) of the last retention write
+            'retention_state': None,
         }
         self.collectors[colname] = e
+        self.collectors_version += 1
+        heapq.heappush(self.schedule, (e['next_check'], colname))
+        self.__update_data_index(colname, None)
     
     
     # Now we hae our collectors and our parameters, link both
@@ -139,15 +203,28 @@ class CollectorManager(BaseManager):
         return res
     
     
+    @staticmethod
+    def __get_retention_entry(e):
+        return {'results': e['results'], 'metrics': e['metrics'], 'state': e['inst'].state, 'old_state': e['inst'].old_state}
+    
+    
     def get_retention(self):
         res = {}
         with self.results_lock:
             for (cname, e) in self.collectors.items():
-                res[cname] = {}
-                res[cname]['results'] = e['results']
-                res[cname]['metrics'] = e['metrics']
-                res[cname]['state'] = e['inst'].state
-                res[cname]['old_state'] = e['inst'].old_state
+                res[cname] = self.__get_retention_entry(e)
+        return res
+    
+    
+    # Only the collectors that did change since the last call
+    def pop_retention_changes(self):
+        res = {}
+        with self.results_lock:
+            dirty, self.retention_dirty = self.retention_dirty, set()
+            for cname in dirty:
+                e = self.collectors.get(cname, None)
+                if e is not None:
+                    res[cname] = self.__get_retention_entry(e)
         return res
     
     
@@ -160,23 +237,29 @@ class CollectorManager(BaseManager):
                 inst = self.collectors[cname]['inst']
                 self.collectors[cname]['results'] = e['results']
                 self.collectors[cname]['metrics'] = e['metrics']
+                self.__update_data_index(cname, e['results'])
                 inst.state = e.get('state', 'PENDING')
                 inst.old_state = e.get('old_state', 'PENDING')
+            self.collectors_version += 1
     
     
     def get_data(self, s):
-        elts = s.split('.')
-        d = {}
-        # construct will all results of our collectors
-        for (k, v) in self.collectors.items():
-            d[k] = v['results']
-        
-        for k in elts:
-            if not isinstance(d, dict) or k not in d:
-                raise KeyError('Cannot find %s key %s in %s' % (s, k, elts))
-            d = d[k]
-        # last is the good one
-        return d
+        try:
+            # the first part of the path is the collector name
+            return self.data_indexes[s.split('.', 1)[0]][s]
+        except KeyError:
+            raise KeyError('Cannot find %s key in the collectors data' % s)
+    
+    
+    def get_data_version(self):
+        return self.data_version
+    
+    
+    # Replace the index of this collector by a new one
+    def __update_data_index(self, cname, results):
+        with self.results_lock:
+            self.data_indexes[cname] = _flatten_results(cname, results)
+            self.data_version += 1
     
     
     # Our collector threads will put back results so beware of the threads
@@ -190,14 +273,31 @@ class CollectorManager(BaseManager):
         col = self.collectors[cname]
         col['log'] = log
         
+        # The retention is only written for the collectors that did change
+        inst = col['inst']
+        retention_state = (inst.state, inst.old_state)
+        if col['retention_state'] != retention_state:
+            col['retention_state'] = retention_state
+            with self.results_lock:
+                self.retention_dirty.add(cname)
+        
         # Only set results and metrics if available
         if not results:
             col['active'] = False
+            self.collectors_version += 1
             return
         
+        old_results = col['results']
+        old_metrics = col['metrics']
         col['results'] = results
         col['metrics'] = metrics
         col['active'] = True
+        if results != old_results:
+            self.__update_data_index(cname, results)
+        if results != old_results or metrics != old_metrics:
+            with self.results_lock:
+                self.retention_dirty.add(cname)
+        self.collectors_version += 1
         
         timestamp = NOW.now
         for (mname, value) in metrics:
@@ -206,31 +306,112 @@ class CollectorManager(BaseManager):
                 tsmgr.tsb.add_value(timestamp, key, value, local=True)
     
     
-    def _launch_collectors(self):
-        now = int(time.time())
+    def __launch_workers(self):
+        if self.workers_launched:
+            return
+        self.workers_launched = True
+        for i in range(NB_COLLECTOR_WORKERS):
+            self.__launch_worker()
+    
+    
+    def __launch_worker(self):
+        threader.create_and_launch(self.do_collector_worker, name='collector-worker-%d' % self.nb_workers, part='collector', essential=True)
+        self.nb_workers += 1
+    
+    
+    def do_collector_worker(self):
+        while not stopper.is_stop():
+            try:
+                colname = self.work_queue.get(timeout=1)
+            except Empty:
+                continue
+            e = self.collectors.get(colname, None)
+            if e is None:
+                continue
+            logger.debug('COLLECTOR: launching collector %s' % colname)
+            e['running_since'] = time.time()
+            e['queued'] = False
+            self.collectors_version += 1
+            try:
+                e['inst'].main()
+            except Exception:
+                err = traceback.format_exc()
+                logger.error('COLLECTOR: the collector %s did fail: %s' % (colname, err))
+                e['inst'].set_error('The collector did fail: %s' % err)
+            finally:
+                with self.workers_lock:
+                    lost = e['overrun']
+                    e['running_since'] = 0
+                    e['overrun'] = False
+                self.collectors_version += 1
+            # A replacement was launched when this run was flagged as overrun, so we are one too many
+            if lost:
+                logger.info('COLLECTOR: the collector %s did finish its overrun, stopping its worker' % colname)
+                return
+    
+    
+    # A run that is too long cannot be killed (it's a thread), but we can flag it, and launch
+    # another worker so the hanging ones cannot take the whole pool. The worker will exit when the
+    # run finishes, and as a collector runs only once at a time, there cannot be more lost workers
+    # than collectors
+    # NOTE: the shell commands of the collectors are killed at the timeout
+    def __look_for_overruns(self, now):
         for (colname, e) in self.collectors.items():
-            colname = e['name']
-            inst = e['inst']
-            # maybe a collection is already running
-            if colname in self.cur_launchs:
+            timeout = e['inst'].timeout
+            with self.workers_lock:
+                running_since = e['running_since']
+                if not running_since or e['overrun'] or now - running_since <= timeout:
+                    continue
+                e['overrun'] = True
+            e['nb_overruns'] += 1
+            logger.warning('COLLECTOR: the collector %s is running since %ds, more than its %ds timeout, launching another worker' % (colname, now - running_since, timeout))
+            e['inst'].set_error('The collector is running since more than its %ds timeout' % timeout)
+            self.collectors_version += 1
+            # its worker is lost until the run ends
+            self.__launch_worker()
+    
+    
+    def _launch_collectors(self):
+        self.__launch_workers()
+        now = time.time()
+        self.__look_for_overruns(now)
+        
+        launched = []
+        while self.schedule and self.schedule[0][0] <= now:
+            next_check, colname = heapq.heappop(self.schedule)
+            e = self.collectors.get(colname, None)
+            if e is None:
+                continue
+            interval = e['inst'].interval
+            if not e['last_check']:
+                # first run: spread the next ones
+                next_check = now + interval * (0.5 + random.random())
+            else:
+                # Keep the same rythm, but if we are too late, do not try to catch up with a burst of runs
+                next_check += interval
+                if next_check <= now:
+                    next_check = now + interval
+            e['next_check'] = next_check
+            self.collectors_version += 1
+            heapq.heappush(self.schedule, (next_check, colname))
+            
+            # maybe a collection is already running, skip this turn
+            if e['queued'] or e['running_since']:
+                logger.debug('COLLECTOR: skipping collector %s as its previous run is not finished' % colname)
                 continue
-            if now >= e['next_check']:
-                logger.debug('COLLECTOR: launching collector %s' % colname)
-                t = threader.create_and_launch(inst.main, name='collector-%s' % colname, part='collector')
-                self.cur_launchs[colname] = t
-                e['next_check'] += 10
-                e['last_check'] = now
+            e['queued'] = True
+            e['last_check'] = now
+            self.work_queue.put(colname)
+            launched.append(e)
         
-        to_del = []
-        for (colname, t) in self.cur_launchs.items():
-            # if the thread is finish, join it
-            # NOTE: but also wait for all first execution to finish
-            if not t.is_alive() or not self.did_run:
-                logger.debug('Joining collector thread: %s' % colname)
-                t.join()
-                to_del.append(colname)
-        for colname in to_del:
-            del self.cur_launchs[colname]
+        # NOTE: wait for all first execution to finish (or to be too long) so our data are ok
+        if not self.did_run:
+            while not stopper.is_stop():
+                now = time.time()
+                if all(not e['queued'] and (not e['running_since'] or e['overrun']) for e in launched):
+                    break
+                self.__look_for_overruns(now)
+                time.sleep(0.1)
     
     
     # Main thread for launching collectors
@@ -264,8 +445,8 @@ class CollectorManager(BaseManager):
     def export_http(self):
         from .httpdaemon import http_export, response
         
-        @http_export('/collectors/')
-        @http_export('/collectors')
+        @http_export('/collectors/', cache_version=lambda: self.collectors_version)
+        @http_export('/collectors', cache_version=lambda: self.collectors_version)
         #        @protected()
         def GET_collectors():
             response.content_type = 'application/json'
@@ -3,12 +3,18 @@ import os
 import json
 import glob
 import imp
+import threading
 from collections import deque
 import traceback
 
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
 from .log import LoggerFactory
 from .stop import stopper
-from .evaluater import evaluater
+from .evaluater import evaluater, ExprInputsTracker
 from .topic import topiker, TOPIC_SYSTEM_COMPLIANCE
 from .handlermgr import handlermgr
 from .basemanager import BaseManager
@@ -38,6 +44,10 @@ COMPLIANCE_STATE_COLORS = {COMPLIANCE_STATES.RUNNING     : 'magenta',
 ALL_COMPLIANCE_STATES = COMPLIANCE_STATE_COLORS.keys()
 COMPLIANCE_LOG_COLORS = {'SUCCESS': 'green', 'ERROR': 'red', 'FIX': 'cyan', 'COMPLIANT': 'green'}
 
+# Number of threads that are running the compliances. The rules of a compliance are always
+# run in order by the same thread
+NB_COMPLIANCE_WORKERS = 4
+
 
 class ComplianceRuleEnvironment(object):
     def __init__(self, env_def):
@@ -88,6 +98,12 @@ class ComplianceMetaClass(type):
 class InterfaceComplianceDriver(object):
     name = '__MISSING__NAME__'
     
+    # How many rules of this driver can run at the same time (None: no limit). Drivers with the
+    # same concurrency_group (default: their name) share this limit, like the ones that are
+    # using the package manager
+    max_concurrency = None
+    concurrency_group = None
+    
     
     @classmethod
     def get_sub_class(cls):
@@ -357,6 +373,10 @@ class Compliance(object):
         
         self.__forced = False
         
+        # verify_if is evaluated again only if what it reads did change
+        self.__verify_if_tracker = ExprInputsTracker()
+        self.__verify_if_result = False
+        
         self.__state = COMPLIANCE_STATES.PENDING
         self.__old_state = COMPLIANCE_STATES.PENDING
         
@@ -409,12 +429,18 @@ class Compliance(object):
         
         verify_if = self.get_verify_if()
         try:
+            inputs = evaluater.get_expr_inputs(verify_if)
+            if not self.__verify_if_tracker.did_change(inputs):
+                return self.__verify_if_result
             r = evaluater.eval_expr(verify_if)
+            self.__verify_if_tracker.set_evaluated(inputs)
+            self.__verify_if_result = bool(r)
             if not r:
                 self.set_not_eligible()
                 return False
             return True
         except Exception as exp:
+            self.__verify_if_tracker.set_evaluated(None)
             err = ' (%s) if rule (%s) evaluation did fail: %s' % (self.name, verify_if, exp)
             logger.error(err)
             self.add_error(err)
@@ -517,6 +543,14 @@ class ComplianceManager(BaseManager):
         self.compliances = {}
         self.did_run = False
         self.drivers = {}
+        # concurrency group -> semaphore, for the drivers with a max_concurrency
+        self.drivers_semaphores = {}
+        
+        # compliances to run, for the workers, and the ones that are queued or running
+        self.work_queue = Queue()
+        self.in_flight = set()
+        self.in_flight_lock = threading.RLock()
+        self.workers_launched = False
         
         self.logger = logger
     
@@ -533,6 +567,10 @@ class ComplianceManager(BaseManager):
             ctx = cls()
             logger.debug('Trying compliance driver %s' % ctx.name)
             self.drivers[cls.name] = ctx
+            if cls.max_concurrency:
+                group = cls.concurrency_group or cls.name
+                if group not in self.drivers_semaphores:
+                    self.drivers_semaphores[group] = threading.BoundedSemaphore(cls.max_concurrency)
         
         # The configuration backend is ready, we can assert the presence of our history directory
         self.prepare_history_directory()
@@ -583,58 +621,98 @@ class ComplianceManager(BaseManager):
         self.compliances[full_path] = compliance
     
     
-    def __launch_compliances(self):
-        for (compliance_id, compliance) in self.compliances.items():
+    def __launch_compliance(self, compliance):
+        name = compliance.get_name()
+        
+        should_be_launched = compliance.should_be_launched()
+        if not should_be_launched:
+            return
+        
+        # Reset previous errors
+        compliance.prepare_running()
+        one_step_in_error = False
+        
+        # Now launch rules
+        # TODO: get all of this in the Compliance class
+        for rule in compliance.get_rules():
+            # Let the compliance know which rule is launched
+            compliance.set_current_step(rule)
+            logger.debug('Execute compliance rule: %s' % rule)
+            _type = rule.get_type()
             
-            name = compliance.get_name()
+            if one_step_in_error:
+                rule.set_unknown()
+                continue
             
-            should_be_launched = compliance.should_be_launched()
-            if not should_be_launched:
+            drv = self.drivers.get(_type)
+            if drv is None:
+                logger.error('Cannot execute rule (%s) as the type is unknown: %s' % (name, _type))
                 continue
             
-            # Reset previous errors
-            compliance.prepare_running()
-            one_step_in_error = False
+            semaphore = self.drivers_semaphores.get(drv.concurrency_group or drv.name, None)
+            if semaphore is not None:
+                semaphore.acquire()
+            try:
+                drv.launch(rule)
+            except Exception:
+                err = 'The compliance driver %s did crash with the rule %s: %s' % (drv.name, name, str(traceback.format_exc()))
+                logger.error(err)
+                rule.add_error(err)
+                rule.set_error()
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
             
-            # Now launch rules
-            # TODO: get all of this in the Compliance class
-            for rule in compliance.get_rules():
-                # Let the compliance know which rule is launched
-                compliance.set_current_step(rule)
-                logger.debug('Execute compliance rule: %s' % rule)
-                _type = rule.get_type()
-                
-                if one_step_in_error:
-                    rule.set_unknown()
-                    continue
-                
-                drv = self.drivers.get(_type)
-                if drv is None:
-                    logger.error('Cannot execute rule (%s) as the type is unknown: %s' % (name, _type))
+            if rule.is_in_error():
+                one_step_in_error = True
+        
+        did_change = compliance.compute_state()
+        history_entries = compliance.get_history_entries()
+        for history_entry in history_entries:
+            self.add_history_entry(history_entry)
+        
+        # We should give the compliance launch to handlers module, but only when the
+        # compliance state do change and the change is an interesting one
+        if did_change and compliance.is_last_change_interesting_for_notification():
+            handlermgr.launch_compliance_handlers(compliance, did_change=did_change)
+    
+    
+    def __launch_workers(self):
+        if self.workers_launched:
+            return
+        self.workers_launched = True
+        from .threadmgr import threader
+        for i in range(NB_COMPLIANCE_WORKERS):
+            threader.create_and_launch(self.do_compliance_worker, name='compliance-worker-%d' % i, essential=True, part='compliance')
+    
+    
+    def do_compliance_worker(self):
+        while not stopper.is_stop():
+            try:
+                compliance_id = self.work_queue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                compliance = self.compliances.get(compliance_id, None)
+                if compliance is not None:
+                    self.__launch_compliance(compliance)
+            finally:
+                with self.in_flight_lock:
+                    self.in_flight.discard(compliance_id)
+    
+    
+    # Give the compliances to the workers, but not the ones that are still running
+    def __launch_compliances(self):
+        self.__launch_workers()
+        for compliance_id in list(self.compliances.keys()):
+            with self.in_flight_lock:
+                if compliance_id in self.in_flight:
                     continue
-                
-                try:
-                    drv.launch(rule)
-                except Exception:
-                    err = 'The compliance driver %s did crash with the rule %s: %s' % (drv.name, name, str(traceback.format_exc()))
-                    logger.error(err)
-                    rule.add_error(err)
-                    rule.set_error()
-                
-                if rule.is_in_error():
-                    one_step_in_error = True
-            
-            did_change = compliance.compute_state()
-            history_entries = compliance.get_history_entries()
-            for history_entry in history_entries:
-                self.add_history_entry(history_entry)
-            
-            # We should give the compliance launch to handlers module, but only when the
-            # compliance state do change and the change is an interesting one
-            if did_change and compliance.is_last_change_interesting_for_notification():
-                handlermgr.launch_compliance_handlers(compliance, did_change=did_change)
+                self.in_flight.add(compliance_id)
+            self.work_queue.put(compliance_id)
     
     
+    # Main thread for launching compliances
     def do_compliance_thread(self):
         from .collectormanager import collectormgr
         # if the collector manager did not run, our evaluation can be invalid, so wait for all collectors to run at least once
@@ -643,12 +721,23 @@ class ComplianceManager(BaseManager):
         while not stopper.is_stop():
             if topiker.is_topic_enabled(TOPIC_SYSTEM_COMPLIANCE):
                 self.__launch_compliances()
+                # NOTE: did_run is for the first run, so we wait for all the compliances to finish it
+                if not self.did_run:
+                    self.__wait_for_running_compliances()
             self.did_run = True
             # For each changes, we write a history entry
             self.write_history_entry()
             time.sleep(1)
     
     
+    def __wait_for_running_compliances(self):
+        while not stopper.is_stop():
+            with self.in_flight_lock:
+                if not self.in_flight:
+                    return
+            time.sleep(0.1)
+    
+    
     def get_infos(self):
         counts = {}
         for state in ALL_COMPLIANCE_STATES:
@@ -31,6 +31,8 @@ class ConfigurationManager(object):
         'lock'                                  : {'type': 'path', 'mapto': 'lock_path'},
         'socket'                                : {'type': 'path', 'mapto': 'socket_path'},
         'log_level'                             : {'type': 'string', 'mapto': 'log_level'},
+        'kv_fsync_policy'                       : {'type': 'string', 'mapto': 'kv_fsync_policy'},
+        'agent_metrics_in_ts'                   : {'type': 'bool', 'mapto': 'agent_metrics_in_ts'},
         'bootstrap'                             : {'type': 'bool', 'mapto': 'bootstrap'},
         'seeds'                                 : {'type': 'list', 'mapto': 'seeds'},
         'groups'                                : {'type': 'list', 'mapto': 'groups'},
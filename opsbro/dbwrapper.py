@@ -40,6 +40,33 @@ class SqliteDBBackend(object):
             pass
     
     
+    # Write all puts and deletes in one transaction, with one row statements as multi rows ones
+    # need sqlite >= 3.7.11. We wait for it, so an error is not lost in the sqlitedict thread
+    def WriteBatch(self, puts, deletes=()):
+        tablename = self.db.tablename
+        reqs = []
+        if puts:
+            reqs.append(('REPLACE INTO "%s" (key, value) VALUES (?,?)' % tablename, [(key, self.db.encode(value)) for (key, value) in puts]))
+        deletes = [(key,) for key in deletes]
+        if deletes:
+            reqs.append(('DELETE FROM "%s" WHERE key = ?' % tablename, deletes))
+        if not reqs:
+            return
+        try:
+            self.db.conn.execute_batch(reqs)
+        except Exception as exp:
+            err = 'The SQLite backend did raise an error: %s. On old system like centos 7.0/7.1, sqlite have stability issues, and you should switch to leveldb instead.' % exp
+            self.last_error = err
+            self.did_error = True
+    
+    
+    # Wait for the pending writes, and sync them on the disk (sqlitedict do not sync them)
+    def Sync(self):
+        self.db.commit(blocking=True)
+        with open(self.path, 'rb') as f:
+            os.fsync(f.fileno())
+    
+    
     def __get_size(self):
         return os.path.getsize(self.path)
     
@@ -48,8 +75,27 @@ class SqliteDBBackend(object):
         return {'size': self.__get_size(), 'raw': 'No stats from sqlitedb', 'error': self.last_error}
     
     
-    def RangeIter(self):
-        return self.db.iterkeys()
+    # Give (key, value) or only keys if not include_value, ordered by key, with both key_from
+    # and key_to included
+    def RangeIter(self, key_from=None, key_to=None, include_value=True, fill_cache=True):
+        conditions = []
+        args = []
+        if key_from is not None:
+            conditions.append('key >= ?')
+            args.append(key_from)
+        if key_to is not None:
+            conditions.append('key <= ?')
+            args.append(key_to)
+        where = ''
+        if conditions:
+            where = ' WHERE %s' % ' AND '.join(conditions)
+        columns = 'key, value' if include_value else 'key'
+        req = 'SELECT %s FROM "%s"%s ORDER BY key ASC' % (columns, self.db.tablename, where)
+        for row in self.db.conn.select(req, tuple(args)):
+            if include_value:
+                yield (row[0], self.db.decode(row[1]))
+            else:
+                yield row[0]
 
 
 class FailbackLevelDBBackend(object):
@@ -79,6 +125,20 @@ class FailbackLevelDBBackend(object):
         self.db.delete(key)
     
     
+    def WriteBatch(self, puts, deletes=()):
+        batch = self.db.newBatch()
+        for (key, value) in puts:
+            self.db.putTo(batch, key, value)
+        for key in deletes:
+            self.db.deleteFrom(batch, key)
+        self.db.write(batch)
+    
+    
+    # A synced write also sync all the previous ones
+    def Sync(self):
+        self.db.write(self.db.newBatch(), sync=True)
+    
+    
     def __get_size(self):
         total_size = 0
         for dirpath, dirnames, filenames in os.walk(self.path):
@@ -93,8 +153,13 @@ class FailbackLevelDBBackend(object):
         return {'size': self.__get_size(), 'raw': 'no stats', 'error': ''}
     
     
-    def RangeIter(self):
-        return self.db.RangeIter()
+    # Give (key, value) or only keys if not include_value, ordered by key, with both key_from
+    # and key_to included
+    def RangeIter(self, key_from=None, key_to=None, include_value=True, fill_cache=True):
+        rows = self.db.range(key_from, key_to, end_inclusive=True, fill_cache=fill_cache)
+        if include_value:
+            return ((row.key, row.value) for row in rows)
+        return (row.key for row in rows)
 
 
 class LevelDBBackend(object):
@@ -120,6 +185,20 @@ class LevelDBBackend(object):
         self.db.Delete(key)
     
     
+    def WriteBatch(self, puts, deletes=()):
+        batch = leveldb_lib.WriteBatch()
+        for (key, value) in puts:
+            batch.Put(key, value)
+        for key in deletes:
+            batch.Delete(key)
+        self.db.Write(batch)
+    
+    
+    # A synced write also sync all the previous ones
+    def Sync(self):
+        self.db.Write(leveldb_lib.WriteBatch(), sync=True)
+    
+    
     def __get_size(self):
         total_size = 0
         for dirpath, dirnames, filenames in os.walk(self.path):
@@ -134,8 +213,8 @@ class LevelDBBackend(object):
         return {'size': self.__get_size(), 'raw': self.db.GetStats(), 'error': ''}
     
     
-    def RangeIter(self):
-        return self.db.RangeIter()
+    def RangeIter(self, key_from=None, key_to=None, include_value=True, fill_cache=True):
+        return self.db.RangeIter(key_from=key_from, key_to=key_to, include_value=include_value, fill_cache=fill_cache)
 
 
 class DBWrapper(object):
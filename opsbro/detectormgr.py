@@ -3,7 +3,7 @@ import json
 
 from .log import LoggerFactory
 from .stop import stopper
-from .evaluater import evaluater
+from .evaluater import evaluater, ExprInputsTracker
 from .collectormanager import collectormgr
 from .gossip import gossiper
 from .monitoring import monitoringmgr
@@ -18,6 +18,8 @@ class DetectorMgr(object):
         self.did_run = False  # did we run at least once? so are our groups ok currently?
         self.detected_groups = {}
         self.detectors = {}
+        # detector name -> inputs of its last evaluation, so we do not evaluate it if nothing did change
+        self.inputs_trackers = {}
     
     
     # Detectors will run rules based on collectors and such things, and will group the local node
@@ -51,6 +53,20 @@ class DetectorMgr(object):
         
         # Add it into the detectors list
         self.detectors[detector['id']] = detector
+        self.inputs_trackers[detector['id']] = ExprInputsTracker()
+    
+    
+    # What the detector rule and its groups are reading, None if we cannot know
+    @staticmethod
+    def __get_detector_inputs(detector):
+        try:
+            inputs = evaluater.get_expr_inputs(detector['apply_if'])
+            if inputs is None:
+                return None
+            groups_inputs = tuple([evaluater.get_expr_inputs(t, only_placeholders=True) for t in detector['add_groups']])
+        except Exception:  # a bad expression, the evaluation will show the error
+            return None
+        return (inputs, groups_inputs)
     
     
     def _launch_detectors(self):
@@ -59,13 +75,20 @@ class DetectorMgr(object):
             interval = int(gen['interval'].split('s')[0])  # todo manage like it should
             should_be_launch = gen['last_launch'] < int(time.time()) - interval
             if should_be_launch:
-                logger.debug('Launching detector: %s rule: %s' % (gname, gen['apply_if']))
                 gen['last_launch'] = int(time.time())
+                # Most detectors are only reading static data, so only evaluate them if what they read did change
+                tracker = self.inputs_trackers[gname]
+                inputs = self.__get_detector_inputs(gen)
+                if not tracker.did_change(inputs):
+                    logger.debug('Skipping detector %s as its inputs did not change' % gname)
+                    continue
+                logger.debug('Launching detector: %s rule: %s' % (gname, gen['apply_if']))
                 try:
                     do_apply = evaluater.eval_expr(gen['apply_if'])
                 except Exception as exp:
                     logger.error('Cannot execute detector %s: %s' % (gname, exp))
                     do_apply = False
+                    inputs = None  # try it again next time
                 gen['do_apply'] = do_apply
                 if do_apply:
                     groups = gen['add_groups']
@@ -84,10 +107,12 @@ class DetectorMgr(object):
                     except Exception as exp:
                         logger.error('Cannot execute detector group %s: %s' % (gname, exp))
                         groups = []
+                        inputs = None
                     logger.debug('groups %s are applying for the detector %s' % (groups, gname))
                     self.detected_groups[gname] = groups
                 else:
                     self.detected_groups[gname] = []
+                tracker.set_evaluated(inputs)
         # take all from the current state of all detectors, and update gossiper about it
         for groups in self.detected_groups.values():
             for group in groups:
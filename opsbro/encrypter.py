@@ -7,6 +7,7 @@ import struct
 
 from .log import LoggerFactory
 from .util import bytes_to_unicode, unicode_to_bytes, get_uuid
+from .wirecodec import BINARY_MAGIC
 
 # Global logger for this part
 logger = LoggerFactory.create_logger('gossip')
@@ -210,6 +211,9 @@ class Encrypter(object):
                 raw_data += ' ' * (-len(encrypted_data) % 16)
             cypher = AES.new(encryption_key, AES.MODE_ECB)
             decrypted_data = cypher.decrypt(encrypted_data).strip()
+            # binary wire codec messages must stay as bytes
+            if decrypted_data[:1] == BINARY_MAGIC:
+                return decrypted_data
             return bytes_to_unicode(decrypted_data)
         except Exception as exp:
             logger.error('Decryption fail: %s' % exp)
@@ -225,7 +229,7 @@ class Encrypter(object):
         
         # Be sure the data is x16 lenght
         if len(data) % 16 != 0:
-            data += ' ' * (-len(data) % 16)
+            data += (b' ' if isinstance(data, bytes) else u' ') * (-len(data) % 16)
         # print('TO encrypt data size: %s' % len(data))
         
         try:
@@ -7,6 +7,7 @@ import base64
 import inspect
 import types
 import sys
+import time
 
 try:  # Python2
     from itertools import izip as zip
@@ -17,7 +18,7 @@ PY3 = sys.version_info >= (3,)
 
 from .collectormanager import collectormgr
 from .log import LoggerFactory
-from .util import string_decode
+from .util import string_decode, LRUCache
 
 # Global logger for this part
 logger = LoggerFactory.create_logger('evaluater')
@@ -91,11 +92,94 @@ for f in (abs, min, max, sum, sorted, len, set):
 
 names = {'True': True, 'False': False, 'None': None}
 
+# some operators are in the right,left order!!
+reversed_operators = (op.contains,)
+
+# Objects that came from a {{ }} are the real collector/parameters/variables objects, not a copy, so
+# we must not allow to call methods that will modify them
+mutating_methods = set(['append', 'extend', 'insert', 'pop', 'popitem', 'remove', 'clear', 'update', 'setdefault',
+                        'sort', 'reverse', 'add', 'discard', 'difference_update', 'intersection_update',
+                        'symmetric_difference_update'])
+
+if PY3:
+    _callable_base_types = (dict, list, set, str)
+else:
+    _callable_base_types = (dict, list, set, basestring)
+
+# How many expression plans we keep compiled
+EXPR_PLANS_CACHE_SIZE = 4096
+
+# Functions groups with results that only depend on their arguments, or that do not change while running
+STATIC_FUNCTION_GROUPS = set(['basic', 'string', 'set', 'display', 'hosting'])
+# Functions that only look at the node groups
+GROUPS_FUNCTIONS = set(['is_in_group', 'is_in_static_group'])
+
+# Even if the inputs of an expression did not change, we evaluate it again after this time (in seconds)
+FULL_EVALUATION_INTERVAL = 300
+
+# In the compiled expression, the {{ }} parts are switched to such names
+_PLACEHOLDER_PREFIX = '__opsbro_placeholder_'
+_PLACEHOLDER_NAME = _PLACEHOLDER_PREFIX + '%d__'
+
+
+# An expression that was parsed only once: the {{ }} parts are switched into names that
+# will be resolved at each evaluation instead of being pasted as text in the expression.
+# If the expression cannot be managed this way (like a {{ }} inside a string), the tree is None
+# and we will fall back to the full text compilation at each evaluation
+# We also look at what the expression is reading, so we can know if its inputs did change:
+# * volatile: it calls functions that look at the system (files, packages, network...) or we
+#             cannot know (text compilation), so it must always be evaluated
+# * use_groups: it calls a function that look at the node groups
+class ExprPlan(object):
+    __slots__ = ('expr', 'tree', 'placeholders', 'volatile', 'use_groups')
+    
+    
+    def __init__(self, expr, tree, placeholders):
+        self.expr = expr
+        self.tree = tree
+        self.placeholders = placeholders  # list of (name, type, path, default)
+        self.volatile = tree is None
+        self.use_groups = False
+        if tree is None:
+            return
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call) or not isinstance(node.func, ast.Name):
+                continue  # methods of values are only reading them
+            fname = node.func.id
+            if fname in GROUPS_FUNCTIONS:
+                self.use_groups = True
+            elif functions_to_groups.get(fname, None) not in STATIC_FUNCTION_GROUPS:
+                self.volatile = True
+
+
+# Remember the inputs of the last evaluation of an expression, so we only evaluate it again
+# if its inputs did change (or if it's volatile, or if the last evaluation is too old)
+class ExprInputsTracker(object):
+    __slots__ = ('last_inputs', 'last_evaluation')
+    
+    
+    def __init__(self):
+        self.last_inputs = None
+        self.last_evaluation = 0
+    
+    
+    def did_change(self, inputs):
+        if inputs is None or inputs != self.last_inputs:
+            return True
+        return time.time() > self.last_evaluation + FULL_EVALUATION_INTERVAL
+    
+    
+    # inputs is None if the evaluation did fail, so we will try again
+    def set_evaluated(self, inputs):
+        self.last_inputs = inputs
+        self.last_evaluation = time.time()
+
 
 class Evaluater(object):
     def __init__(self):
         self.cfg_data = {}
         self.pat = re.compile('{{.*?}}')
+        self.plans = LRUCache(max_size=EXPR_PLANS_CACHE_SIZE)
     
     
     def load(self, cfg_data):
@@ -161,7 +245,125 @@ class Evaluater(object):
         return expr
     
     
+    # Split a {{ }} part into (type, path, default) without looking at the values
+    @staticmethod
+    def __parse_placeholder(p):
+        p = p[2:-2]  # remove {{ and }}
+        default_s = ''
+        # If there is a EXPR||DEFAULT we split in the part we need to grok, and the default
+        if '||' in p:
+            p, default_s = p.split('||', 1)
+        for _type in ('collector', 'parameters', 'variables'):
+            prefix = _type + '.'
+            if p.startswith(prefix):
+                return (_type, p[len(prefix):], default_s)
+        raise Exception('The {{ }} expression: %s is not a known type' % p)
+    
+    
+    def __build_plan(self, expr):
+        placeholders = []
+        by_text = {}
+        
+        
+        def _replace(m):
+            p = m.group(0)
+            name = by_text.get(p, None)
+            if name is None:
+                _type, path, default_s = self.__parse_placeholder(p)
+                name = _PLACEHOLDER_NAME % len(placeholders)
+                by_text[p] = name
+                placeholders.append((name, _type, path, default_s))
+            return name
+        
+        
+        source = self.pat.sub(_replace, expr)
+        try:
+            tree = ast.parse(source, mode='eval').body
+        except SyntaxError:  # maybe the textual version will be fine
+            return ExprPlan(expr, None, placeholders)
+        # All the {{ }} must be real names in the tree, if one is inside a string we cannot
+        # resolve it late, and so we fall back to the text version
+        if placeholders:
+            placeholders_names = set([name for (name, _, _, _) in placeholders])
+            founded_names = set()
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Name) and node.id in placeholders_names:
+                    founded_names.add(node.id)
+                elif isinstance(node, ast.Str) and _PLACEHOLDER_PREFIX in node.s:
+                    return ExprPlan(expr, None, placeholders)
+            if founded_names != placeholders_names:
+                return ExprPlan(expr, None, placeholders)
+        return ExprPlan(expr, tree, placeholders)
+    
+    
+    def get_plan(self, expr):
+        plan = self.plans.get(expr)
+        if plan is None:
+            plan = self.__build_plan(expr)
+            self.plans.set(expr, plan)
+        return plan
+    
+    
+    # Look at the values for all the {{ }} of a plan
+    def __resolve_placeholders(self, plan, check, variables):
+        ctx = {}
+        for (name, _type, path, default_s) in plan.placeholders:
+            if _type == 'collector':
+                try:
+                    v = collectormgr.get_data(path)
+                except KeyError:  # ok cannot find it, try to switch to default if there is one
+                    if default_s == '':
+                        v = ''
+                    else:
+                        v = self.compile(default_s, check=check)
+            elif _type == 'parameters':
+                v = self._found_params(path, check)
+            else:  # variables
+                v = variables[path]
+            ctx[name] = v
+        return ctx
+    
+    
+    # Get the values of all that an expression is reading ({{ }} parts, and node groups if
+    # need), or None if we cannot know them (volatile expression).
+    # With only_placeholders the expression is only a template for compile(), so only the {{ }}
+    # parts are interesting
+    def get_expr_inputs(self, expr, check=None, only_placeholders=False):
+        plan = self.get_plan(expr)
+        if plan.volatile and not only_placeholders:
+            return None
+        inputs = []
+        for (_, _type, path, _) in plan.placeholders:
+            if _type == 'collector':
+                try:
+                    inputs.append(collectormgr.get_data(path))
+                except KeyError:
+                    inputs.append(KeyError)  # the missing value marker, cannot be a real value
+            elif _type == 'parameters':
+                inputs.append(self._found_params(path, check) if check else '')
+            else:  # variables are computed at each check run, we cannot know them
+                return None
+        if plan.use_groups and not only_placeholders:
+            from .gossip import gossiper
+            inputs.append(tuple(sorted(gossiper.groups)))
+        return tuple(inputs)
+    
+    
     def eval_expr(self, expr, check=None, variables={}):
+        plan = self.get_plan(expr)
+        # Cannot be managed as a compiled plan, go with the full text compilation
+        if plan.tree is None:
+            return self.__eval_text_expr(expr, check=check, variables=variables)
+        ctx = self.__resolve_placeholders(plan, check, variables)
+        try:
+            r = self.eval_(plan.tree, ctx)
+        except Exception as exp:
+            logger.debug('EVAL: fail to eval expr: %s (with %s) : %s' % (expr, ctx, exp))
+            raise
+        return r
+    
+    
+    def __eval_text_expr(self, expr, check=None, variables={}):
         logger.debug('EVAL: expression: %s' % expr)
         expr = self.compile(expr, check=check, variables=variables)
         logger.debug('EVAL: exp changed: %s' % expr)
@@ -179,51 +381,52 @@ class Evaluater(object):
         return r
     
     
-    def eval_(self, node):
-        logger.debug('eval_ node: %s => type=%s' % (node, type(node)))
+    # ctx: values of the {{ }} placeholders of a compiled plan
+    def eval_(self, node, ctx=None):
         if isinstance(node, ast.Num):  # <number>
             return node.n
         elif isinstance(node, ast.Str):  # <string>
             return node.s
         elif isinstance(node, ast.List):  # <list>
-            return [self.eval_(e) for e in node.elts]
+            return [self.eval_(e, ctx) for e in node.elts]
         elif isinstance(node, ast.Tuple):  # <tuple>
-            return tuple([self.eval_(e) for e in node.elts])
+            return tuple([self.eval_(e, ctx) for e in node.elts])
         elif isinstance(node, ast.Dict):  # <dict>
-            _keys = [self.eval_(e) for e in node.keys]
-            _values = [self.eval_(e) for e in node.values]
+            _keys = [self.eval_(e, ctx) for e in node.keys]
+            _values = [self.eval_(e, ctx) for e in node.values]
             _dict = dict(zip(_keys, _values))  # zip it into a new dict
             return _dict
         elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
-            return operators[type(node.op)](self.eval_(node.left), self.eval_(node.right))
+            return operators[type(node.op)](self.eval_(node.left, ctx), self.eval_(node.right, ctx))
         elif isinstance(node, _ast.BoolOp):  # <elt1> OP <elt2>   TOD: manage more than 2 params
             if len(node.values) != 2:
                 raise Exception('Cannot manage and/or operators woth more than 2 parts currently.')
             # Special case: _ast.And   if the first element is False, then we should NOT eval the right part
             # and directly returns False
-            left_part_eval = self.eval_(node.values[0])
+            left_part_eval = self.eval_(node.values[0], ctx)
             if not left_part_eval and isinstance(node.op, _ast.And):
                 return False
             # Special case: _ast.Or   if the first element is True, then we should NOT eval the right part
             # and directly returns True
-            left_part_eval = self.eval_(node.values[0])
             if left_part_eval and isinstance(node.op, _ast.Or):
                 return True
             # else, give the whole result
-            return operators[type(node.op)](left_part_eval, self.eval_(node.values[1]))
+            return operators[type(node.op)](left_part_eval, self.eval_(node.values[1], ctx))
         elif isinstance(node, ast.Compare):  # <left> <operator> <right>
-            left = self.eval_(node.left)
-            right = self.eval_(node.comparators[0])
+            left = self.eval_(node.left, ctx)
+            right = self.eval_(node.comparators[0], ctx)
             _op = operators[type(node.ops[0])]
-            reversed_operator = [op.contains]  # some operators are in the right,left order!!
-            if _op not in reversed_operator:
+            if _op not in reversed_operators:
                 return _op(left, right)
             else:  # reverse order
                 return _op(right, left)
         elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
-            return operators[type(node.op)](self.eval_(node.operand))
+            return operators[type(node.op)](self.eval_(node.operand, ctx))
         elif isinstance(node, ast.Name):  # name? try to look at it
             key = node.id
+            # a {{ }} part of a compiled plan
+            if ctx is not None and key in ctx:
+                return ctx[key]
             v = names.get(key, None)
             return v
         # None, True, False are nameconstants in python3, but names in 2
@@ -234,7 +437,7 @@ class Evaluater(object):
         elif isinstance(node, ast.Subscript):  # {}['key'] access
             # NOTE: the 'key' is node.slice.value.s
             # and the node.value is a ast.Dict, so must be eval_
-            _d = self.eval_(node.value)
+            _d = self.eval_(node.value, ctx)
             v = _d[node.slice.value.s]
             return v
         #        elif isinstance(node, _ast.Attribute):  # o.f() call
@@ -245,7 +448,7 @@ class Evaluater(object):
         #            v = _d[node.slice.value.s]
         #            return v
         elif isinstance(node, ast.Call):  # call? dangerous, must be registered :)
-            args = [self.eval_(arg) for arg in node.args]
+            args = [self.eval_(arg, ctx) for arg in node.args]
             f = None
             # print 'attr?', isinstance(node.func, ast.Attribute)
             # print 'name?', isinstance(node.func, ast.Name)
@@ -259,7 +462,19 @@ class Evaluater(object):
                 # Attribute is managed only if the base type is a standard one
                 _ref_object_node = node.func.value
                 if isinstance(_ref_object_node, ast.Dict) or isinstance(_ref_object_node, ast.List) or isinstance(_ref_object_node, ast.Str) or isinstance(_ref_object_node, ast.Set) or isinstance(_ref_object_node, ast.Subscript):
-                    _ref_object = self.eval_(_ref_object_node)
+                    # if coming from a {{ }} value, it's the real object, do not allow to modify it
+                    if ctx and isinstance(_ref_object_node, ast.Subscript) and node.func.attr in mutating_methods:
+                        logger.error('Eval UNMANAGED (ast.attribute) CALL: %s is refused' % node.func.attr)
+                        raise TypeError(node)
+                    _ref_object = self.eval_(_ref_object_node, ctx)
+                    f = getattr(_ref_object, node.func.attr)
+                # a {{ }} value of a compiled plan: it's the real object, so only accept basic types and
+                # do not allow to modify it
+                elif isinstance(_ref_object_node, ast.Name) and ctx is not None and _ref_object_node.id in ctx:
+                    _ref_object = ctx[_ref_object_node.id]
+                    if not isinstance(_ref_object, _callable_base_types) or node.func.attr in mutating_methods:
+                        logger.error('Eval UNMANAGED (ast.attribute) CALL: %s on %s is refused' % (node.func.attr, type(_ref_object)))
+                        raise TypeError(node)
                     f = getattr(_ref_object, node.func.attr)
                 else:
                     logger.error('Eval UNMANAGED (ast.attribute) CALL: %s %s %s is refused' % (node.func, node.func.__dict__, node.func.value.__dict__))
@@ -4,6 +4,7 @@ import traceback
 import codecs
 import stat
 import shutil
+import hashlib
 from collections import deque
 
 from .log import LoggerFactory
@@ -55,8 +56,14 @@ class Generator(object):
         
         self.buf = None
         self.template = None
+        self.template_mtime = None
         self.output = None
         self.jinja2 = None
+        self.jinja2_env = None
+        # (template mtime, gossip nodes version) of the current output, so we render only if one did change
+        self.render_inputs = None
+        # ((mtime, size) of the target file, hash of the output) when we know the file is up to date
+        self.target_in_sync = None
         self.generate_if = g['generate_if']
         self.cur_value = ''
         self.current_diff = []
@@ -121,7 +128,30 @@ class Generator(object):
         return b
     
     
+    def __get_jinja2_env(self):
+        if self.jinja2_env is not None:
+            return self.jinja2_env
+        try:
+            env = self.jinja2.Environment(trim_blocks=True, lstrip_blocks=True, keep_trailing_newline=True)
+        except TypeError:  # old jinja2 version do not manage keep_trailing_newline nor
+            # lstrip_blocks (like in redhat6)
+            env = self.jinja2.Environment(trim_blocks=True)
+        self.jinja2_env = env
+        return env
+    
+    
+    # Reset all we did compute, so the next loop will do all again
+    def __reset_output(self):
+        self.output = None
+        self.template = None
+        self.buf = None
+        self.render_inputs = None
+        self.target_in_sync = None
+    
+    
     # Open the template file and generate the output
+    # NOTE: the template is compiled only if the file did change, and the rendering is only done
+    # if the template or the nodes did change
     def generate(self):
         if self.jinja2 is None:
             self.jinja2 = libstore.get_jinja2()
@@ -131,49 +161,51 @@ class Generator(object):
             self.set_error('Generator: Error, no jinja2 librairy defined, please install it')
             return
         try:
-            f = codecs.open(self.g['template'], 'r', 'utf8')
-            self.buf = f.read()
-            f.close()
-        except IOError as exp:
+            template_mtime = os.stat(self.g['template']).st_mtime
+        except OSError as exp:
             self.set_error('Cannot open template file %s : %s' % (self.g['template'], exp))
-            self.buf = None
-            self.template = None
+            self.__reset_output()
             return
         
-        # NOTE: nodes is a static object, node too (or atomic change)
-        node = gossiper.nodes[gossiper.uuid]
+        render_inputs = (template_mtime, gossiper.get_nodes_version())
+        if self.output is not None and render_inputs == self.render_inputs:
+            logger.debug('Generator %s: the template and the nodes did not change, no need to render it' % self.name)
+            return
         
-        # Now try to make it a jinja template object
-        try:
-            env = self.jinja2.Environment(trim_blocks=True, lstrip_blocks=True, keep_trailing_newline=True)
-        except TypeError:  # old jinja2 version do not manage keep_trailing_newline nor
-            # lstrip_blocks (like in redhat6)
-            env = self.jinja2.Environment(trim_blocks=True)
+        if not self.template or template_mtime != self.template_mtime:
+            try:
+                f = codecs.open(self.g['template'], 'r', 'utf8')
+                self.buf = f.read()
+                f.close()
+            except IOError as exp:
+                self.set_error('Cannot open template file %s : %s' % (self.g['template'], exp))
+                self.__reset_output()
+                return
+            
+            # Now try to make it a jinja template object
+            try:
+                self.template = self.__get_jinja2_env().from_string(self.buf)
+                self.template_mtime = template_mtime
+            except Exception as exp:
+                self.set_error('Template file %s did raise an error with jinja2 : %s' % (self.g['template'], exp))
+                self.__reset_output()
+                return
         
-        try:
-            self.template = env.from_string(self.buf)
-        except Exception as exp:
-            self.set_error('Template file %s did raise an error with jinja2 : %s' % (self.g['template'], exp))
-            self.output = None
-            self.template = None
-            self.buf = None
-            return
+        # NOTE: nodes is a static object, node too (or atomic change)
+        node = gossiper.nodes[gossiper.uuid]
         
         # Now try to render all of this with real objects
         try:
             self.output = self.template.render(nodes=gossiper.nodes, node=node, ok_nodes=ok_nodes)
         except NoElementsExceptions:
             self.set_error('No nodes did match filters for template : %s %s' % (self.g['template'], self.name))
-            self.output = None
-            self.template = None
-            self.buf = None
+            self.__reset_output()
             return
         except Exception:
             self.set_error('Template rendering %s did raise an error with jinja2 : %s' % (self.g['template'], traceback.format_exc()))
-            self.output = None
-            self.template = None
-            self.buf = None
+            self.__reset_output()
             return
+        self.render_inputs = render_inputs
         
         # if we have a partial generator prepare the output we must check for
         if self.output is not None and self.g['partial_start'] and self.g['partial_end']:
@@ -188,6 +220,12 @@ class Generator(object):
         if self.output is None:
             return False
         
+        # If the file did not change since we did look at it, and the output is the same, we are still good
+        output_hash = hashlib.sha1(self.output.encode('utf8')).hexdigest()
+        target_signature = self.__get_target_signature()
+        if target_signature is not None and self.target_in_sync == (target_signature, output_hash):
+            return False
+        
         self.cur_value = ''
         
         # first try to load the current file if exist and compare to the generated file
@@ -198,9 +236,7 @@ class Generator(object):
                 f.close()
             except IOError as exp:
                 self.set_error('Cannot open path file %s : %s' % (self.g['path'], exp))
-                self.output = None
-                self.template = ''
-                self.buf = ''
+                self.__reset_output()
                 self.current_diff = []
                 return False
         
@@ -217,6 +253,10 @@ class Generator(object):
             if self.output != self.cur_value:
                 need_regenerate_full = True
         
+        if not need_regenerate_full and not need_regenerate_partial:
+            self.target_in_sync = (target_signature, output_hash)
+            return False
+        
         # If not exists or the value did change, regenerate it :)
         if need_regenerate_full:
             logger.debug('Generator %s generate a new value, writing it to %s' % (self.g['name'], self.g['path']))
@@ -227,13 +267,12 @@ class Generator(object):
                 f.write(self.output)
                 f.close()
                 logger.info('Regenerate result: %s' % self.output)
+                self.target_in_sync = (self.__get_target_signature(), output_hash)
                 self.set_compliant('Generator %s did generate a new file at %s' % (self.g['name'], self.g['path']))
                 return True
             except IOError as exp:
                 self.set_error('Cannot write path file %s : %s' % (self.g['path'], exp))
-                self.output = None
-                self.template = ''
-                self.buf = ''
+                self.__reset_output()
                 self.current_diff = []
                 return False
         
@@ -275,9 +314,7 @@ class Generator(object):
                     # Maybe there is a bad order in the index?
                     if idx_start > idx_end:
                         self.set_error('The partial_start "%s" and partial_end "%s" in the file "%s" for the generator %s are not in the good order' % (self.g['partial_start'], self.g['partial_end'], self.g['path'], self.g['name']))
-                        self.output = None
-                        self.template = ''
-                        self.buf = ''
+                        self.__reset_output()
                         self.current_diff = []
                         return False
                     part_before = lines[:idx_start]
@@ -307,17 +344,25 @@ class Generator(object):
                 logger.debug('PREV UID GID PERMISSIONS: %s %s %s' % (prev_uid, prev_gid, prev_permissions))
                 os.chmod(tmp_path, prev_permissions)
                 shutil.move(tmp_path, self.g['path'])
+                self.target_in_sync = (self.__get_target_signature(), output_hash)
                 self.set_compliant('Generator %s did generate a new file at %s' % (self.g['name'], self.g['path']))
                 return True
             except IOError as exp:
                 self.set_error('Cannot write path file %s : %s' % (self.g['path'], exp))
-                self.output = None
-                self.template = ''
-                self.buf = ''
+                self.__reset_output()
                 self.current_diff = []
                 return False
     
     
+    # The target file modification time and size, None if it do not exists
+    def __get_target_signature(self):
+        try:
+            st = os.stat(self.g['path'])
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+    
+    
     # If need launch the restart command, shoul not block too long of
     # course
     def launch_command(self):
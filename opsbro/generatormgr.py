@@ -72,13 +72,13 @@ class GeneratorMgr(BaseManager):
         while not stopper.is_stop():
             logger.debug('Looking for %d generators' % len(self.generators))
             for (gname, g) in self.generators.items():
-                logger.debug('LOOK AT GENERATOR', g, 'to be apply if', g.generate_if)
+                logger.debug('LOOK AT GENERATOR', gname, 'to be apply if', g.generate_if)
                 # Maybe this generator is not for us...
                 if not g.must_be_launched():
                     continue
-                logger.debug('Generator %s will generate' % str(g.__dict__))
+                logger.debug('Generator %s will generate' % gname)
                 g.generate()
-                logger.debug('Generator %s is generated' % str(g.__dict__))
+                logger.debug('Generator %s is generated' % gname)
                 should_launch = g.write_if_need()
                 if should_launch:
                     g.launch_command()
@@ -4,10 +4,14 @@ import random
 import math
 import copy
 import bisect
+import zlib
 import threading
-from collections import deque
 import traceback
-from contextlib import closing as closing_context
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
 # some singleton :)
 from .log import LoggerFactory
@@ -16,24 +20,48 @@ from .broadcast import broadcaster
 from .websocketmanager import websocketmgr
 from .pubsub import pubsub
 from .library import libstore
-from .httpclient import get_http_exceptions, httper
+from .httpclient import get_http_exceptions, httper, HTTPError
 from .stop import stopper
 from .handlermgr import handlermgr
 from .topic import topiker, TOPIC_SERVICE_DISCOVERY
 from .basemanager import BaseManager
 from .jsonmgr import jsoner
-from .util import get_uuid
+from .util import get_uuid, unicode_to_bytes
 from .udprouter import udprouter
+from .udptransport import udptransport
+from .wirecodec import BINARY_CODEC_VERSION, encode_for_node, is_node_binary_capable
 from .zonemanager import zonemgr
 
 KGOSSIP = 10
 
+# Push-pull messages bigger than this are zlib compressed
+PUSH_PULL_COMPRESS_SIZE = 1024
+
 # LIMIT= 4 * math.ceil(math.log10(float(2 + 1)))
 
 # Global logger for this part
 logger = LoggerFactory.create_logger('gossip')
 
 
+# Push-pull messages are json, and compressed if big. As a zlib stream never starts
+# with a '{', we can detect it when reading
+def encode_push_pull_msg(m):
+    data = unicode_to_bytes(jsoner.dumps(m))
+    if len(data) > PUSH_PULL_COMPRESS_SIZE:
+        data = zlib.compress(data)
+    return data
+
+
+def decode_push_pull_msg(data):
+    data = unicode_to_bytes(data)
+    if data[:1] != b'{':
+        try:
+            data = zlib.decompress(data)
+        except zlib.error as exp:
+            raise ValueError('Bad compressed push-pull message: %s' % exp)
+    return jsoner.loads(data)
+
+
 class NODE_STATES(object):
     ALIVE = 'alive'
     DEAD = 'dead'
@@ -65,6 +93,8 @@ class Gossip(BaseManager):
     def __init__(self):
         super(Gossip, self).__init__()
         self.logger = logger
+        # increased for each nodes change, see get_nodes_version
+        self.nodes_version = 0
         # Set myself as master of the gossip:: udp messages
         udprouter.declare_handler('gossip', self)
     
@@ -73,6 +103,11 @@ class Gossip(BaseManager):
         self.nodes_lock = nodes_lock
         self._nodes_writing = nodes
         self.__refresh_read_only_nodes()  # Create the self.nodes
+        # group -> sorted list of the not dead/leave nodes uuids, used by find_group_node
+        self._group_rings = {}
+        # node uuid -> groups it is currently in the rings
+        self._node_rings_groups = {}
+        self.__rebuild_group_rings()
         self.addr = addr
         self.port = port
         self.name = name
@@ -89,6 +124,10 @@ class Gossip(BaseManager):
         # list of uuid to ping back because we though they were dead
         self.to_ping_back = []
         
+        # node uuid -> queues of the pings waiting for an ack about this node
+        self.ping_waiters_lock = threading.RLock()
+        self.ping_waiters = {}
+        
         # Our main events dict, should not be too old or we will delete them
         self.events_lock = threading.RLock()
         self.events = {}
@@ -209,6 +248,7 @@ class Gossip(BaseManager):
         with self.nodes_lock:
             self._nodes_writing[uuid] = new_node
             self.__refresh_read_only_nodes()
+            self.__update_node_in_group_rings(uuid)
     
     
     def __delitem__(self, node_uuid):
@@ -217,6 +257,7 @@ class Gossip(BaseManager):
                 return
             del self._nodes_writing[node_uuid]
             self.__refresh_read_only_nodes()
+            self.__update_node_in_group_rings(node_uuid)
     
     
     # We did change nodes so we are updating the read only copy with the new nodes DICT
@@ -225,6 +266,53 @@ class Gossip(BaseManager):
         with self.nodes_lock:
             nodes_copy = copy.copy(self._nodes_writing)
             self.nodes = nodes_copy
+            self.nodes_version += 1
+    
+    
+    # Increased each time a node is added, removed or did change, so others parts can know
+    # they do not need to look at the nodes again
+    def get_nodes_version(self):
+        return self.nodes_version
+    
+    
+    def __rebuild_group_rings(self):
+        with self.nodes_lock:
+            self._group_rings = {}
+            self._node_rings_groups = {}
+            for nuuid in self._nodes_writing:
+                self.__update_node_in_group_rings(nuuid)
+    
+    
+    # A node did change (new, deleted, state or groups), so we update the group rings for it.
+    # Only nearly alive nodes are in the rings. The rings lists are never modified in place but
+    # replaced, so readers can use them without the lock
+    def __update_node_in_group_rings(self, nuuid):
+        with self.nodes_lock:
+            node = self._nodes_writing.get(nuuid, None)
+            if node is None or node['state'] in (NODE_STATES.DEAD, NODE_STATES.LEAVE):
+                new_groups = frozenset()
+            else:
+                new_groups = frozenset(node.get('groups', []))
+            old_groups = self._node_rings_groups.get(nuuid, frozenset())
+            if new_groups == old_groups:
+                return
+            for group in old_groups - new_groups:
+                ring = self._group_rings.get(group, [])
+                idx = bisect.bisect_left(ring, nuuid)
+                if idx < len(ring) and ring[idx] == nuuid:
+                    ring = ring[:idx] + ring[idx + 1:]
+                if ring:
+                    self._group_rings[group] = ring
+                else:
+                    self._group_rings.pop(group, None)
+            for group in new_groups - old_groups:
+                ring = list(self._group_rings.get(group, []))
+                bisect.insort(ring, nuuid)
+                self._group_rings[group] = ring
+            if new_groups:
+                self._node_rings_groups[nuuid] = new_groups
+            else:
+                self._node_rings_groups.pop(nuuid, None)
     
     
     def __register_myself(self):
@@ -251,7 +339,7 @@ class Gossip(BaseManager):
                          'name': node['name'], 'display_name': node.get('display_name', ''),
                          'uuid': node['uuid'], 'old_state': old_state, 'state': new_state,
                          }
-        logger.debug('__add_node_state_change_history_entry:: %s' % history_entry)
+        logger.debug('__add_node_state_change_history_entry::', history_entry)
         self.add_history_entry(history_entry)
     
     
@@ -260,7 +348,7 @@ class Gossip(BaseManager):
                          'name': node['name'], 'display_name': node.get('display_name', ''),
                          'uuid': node['uuid'], 'old_zone': old_zone, 'zone': new_zone,
                          }
-        logger.debug('__add_node_zone_change_history_entry:: %s' % history_entry)
+        logger.debug('__add_node_zone_change_history_entry::', history_entry)
         self.add_history_entry(history_entry)
     
     
@@ -324,14 +412,7 @@ class Gossip(BaseManager):
     
     # find all nearly alive nodes with a specific group
     def find_group_nodes(self, group):
-        nodes = []
-        for (uuid, node) in self.nodes.items():
-            if node['state'] in [NODE_STATES.DEAD, NODE_STATES.LEAVE]:
-                continue
-            groups = node.get('groups', [])
-            if group in groups:
-                nodes.append(uuid)
-        return nodes
+        return list(self._group_rings.get(group, []))
     
     
     # find all nearly alive nodes with a specific name or display_name
@@ -347,14 +428,13 @@ class Gossip(BaseManager):
     
     # find the good ring node for a group and for a key
     def find_group_node(self, group, hkey):
-        group_nodes = self.find_group_nodes(group)
+        # already sorted, and never modified in place
+        group_nodes = self._group_rings.get(group, None)
         
         # No kv nodes? oups, set myself so
-        if len(group_nodes) == 0:
+        if not group_nodes:
             return self.uuid
         
-        group_nodes.sort()
-        
         idx = bisect.bisect_right(group_nodes, hkey) - 1
         nuuid = group_nodes[idx]
         return nuuid
@@ -379,7 +459,7 @@ class Gossip(BaseManager):
         # if no change, we finish, job done
         if self.detected_groups == detected_groups:
             return
-        logger.debug('We have an update for the detected groups. GROUPS=%s  old-detected_groups=%s new-detected_groups=%s' % (self.groups, self.detected_groups, detected_groups))
+        logger.debug('We have an update for the detected groups. GROUPS=', self.groups, ' old-detected_groups=', self.detected_groups, 'new-detected_groups=', detected_groups)
         # ok here we will change things
         did_change = False
         new_groups = detected_groups - self.detected_groups
@@ -431,6 +511,10 @@ class Gossip(BaseManager):
                 raise Exception('Oups, both objects are differents')
             if id(myself_read_only) != id(myself_write_allowed):
                 raise Exception('Oups, both objects ids are differents')
+            
+            if prop in ('groups', 'state'):
+                self.__update_node_in_group_rings(self.uuid)
+            self.nodes_version += 1
     
     
     # A check did change it's state (we did check this), update it in our structure
@@ -440,6 +524,7 @@ class Gossip(BaseManager):
             myself = self._get_myself_write_allowed()
             check_entry = myself['checks'].get(cname, None)
             # We can just atomic write it
+            self.nodes_version += 1
             if check_entry is not None:
                 check_entry['state_id'] = state_id
                 return
@@ -501,7 +586,7 @@ class Gossip(BaseManager):
     def __get_boostrap_node(self):
         node = {'addr'       : self.addr, 'port': self.port, 'name': self.name, 'display_name': self.display_name,
                 'incarnation': self.incarnation, 'uuid': self.uuid, 'state': NODE_STATES.ALIVE, 'groups': self.groups,
-                'services'   : {}, 'checks': {}, 'zone': self.zone, 'is_proxy': self.is_proxy}
+                'services'   : {}, 'checks': {}, 'zone': self.zone, 'is_proxy': self.is_proxy, 'codec': BINARY_CODEC_VERSION}
         return node
     
     
@@ -512,6 +597,7 @@ class Gossip(BaseManager):
         with self.nodes_lock:
             del self._nodes_writing[nid]
             self.__refresh_read_only_nodes()
+            self.__update_node_in_group_rings(nid)
         
         # Le the modules know about it
         pubsub.pub('delete-node', node_uuid=nid)
@@ -525,6 +611,7 @@ class Gossip(BaseManager):
                     continue
                 did_delete = True
                 del self._nodes_writing[node_uuid]
+                self.__update_node_in_group_rings(node_uuid)
                 
                 # Let the modules know about it
                 pubsub.pub('delete-node', node_uuid=node_uuid)
@@ -554,6 +641,7 @@ class Gossip(BaseManager):
         with self.nodes_lock:
             self._nodes_writing[nuuid] = node
             self.__refresh_read_only_nodes()
+            self.__update_node_in_group_rings(nuuid)
         # if bootstrap, do not export to other nodes or modules
         if bootstrap:
             return
@@ -569,8 +657,8 @@ class Gossip(BaseManager):
     
     
     # Warn other about a node that is not new or remove, but just did change it's internals data
-    @staticmethod
-    def node_did_change(nid):
+    def node_did_change(self, nid):
+        self.nodes_version += 1
         pubsub.pub('change-node', node_uuid=nid)
     
     
@@ -621,6 +709,7 @@ class Gossip(BaseManager):
             with self.nodes_lock:
                 self._nodes_writing[uuid] = node
                 self.__refresh_read_only_nodes()
+                self.__update_node_in_group_rings(uuid)
             
             # Only broadcast if it's a new data from somewhere else
             if (strong and change_state) or incarnation > prev['incarnation']:
@@ -758,6 +847,7 @@ class Gossip(BaseManager):
         node['incarnation'] = incarnation
         node['state'] = state
         node['leave_time'] = int(time.time())
+        self.__update_node_in_group_rings(uuid)
         
         # warn internal elements
         self.node_did_change(uuid)
@@ -805,6 +895,7 @@ class Gossip(BaseManager):
         node['incarnation'] = incarnation
         node['state'] = state
         node['suspect_time'] = int(time.time())
+        self.__update_node_in_group_rings(uuid)
         
         # warn internal elements
         self.node_did_change(uuid)
@@ -937,7 +1028,7 @@ class Gossip(BaseManager):
     
     def launch_gossip(self):
         # There is no broadcast message to sent so bail out :)
-        if len(broadcaster.broadcasts) == 0:
+        if len(broadcaster) == 0:
             return
         
         nodes = self.nodes
@@ -1043,8 +1134,62 @@ class Gossip(BaseManager):
             # Ok we did finish to ping another
     
     
+    # The acks are received by the udp listener, so a ping register a waiter for the node uuid it pings
+    # NOTE: we wait by node uuid and not seqno, because the relays give back the acks with a 0 seqno
+    def __register_ping_waiter(self, nuuid):
+        q = Queue()
+        with self.ping_waiters_lock:
+            self.ping_waiters.setdefault(nuuid, []).append(q)
+        return q
+    
+    
+    def __unregister_ping_waiter(self, nuuid, q):
+        with self.ping_waiters_lock:
+            waiters = self.ping_waiters.get(nuuid, [])
+            if q in waiters:
+                waiters.remove(q)
+            if not waiters:
+                self.ping_waiters.pop(nuuid, None)
+    
+    
+    # Return the ack message or None if timeout
+    @staticmethod
+    def __wait_ping_ack(q, timeout):
+        try:
+            return q.get(timeout=timeout)
+        except Empty:
+            return None
+    
+    
+    def manage_ack_message(self, m):
+        node = m.get('node', None)
+        if not isinstance(node, dict):
+            return
+        with self.ping_waiters_lock:
+            waiters = list(self.ping_waiters.get(node.get('uuid', None), []))
+        for q in waiters:
+            q.put(m)
+    
+    
+    def __manage_ping_ack(self, other, msg):
+        new_other = msg['node']
+        logger.debug('PING got a return from', new_other['name'], '(%s) (node state)=%s:' % (new_other['display_name'], new_other['state']), msg)
+        if new_other['state'] == NODE_STATES.ALIVE:
+            # An aswer? great it is alive!
+            self.set_alive(other, strong=True)
+        elif new_other['state'] == NODE_STATES.LEAVE:
+            self.set_leave(new_other)
+        else:
+            logger.error('PING the other node %s did give us a unamanged state: %s' % (new_other['name'], new_other['state']))
+            self.set_suspect(new_other)
+    
+    
     # Launch a ping to another node and if fail set it as suspect
     def __do_ping(self, other):
+        # the ack will be give to our listening socket, so we cannot know if it is alive without it
+        if not udptransport.is_listening():
+            logger.debug('PING: skipping ping to %s as our UDP listener is not open' % other['name'])
+            return
         addr = other['addr']
         port = other['port']
         other_zone_name = other['zone']
@@ -1056,31 +1201,24 @@ class Gossip(BaseManager):
         message = jsoner.dumps(ping_payload)
         encrypter = libstore.get_encrypter()
         enc_message = encrypter.encrypt(message, dest_zone_name=ping_zone)
+        q = self.__register_ping_waiter(other['uuid'])
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
-            sock.sendto(enc_message, (addr, port))
-            logger.debug('PING waiting %s ack message' % other['name'])
-            # Allow 3s to get an answer
-            sock.settimeout(3)
-            ret = sock.recv(65535)
-            uncrypted_ret = encrypter.decrypt(ret)
-            logger.debug('RECEIVING PING RESPONSE: %s' % uncrypted_ret)
             try:
-                msg = jsoner.loads(uncrypted_ret)
-                new_other = msg['node']
-                logger.debug('PING got a return from %s (%s) (node state)=%s: %s' % (new_other['name'], new_other['display_name'], new_other['state'], msg))
-                if new_other['state'] == NODE_STATES.ALIVE:
-                    # An aswer? great it is alive!
-                    self.set_alive(other, strong=True)
-                elif new_other['state'] == NODE_STATES.LEAVE:
-                    self.set_leave(new_other)
-                else:
-                    logger.error('PING the other node %s did give us a unamanged state: %s' % (new_other['name'], new_other['state']))
-                    self.set_suspect(new_other)
-            except ValueError:  # bad json
-                self.set_suspect(other)
-        except (socket.timeout, socket.gaierror) as exp:
-            logger.info("PING: error joining the other node %s:%s : %s. Switching to a indirect ping mode." % (addr, port, exp))
+                udptransport.sendto(enc_message, (addr, port))
+                logger.debug('PING waiting %s ack message' % other['name'])
+                # Allow 3s to get an answer
+                msg = self.__wait_ping_ack(q, 3)
+            except socket.gaierror as exp:
+                logger.info("PING: error joining the other node %s:%s : %s" % (addr, port, exp))
+                msg = None
+            except socket.error as exp:
+                logger.info("PING: cannot join the other node %s:%s : %s" % (addr, port, exp))
+                return
+            if msg is not None:
+                self.__manage_ping_ack(other, msg)
+                return
+            
+            logger.info("PING: no answer from the other node %s:%s. Switching to a indirect ping mode." % (addr, port))
             possible_relays = [n for n in self.nodes.values() if
                                n['uuid'] != self.uuid
                                and n != other
@@ -1091,45 +1229,27 @@ class Gossip(BaseManager):
             if len(possible_relays) == 0:
                 logger.info("PING: no possible relays for ping")
                 self.set_suspect(other)
+                return
             # Take at least 3 relays to ask ping
             relays = random.sample(possible_relays, min(len(possible_relays), 3))
             logger.debug('POSSIBLE RELAYS', relays)
             ping_relay_payload = {'type': PACKET_TYPES.PING_RELAY, 'seqno': 0, 'tgt': other['uuid'], 'from': self.uuid, 'from_zone': self.zone}
             message = jsoner.dumps(ping_relay_payload)
             enc_message = encrypter.encrypt(message, dest_zone_name=ping_zone)  # relays are all in the other zone, so same as before
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
-            for r in relays:
-                try:
-                    sock.sendto(enc_message, (r['addr'], r['port']))
-                    logger.info('PING waiting ack message from relay %s about node %s' % (r['display_name'], other['display_name']))
-                except socket.error as exp:
-                    logger.error('Cannot send a ping relay to %s:%s' % (r['addr'], r['port']))
+            udptransport.send_many([(enc_message, (r['addr'], r['port'])) for r in relays])
+            logger.info('PING waiting ack message from relays %s about node %s' % ([r['display_name'] for r in relays], other['display_name']))
             # Allow 3s to get an answer from whatever relays got it
-            sock.settimeout(3 * 2)
-            try:
-                ret = sock.recv(65535)
-            except socket.timeout:
+            msg = self.__wait_ping_ack(q, 3 * 2)
+            if msg is None:
                 logger.info('PING RELAY: no response from relays about node %s' % other['display_name'])
                 # still noone succed to ping it? I suspect it
                 self.set_suspect(other)
-                sock.close()
                 return
-            sock.close()
-            uncrypted_ret = encrypter.decrypt(ret)
-            msg = jsoner.loads(uncrypted_ret)
-            new_other = msg['node']
-            logger.debug('PING got a return from %s (%s) via a relay: %s' % (new_other['name'], new_other['display_name'], msg))
+            logger.debug('PING got a return from %s via a relay' % other['display_name'])
             # Ok it's no more suspected, great :)
-            if new_other['state'] == NODE_STATES.ALIVE:
-                # An aswer? great it is alive!
-                self.set_alive(other, strong=True)
-            elif new_other['state'] == NODE_STATES.LEAVE:
-                self.set_leave(new_other)
-            else:
-                logger.error('PING the other node %s did give us a unamanged state: %s' % (new_other['name'], new_other['state']))
-                self.set_suspect(new_other)
-        except socket.error as exp:
-            logger.info("PING: cannot join the other node %s:%s : %s" % (addr, port, exp))
+            self.__manage_ping_ack(other, msg)
+        finally:
+            self.__unregister_ping_waiter(other['uuid'], q)
     
     
     def manage_ping_message(self, m, addr):
@@ -1152,11 +1272,9 @@ class Gossip(BaseManager):
         my_node_data = self.create_alive_msg(my_self)
         ack = {'type': PACKET_TYPES.ACK, 'seqno': m['seqno'], 'node': my_node_data}
         ret_msg = jsoner.dumps(ack)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
         encrypter = libstore.get_encrypter()
         enc_ret_msg = encrypter.encrypt(ret_msg, dest_zone_name=ack_zone_to_use)
-        sock.sendto(enc_ret_msg, addr)
-        sock.close()
+        udptransport.sendto(enc_ret_msg, addr)
         logger.debug("PING RETURN ACK MESSAGE", ret_msg)
         
         # now maybe the source was a suspect that just ping me? if so
@@ -1189,20 +1307,21 @@ class Gossip(BaseManager):
         if zonemgr.is_top_zone_from(self.zone, tgt_zone):
             tgt_zone = self.zone
         # Now do the real ping
-        ping_payload = {'type': PACKET_TYPES.PING, 'seqno': 0, 'node': ntgt['uuid'], 'from': self.uuid}
+        ping_payload = {'type': PACKET_TYPES.PING, 'seqno': 0, 'node': ntgt['uuid'], 'from': self.uuid, 'from_zone': self.zone}
         message = jsoner.dumps(ping_payload)
         encrypter = libstore.get_encrypter()
         enc_message = encrypter.encrypt(message, dest_zone_name=tgt_zone)
         
+        q = self.__register_ping_waiter(ntgt['uuid'])
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
-            sock.sendto(enc_message, (tgtaddr, tgtport))
+            udptransport.sendto(enc_message, (tgtaddr, tgtport))
             logger.debug('PING waiting %s ack message from a ping-relay' % ntgt['display_name'])
             # Allow 3s to get an answer
-            sock.settimeout(3)
-            ret = sock.recv(65535)
-            uncrypted_ret = encrypter.decrypt(ret)
-            j_ret = jsoner.loads(uncrypted_ret)
+            j_ret = self.__wait_ping_ack(q, 3)
+            if j_ret is None:
+                # cannot reach even us? so it's really dead, let the timeout do its job on _from
+                logger.info('PING (relay): cannot ping the node %s(%s:%s) for %s: no answer' % (ntgt['display_name'], tgtaddr, tgtport, nfrom['display_name']))
+                return
             logger.info('PING (relay) got a return from %s' % ntgt['name'], j_ret)
             # An aswer? great it is alive! Let it know our _from node
             ack = {'type': PACKET_TYPES.ACK, 'seqno': 0, 'node': j_ret['node']}
@@ -1212,13 +1331,13 @@ class Gossip(BaseManager):
             if zonemgr.is_top_zone_from(self.zone, nfrom_zone):
                 nfrom_zone = self.zone
             enc_ret_msg = encrypter.encrypt(ret_msg, dest_zone_name=nfrom_zone)
-            sock.sendto(enc_ret_msg, addr)
-            sock.close()
-        except (socket.timeout, socket.gaierror) as exp:
-            # cannot reach even us? so it's really dead, let the timeout do its job on _from
+            udptransport.sendto(enc_ret_msg, addr)
+        except socket.error as exp:
             logger.info('PING (relay): cannot ping the node %s(%s:%s) for %s: %s' % (ntgt['display_name'], tgtaddr, tgtport, nfrom['display_name'], exp))
         except Exception as exp:
             logger.error('PING (relay) error, cannot ping-relay for a node: %s' % exp)
+        finally:
+            self.__unregister_ping_waiter(ntgt['uuid'], q)
     
     
     def manage_ping_relay_message(self, m, addr):
@@ -1246,7 +1365,6 @@ class Gossip(BaseManager):
         
         r = {'type': PACKET_TYPES.DETECT_PONG, 'node': my_node_data, 'from_zone': self.zone}
         ret_msg = jsoner.dumps(r)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
         encrypter = libstore.get_encrypter()
         
         answer_allowed = False
@@ -1271,8 +1389,7 @@ class Gossip(BaseManager):
         if zonemgr.is_top_zone_from(self.zone, requestor_zone):
             response_zone = self.zone
         enc_ret_msg = encrypter.encrypt(ret_msg, dest_zone_name=response_zone)
-        sock.sendto(enc_ret_msg, addr)
-        sock.close()
+        udptransport.sendto(enc_ret_msg, addr)
         logger.info("Detect back: return back message (from %s): %s" % (ret_msg, m))
     
     
@@ -1339,56 +1456,17 @@ class Gossip(BaseManager):
     # KGOSSIP others nodes
     # consume: if True (default) then a message will be decremented
     def __do_gossip_push(self, dest, consume=True):
-        messages = deque()
-        message = ''
-        to_del = []
-        stack = []  # not deque because we cannot json it
-        groups = dest.get('groups', [])
         # Be sure we will have first:
         # * prioritary messages
         # * less send first
-        broadcaster.sort()
-        with broadcaster.broadcasts_lock:
-            for b in broadcaster.broadcasts:
-                # not a valid node for this message, skip it
-                if 'group' in b and b['group'] not in groups:
-                    continue
-                old_message = message
-                # only delete message if we consume it (our zone)
-                if consume:
-                    # Increase message send number but only if we need to consume it (our zone send)
-                    b['send'] += 1
-                    send = b['send']
-                    if send >= KGOSSIP:
-                        to_del.append(b)
-                # NOTE: maybe this message will make the current stack too big
-                # if so we will get back to the old version and create a new stack
-                bmsg = b['msg']
-                stack.append(bmsg)
-                message = jsoner.dumps(stack)
-                # Maybe we are now too large and we do not have just one
-                # fucking big message, so we fail back to the old_message that was
-                # in the good size and send it now
-                if len(message) > 1400 and len(stack) != 1:
-                    # Stop this message, stock the previous version, and start a new stack
-                    messages.append(old_message)
-                    # reset with just the new packet
-                    stack = [bmsg]
-                    message = jsoner.dumps(stack)
-        # always stack the last one if we did create more than 1
-        # or just the first if it was small
-        if message != '':
-            messages.append(message)
+        # and only the messages for this node groups, already packed in packets of the good size
+        # and in binary if the other node can read it
+        messages = broadcaster.get_packets(dest.get('groups', []), consume=consume, max_send=KGOSSIP, binary=is_node_binary_capable(dest))
         
         # Maybe there is no messages to send
         if len(messages) == 0:
             return
         
-        with broadcaster.broadcasts_lock:
-            # Clean too much broadcasted messages
-            for b in to_del:
-                broadcaster.broadcasts.remove(b)
-        
         addr = dest['addr']
         port = dest['port']
         zone_name = dest['zone']
@@ -1396,24 +1474,16 @@ class Gossip(BaseManager):
         if zonemgr.is_top_zone_from(self.zone, zone_name):
             zone_name = self.zone
         total_size = 0
-        sock = None
+        packets = []
         # and go for it!
-        try:
-            encrypter = libstore.get_encrypter()
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
-            for message in messages:
-                logger.debug('BROADCAST: sending message: (len=%d) %s' % (len(message), message))
-                enc_message = encrypter.encrypt(message, dest_zone_name=zone_name)
-                total_size += len(enc_message)
-                sock.sendto(enc_message, (addr, port))
-            logger.debug('BROADCAST: sent %d messages (total size=%d) to %s:%s (uuid=%s  display_name=%s)' % (len(messages), total_size, addr, port, dest['uuid'], dest['display_name']))
-        except (socket.timeout, socket.gaierror) as exp:
-            logger.error("ERROR: cannot sent the UDP message of len %d to %s: %s" % (len(message), dest['uuid'], exp))
-        try:
-            if sock is not None:
-                sock.close()
-        except Exception:
-            pass
+        encrypter = libstore.get_encrypter()
+        for message in messages:
+            logger.debug('BROADCAST: sending message: (len=%d)' % len(message), message)
+            enc_message = encrypter.encrypt(message, dest_zone_name=zone_name)
+            total_size += len(enc_message)
+            packets.append((enc_message, (addr, port)))
+        nb_sent = udptransport.send_many(packets)
+        logger.debug('BROADCAST: sent %d/%d messages (total size=%d) to %s:%s (uuid=%s  display_name=%s)' % (nb_sent, len(messages), total_size, addr, port, dest['uuid'], dest['display_name']))
     
     
     def _get_seeds_nodes(self):
@@ -1481,24 +1551,108 @@ class Gossip(BaseManager):
                 time.sleep(0.1)
     
     
-    # Go launch a push-pull to another node. We will sync all our nodes
-    # entries, and each other will be able to learn new nodes and so
-    # launch gossip broadcasts if need
-    # We push pull:
+    # The nodes we do give to the others in a push-pull:
     # * our own zone
-    # * the upper zone
-    # * NEVER lower zone. They will connect to us
-    def do_push_pull(self, other):
-        nodes = self.nodes
+    # * the sub zones
+    # * NEVER top zones, they are managed by their own proxies
+    def __get_nodes_to_push(self):
         sub_zones = zonemgr.get_sub_zones_from(self.zone)
         nodes_to_send = {}
-        for (nuuid, node) in nodes.items():
+        for (nuuid, node) in self.nodes.items():
             nzone = node['zone']
             if nzone != self.zone and nzone not in sub_zones:
                 # skip this node
                 continue
             # ok in the good zone (our or sub)
             nodes_to_send[nuuid] = node
+        return nodes_to_send
+    
+    
+    # The digest of a node is only what we need to know if its entry did change
+    @staticmethod
+    def __get_node_digest(node):
+        return [node['incarnation'], node['state']]
+    
+    
+    # Is the digest (incarnation, state) newer or different than the other one?
+    # NOTE: on the same incarnation we cannot know which state is the good one, so we exchange both
+    # and the set_alive/set_suspect/set_leave will manage it
+    @staticmethod
+    def __is_digest_newer(digest, other_digest):
+        if other_digest is None:
+            return True
+        if digest[0] != other_digest[0]:
+            return digest[0] > other_digest[0]
+        return digest[1] != other_digest[1]
+    
+    
+    def __get_events_copy(self, eventids):
+        with self.events_lock:
+            return copy.deepcopy(dict((eventid, self.events[eventid]) for eventid in eventids if eventid in self.events))
+    
+    
+    # Go launch a push-pull to another node. We will sync all our nodes
+    # entries, and each other will be able to learn new nodes and so
+    # launch gossip broadcasts if need
+    # We push pull:
+    # * our own zone
+    # * the upper zone
+    # * NEVER lower zone. They will connect to us
+    # To not send all the nodes each time, we first send only a digest of our nodes and events, the other
+    # node give us back the nodes and events we do not know about, and ask for the ones it is missing.
+    # Then only if need we send them.
+    def do_push_pull(self, other):
+        nodes_to_send = self.__get_nodes_to_push()
+        with self.events_lock:
+            eventids = list(self.events.keys())
+        
+        m = {'type': 'push-pull-digest', 'ask-from-zone': self.zone, 'nodes': dict((nuuid, self.__get_node_digest(node)) for (nuuid, node) in nodes_to_send.items()), 'events': eventids}
+        
+        (addr, port) = other
+        
+        uri = 'http://%s:%s/agent/push-pull/digest' % (addr, port)
+        try:
+            try:
+                r = httper.post(uri, data=encode_push_pull_msg(m), timeout=10)
+            except HTTPError as exp:
+                # an old node that do not know about digests, do a full one
+                if exp.code == 404:
+                    return self.__do_full_push_pull(other)
+                raise
+            try:
+                back = decode_push_pull_msg(r)
+            except ValueError as exp:
+                logger.error('ERROR CONNECTING TO %s:%s' % other, exp)
+                return False
+            # Maybe we were not autorized
+            if 'error' in back:
+                logger.error('Cannot push/pull with node %s: %s' % (addr, back['error']))
+                return False
+            logger.debug('do_push_pull: get return from %s:%s' % (other[0], back))
+            if 'nodes' not in back:
+                logger.error('do_push_pull: back message do not have nodes entry: %s' % back)
+                return False
+            self.merge_nodes(back['nodes'])
+            self.merge_events(back.get('events', {}))
+            
+            # Now give the other node what it did ask for
+            asked_nodes = dict((nuuid, nodes_to_send[nuuid]) for nuuid in back.get('ask-nodes', []) if nuuid in nodes_to_send)
+            asked_events = self.__get_events_copy(back.get('ask-events', []))
+            if not asked_nodes and not asked_events:
+                return True
+            logger.debug('do_push_pull:: giving %s informations about nodes: %s' % (other[0], [n['name'] for n in asked_nodes.values()]))
+            m = {'type': 'push-pull-msg', 'ask-from-zone': self.zone, 'nodes': asked_nodes, 'events': asked_events}
+            uri = 'http://%s:%s/agent/push-pull/delta' % (addr, port)
+            httper.post(uri, data=encode_push_pull_msg(m), timeout=10)
+            return True
+        except get_http_exceptions() as exp:
+            logger.error('[push-pull] ERROR CONNECTING TO %s:%s' % other, exp)
+            return False
+    
+    
+    # Old way of push-pull, with all our nodes and events, for nodes that do not manage digests
+    def __do_full_push_pull(self, other):
+        nodes_to_send = self.__get_nodes_to_push()
         
         with self.events_lock:
             events = copy.deepcopy(self.events)
@@ -1535,6 +1689,39 @@ class Gossip(BaseManager):
             return False
     
     
+    # Another node did send us its digest: we give back the nodes and events it is missing (only
+    # the nodes its zone is allowed to see), and ask the ones we are missing
+    def get_push_pull_digest_response(self, msg):
+        other_node_zone = msg['ask-from-zone']
+        nodes = self.get_nodes_for_push_pull_response(other_node_zone)
+        if nodes is None:
+            return {'error': 'You are not from a valid zone'}
+        
+        other_digest = msg.get('nodes', {})
+        nodes_to_give = {}
+        for (nuuid, node) in nodes.items():
+            if self.__is_digest_newer(self.__get_node_digest(node), other_digest.get(nuuid, None)):
+                nodes_to_give[nuuid] = node
+        
+        ask_nodes = []
+        my_nodes = self.nodes
+        for (nuuid, digest) in other_digest.items():
+            if nuuid == self.uuid:
+                continue
+            node = my_nodes.get(nuuid, None)
+            if node is None or self.__is_digest_newer(digest, self.__get_node_digest(node)):
+                ask_nodes.append(nuuid)
+        
+        other_eventids = set(msg.get('events', []))
+        with self.events_lock:
+            my_eventids = set(self.events.keys())
+        events_to_give = self.__get_events_copy(my_eventids - other_eventids)
+        ask_events = list(other_eventids - my_eventids)
+        
+        logger.debug('PUSH-PULL digest from zone %s: give %d nodes and %d events, ask %d nodes and %d events' % (other_node_zone, len(nodes_to_give), len(events_to_give), len(ask_nodes), len(ask_events)))
+        return {'type': 'push-pull-delta', 'nodes': nodes_to_give, 'events': events_to_give, 'ask-nodes': ask_nodes, 'ask-events': ask_events}
+    
+    
     # An other node did push-pull us, and we did load it's nodes,
     # but now we should give back only nodes that the other zone
     # have the right:
@@ -1605,6 +1792,7 @@ class Gossip(BaseManager):
             if stime < (now - suspect_timeout):
                 logger.info("SUSPECT: NODE", node['name'], node['incarnation'], node['state'], "is NOW DEAD")
                 node['state'] = NODE_STATES.DEAD
+                self.__update_node_in_group_rings(node['uuid'])
                 # warn internal elements
                 self.node_did_change(node['uuid'])
                 # Save this change into our history
@@ -1637,6 +1825,7 @@ class Gossip(BaseManager):
             'incarnation': node['incarnation'], 'groups': node.get('groups', []),
             'services'   : node['services'], 'checks': node['checks'],
             'zone'       : node.get('zone', ''), 'is_proxy': node.get('is_proxy', False),
+            'codec'      : node.get('codec', 0),
         }
     
     
@@ -1748,13 +1937,15 @@ class Gossip(BaseManager):
         # If the other is in a top level, we don't have it's zone key, use our
         if zonemgr.is_top_zone_from(self.zone, dest_zone):
             dest_zone = self.zone
-        flat_message = jsoner.dumps(message)
+        # NOTE: with a force_addr, the other side is not the node itself (like a cli), so stay in json
+        if force_addr:
+            flat_message = jsoner.dumps(message)
+        else:
+            flat_message = encode_for_node(message, dest_node)
         try:
-            # Closing context: make a context that always exit when done
-            with closing_context(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as sock:  # UDP
-                encrypter = libstore.get_encrypter()
-                encrypted_message = encrypter.encrypt(flat_message, dest_zone_name=dest_zone)
-                sock.sendto(encrypted_message, (dest_addr, dest_port))
+            encrypter = libstore.get_encrypter()
+            encrypted_message = encrypter.encrypt(flat_message, dest_zone_name=dest_zone)
+            udptransport.sendto(encrypted_message, (dest_addr, dest_port))
             logger.debug('Sending message to (%s) (type:%s)' % (dest_node['uuid'], message['type']))
         except (socket.timeout, socket.gaierror) as exp:
             logger.error('Cannot Send message to (%s) (type:%s): %s' % (dest_node['uuid'], message['type'], exp))
@@ -1772,7 +1963,7 @@ class Gossip(BaseManager):
             gossiper.manage_detect_ping_message(message, source_addr)
         
         elif message_type == PACKET_TYPES.ACK:
-            pass  # do nothing, wrong route but not a problem
+            gossiper.manage_ack_message(message)
         
         elif message_type == PACKET_TYPES.ALIVE:
             gossiper.set_alive(message)
@@ -1814,7 +2005,7 @@ class Gossip(BaseManager):
             return
         
         
-        @http_export('/agent/members')
+        @http_export('/agent/members', cache_version=self.get_nodes_version)
         def agent_members():
             response.content_type = 'application/json'
             return self.nodes
@@ -1862,7 +2053,7 @@ class Gossip(BaseManager):
             if nodes is None:
                 return jsoner.dumps({'error': 'You are not from a valid zone'})
             
-            logger.debug('ASK from zone: %s and give: %s' % (msg['ask-from-zone'], nodes))
+            logger.debug('ASK from zone:', msg['ask-from-zone'], 'and give:', nodes)
             with self.events_lock:
                 events = copy.deepcopy(self.events)
             m = {'type': 'push-pull-msg', 'nodes': nodes, 'events': events}
@@ -1870,6 +2061,35 @@ class Gossip(BaseManager):
             return jsoner.dumps(m)
         
         
+        @http_export('/agent/push-pull/digest', method='POST')
+        def interface_push_pull_digest():
+            response.content_type = 'application/json'
+            try:
+                msg = decode_push_pull_msg(request.body.getvalue())
+            except ValueError:  # bad json...
+                return abort(400, 'Bad push-pull message')
+            if msg.get('type', None) != 'push-pull-digest':  # bad message, skip it
+                return abort(400, 'Bad push-pull message')
+            data = encode_push_pull_msg(self.get_push_pull_digest_response(msg))
+            if data[:1] != b'{':  # compressed
+                response.content_type = 'application/octet-stream'
+            return data
+        
+        
+        @http_export('/agent/push-pull/delta', method='POST')
+        def interface_push_pull_delta():
+            response.content_type = 'application/json'
+            try:
+                msg = decode_push_pull_msg(request.body.getvalue())
+            except ValueError:  # bad json...
+                return abort(400, 'Bad push-pull message')
+            if msg.get('type', None) != 'push-pull-msg':  # bad message, skip it
+                return abort(400, 'Bad push-pull message')
+            self.merge_nodes(msg['nodes'])
+            self.merge_events(msg.get('events', {}))
+            return jsoner.dumps(True)
+        
+        
         @http_export('/agent/detect', protected=True)
         def agent_detect():
             response.content_type = 'application/json'
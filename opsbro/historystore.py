@@ -0,0 +1,204 @@
+import os
+import bisect
+import threading
+import time
+
+from .jsonmgr import jsoner
+
+# A new segment file is started when the current one is bigger than this
+HISTORY_SEGMENT_MAX_SIZE = 1024 * 1024
+
+# Segments with only entries older than this are removed
+HISTORY_RETENTION = 30 * 86400
+
+# And we do not keep more than this number of segments
+HISTORY_MAX_SEGMENTS = 64
+
+HISTORY_SEGMENT_PREFIX = 'history-'
+HISTORY_SEGMENT_EXTENSION = '.log'
+
+
+# One file of the history, with the (date, offset, size) of its entries, and only their dates
+# so we can bisect them
+class HistorySegment(object):
+    def __init__(self, path, first_date):
+        self.path = path
+        self.first_date = first_date
+        self.entries = []
+        self.dates = []
+        self.size = 0
+    
+    
+    def add_entry(self, date, offset, size):
+        self.entries.append((date, offset, size))
+        self.dates.append(date)
+    
+    
+    # Look at the entries in the file, only their date is read (the line start) so we do not need to
+    # parse the json. A line without its end is an entry we did not finish to write, we drop it
+    def load_index(self):
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                date_part = line.split(b'\t', 1)[0]
+                try:
+                    date = int(date_part)
+                except ValueError:
+                    break
+                self.add_entry(date, offset, len(line))
+                offset += len(line)
+        if offset != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+        self.size = offset
+    
+    
+    def get_last_date(self):
+        if not self.entries:
+            return self.first_date
+        return self.entries[-1][0]
+    
+    
+    # Read the entries from the index idx_from to idx_to (excluded), in only one read
+    def read_entries(self, idx_from, idx_to):
+        if idx_from >= idx_to:
+            return []
+        first_offset = self.entries[idx_from][1]
+        last_date, last_offset, last_size = self.entries[idx_to - 1]
+        with open(self.path, 'rb') as f:
+            f.seek(first_offset)
+            data = f.read(last_offset + last_size - first_offset)
+        r = []
+        for line in data.splitlines():
+            date_part, entries = line.split(b'\t', 1)
+            r.append({'date': int(date_part), 'entries': jsoner.loads(entries)})
+        return r
+
+
+# Append only history of a manager, in size capped segment files, with an in memory index of the
+# entries dates, so we can read the last ones or a time range without looking at the directory
+class HistoryStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = []  # oldest first
+        self.lock = threading.RLock()
+        self.current_file = None
+    
+    
+    def open(self):
+        with self.lock:
+            segments = []
+            for name in os.listdir(self.directory):
+                if not (name.startswith(HISTORY_SEGMENT_PREFIX) and name.endswith(HISTORY_SEGMENT_EXTENSION)):
+                    continue
+                try:
+                    first_date = int(name[len(HISTORY_SEGMENT_PREFIX):-len(HISTORY_SEGMENT_EXTENSION)])
+                except ValueError:
+                    continue
+                segment = HistorySegment(os.path.join(self.directory, name), first_date)
+                segment.load_index()
+                segments.append(segment)
+            segments.sort(key=lambda s: s.first_date)
+            self.segments = segments
+            self.__import_old_files()
+            self.__clean_old_segments()
+    
+    
+    # Old versions did have one json file by entry, import the ones we should still keep
+    def __import_old_files(self):
+        old_files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                date = int(name[:-len('.json')])
+            except ValueError:
+                continue
+            old_files.append((date, os.path.join(self.directory, name)))
+        if not old_files:
+            return
+        old_files.sort()
+        too_old = time.time() - HISTORY_RETENTION
+        for (date, path) in old_files:
+            if date >= too_old:
+                try:
+                    with open(path, 'r') as f:
+                        entries = jsoner.loads(f.read())
+                    self.append(date, entries)
+                except (IOError, ValueError):  # bad file, skip it
+                    pass
+            os.unlink(path)
+    
+    
+    def __get_current_segment(self, date):
+        if self.segments and self.segments[-1].size < HISTORY_SEGMENT_MAX_SIZE:
+            segment = self.segments[-1]
+        else:
+            if self.current_file is not None:
+                self.current_file.close()
+                self.current_file = None
+            # the segments are named by their first date, so two of them cannot start at the same time
+            if self.segments:
+                date = max(date, self.segments[-1].first_date + 1)
+            segment = HistorySegment(os.path.join(self.directory, '%s%d%s' % (HISTORY_SEGMENT_PREFIX, date, HISTORY_SEGMENT_EXTENSION)), date)
+            self.segments.append(segment)
+            self.__clean_old_segments()
+        if self.current_file is None:
+            self.current_file = open(segment.path, 'ab')
+        return segment
+    
+    
+    def __clean_old_segments(self):
+        too_old = time.time() - HISTORY_RETENTION
+        # never remove the current one
+        while len(self.segments) > 1 and (len(self.segments) > HISTORY_MAX_SEGMENTS or self.segments[0].get_last_date() < too_old):
+            segment = self.segments.pop(0)
+            try:
+                os.unlink(segment.path)
+            except OSError:
+                pass
+    
+    
+    def append(self, date, entries):
+        data = jsoner.dumps(entries)
+        if not isinstance(data, bytes):
+            data = data.encode('utf8')
+        line = ('%d\t' % date).encode('utf8') + data + b'\n'
+        with self.lock:
+            segment = self.__get_current_segment(date)
+            self.current_file.write(line)
+            self.current_file.flush()
+            segment.add_entry(date, segment.size, len(line))
+            segment.size += len(line)
+    
+    
+    # The last entries, with at least max_size bytes of them (if available), older first
+    def get_tail(self, max_size=1024 * 1024):
+        with self.lock:
+            to_read = []
+            current_size = 0
+            for segment in reversed(self.segments):
+                idx = len(segment.entries)
+                while idx > 0 and current_size <= max_size:
+                    idx -= 1
+                    current_size += segment.entries[idx][2]
+                to_read.append((segment, idx, len(segment.entries)))
+                if current_size > max_size:
+                    break
+            r = []
+            for (segment, idx_from, idx_to) in reversed(to_read):
+                r.extend(segment.read_entries(idx_from, idx_to))
+            return r
+    
+    
+    # The entries between start and end (both included), older first
+    def get_range(self, start, end):
+        with self.lock:
+            r = []
+            for segment in self.segments:
+                if segment.get_last_date() < start or segment.first_date > end:
+                    continue
+                r.extend(segment.read_entries(bisect.bisect_left(segment.dates, start), bisect.bisect_right(segment.dates, end)))
+            return r
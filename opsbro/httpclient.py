@@ -101,11 +101,10 @@ class Httper(object):
         return response
     
     
+    # NOTE: if data is given, it's used as the raw body instead of the json of params
     @staticmethod
-    def post(uri, params={}, headers={}):
-        data = None  # always none in GET
-        
-        if params:
+    def post(uri, params={}, headers={}, data=None, timeout=None):
+        if data is None and params:
             # TODO: sure it's json and not urlencode?
             # data = urlencode(params)
             data = unicode_to_bytes(jsoner.dumps(params))
@@ -116,7 +115,10 @@ class Httper(object):
         req.get_method = lambda: 'POST'
         for (k, v) in headers.items():
             req.add_header(k, v)
-        request = url_opener.open(req)
+        if timeout is not None:
+            request = url_opener.open(req, timeout=timeout)
+        else:
+            request = url_opener.open(req)
         response = request.read()
         # code = request.code
         return response
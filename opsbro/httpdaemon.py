@@ -1,4 +1,8 @@
 import traceback
+import threading
+import hashlib
+import functools
+import zlib
 
 from .misc.bottle import run, request, abort, error, redirect, response, gserver
 from .misc.bottle import route as bottle_route
@@ -8,26 +12,128 @@ bottle.debug(False)
 
 from .log import logger, LoggerFactory
 from .jsonmgr import jsoner
+from .stats import STATS
 
 http_logger = LoggerFactory.create_logger('http_errors')
 
 # Global: keep a trace of the exported functions called by the routes
 exported_functions = {}
 
+# Max number of cached responses (routes x arguments), the cache is emptied if there are more
+HTTP_CACHE_MAX_ENTRIES = 256
+
+# Smaller responses are never gzipped
+HTTP_GZIP_MIN_SIZE = 1024
+
+try:
+    _text_types = (str, unicode, bytes)
+except NameError:  # python3
+    _text_types = (str, bytes)
+
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf8')
+
+
+# A response for a version of the data
+class HttpCacheEntry(object):
+    def __init__(self, version, body, content_type):
+        self.version = version
+        self.body = body
+        self.content_type = content_type
+        digest = hashlib.md5(_to_bytes(body)).hexdigest()
+        self.etag = '"%s"' % digest
+        self.gzip_etag = '"%s-gzip"' % digest
+        self.gzip_body = None
+    
+    
+    # Only compressed if a client ask for it, and only once
+    def get_gzip_body(self):
+        if self.gzip_body is None:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16+: gzip format
+            self.gzip_body = compressor.compress(_to_bytes(self.body)) + compressor.flush()
+        return self.gzip_body
+
+
+# Cache of the GET responses of the routes exported with a cache_version function, by route and
+# arguments. The response is only computed (and json dumped) again when the version did change,
+# like the gossip nodes version for the members.
+# The clients can give the ETag back in If-None-Match to get a 304 without the body, and big
+# responses are gzipped for the clients that accept it.
+class HttpResponseCache(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.entries = {}
+    
+    
+    def wrap(self, f, _route, get_version):
+        @functools.wraps(f)
+        def _cached_response(*args, **kwargs):
+            key = (_route, args, tuple(sorted(kwargs.items())), request.query_string)
+            # the version is taken before the response, so a change during it is seen on the next call
+            version = get_version()
+            entry = self.entries.get(key, None)
+            if entry is None or entry.version != version:
+                STATS.incr('http.cache-miss')
+                body = f(*args, **kwargs)
+                if isinstance(body, dict):
+                    body = jsoner.dumps(body)
+                    response.content_type = 'application/json'
+                # None, HTTPResponse and such are not cached
+                if not isinstance(body, _text_types):
+                    return body
+                entry = HttpCacheEntry(version, body, response.content_type)
+                with self.lock:
+                    if len(self.entries) >= HTTP_CACHE_MAX_ENTRIES:
+                        self.entries.clear()
+                    self.entries[key] = entry
+            else:
+                STATS.incr('http.cache-hit')
+            
+            response.content_type = entry.content_type
+            use_gzip = False
+            if len(entry.body) >= HTTP_GZIP_MIN_SIZE:
+                response.headers['Vary'] = 'Accept-Encoding'
+                use_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+            etag = entry.gzip_etag if use_gzip else entry.etag
+            response.headers['ETag'] = etag
+            if_none_match = request.headers.get('If-None-Match', '')
+            if if_none_match and (if_none_match.strip() == '*' or etag in [e.strip() for e in if_none_match.split(',')]):
+                response.status = 304
+                return ''
+            if use_gzip:
+                response.headers['Content-Encoding'] = 'gzip'
+                return entry.get_gzip_body()
+            return entry.body
+        
+        
+        return _cached_response
+
+
+http_cache = HttpResponseCache()
+
 
 # propose a decorator to export http function, and so provide way to
 # list them, propose automatic handling (protection or json dump, etc)
-def http_export(_route, method='GET', protected=False):
+# If cache_version is set, it is a function that give the version of the data of the
+# route, and the GET responses are cached until it change (see HttpResponseCache)
+def http_export(_route, method='GET', protected=False, cache_version=None):
     def decorator(f):
         # Maybe it was already exported, just stack the route and exit
         if f not in exported_functions:
             exported_functions[f] = {'routes': [], 'method': method}
         exported_functions[f]['routes'].append(_route)
         logger.debug('Exporting a function %s as a HTTP route %s and method %s' % (f, _route, method))
-        bottle_route(_route, callback=f, method=[method, 'OPTIONS'])
+        callback = f
+        if cache_version is not None and method == 'GET':
+            callback = http_cache.wrap(f, _route, cache_version)
+        bottle_route(_route, callback=callback, method=[method, 'OPTIONS'])
         # and protect it from external queries
         if protected:
             f.protected = True
+            callback.protected = True
         return f
     
     
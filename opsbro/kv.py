@@ -1,7 +1,11 @@
 import os
 import time
-import threading
-import socket
+from collections import OrderedDict
+
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
 
 from .httpclient import get_http_exceptions, httper
 from .log import LoggerFactory
@@ -10,13 +14,42 @@ from .dbwrapper import dbwrapper
 from .gossip import gossiper
 from .library import libstore
 from .stop import stopper
-from .util import get_sha1_hash
+from .util import get_sha1_hash, string_to_b64unicode, b64_into_bytes
 from .jsonmgr import jsoner
 from .ttldatabase import TTLDatabase
+from .updatelog import UpdateLog
 from .udprouter import udprouter
+from .udptransport import udptransport
+from .wirecodec import encode_for_node
 
 REPLICATS = 1
 
+# Max number of keys sent to a replica in one replication request
+REPLICATION_BATCH_SIZE = 500
+# and max size of the values in one request
+REPLICATION_BATCH_MAX_BYTES = 1024 * 1024
+
+# Max number of keys waiting for a replica. If it cannot follow, we drop the oldest
+# updates (only the last value of a key is kept anyway)
+REPLICATION_MAX_PENDING = 100000
+
+# Max time to wait before retrying a replica in error
+REPLICATION_MAX_BACKOFF = 30
+
+# The changes index: __changes/MODIFY_TIME/KEY entries, ordered by modification time, so we can
+# give the keys changed since a time without looking at all the meta entries.
+# NOTE: must not be between __meta and __n, where are the meta entries
+CHANGES_INDEX_PREFIX = '__changes/'
+# When this key is set, the changes index is up to date with the meta entries
+CHANGES_INDEX_VERSION_KEY = '__changes-version'
+CHANGES_INDEX_VERSION = '1'
+
+# Number of changed keys read from the database (and given by the http interface) at once
+CHANGES_PAGE_SIZE = 1000
+
+# Sequence number of the last update log record that is in the database
+UPDATE_LOG_SEQNO_KEY = '__update-log-seqno'
+
 # Global logger for this part
 logger = LoggerFactory.create_logger('key-value')
 
@@ -25,6 +58,87 @@ class KV_PACKET_TYPES(object):
     PUT = 'kv::put'
 
 
+# Replication state of one of our replicas:
+# * the keys that are waiting to be sent to it, only the last value of a key is kept
+# * a persistent http connection to it
+# * stats about its lag
+class ReplicaState(object):
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.pending = OrderedDict()  # ukey -> (value, meta, stack time)
+        self.connection = None
+        self.connection_addr = None
+        self.batch_capable = True  # old nodes do not have the batch interface
+        self.next_try = 0
+        self.errors = 0
+        self.sent = 0
+        self.dropped = 0
+        self.last_success = 0
+    
+    
+    def stack(self, ukey, value, meta, now):
+        # a new value for this key: it replaces the old one, but it's now the newest one
+        self.pending.pop(ukey, None)
+        self.pending[ukey] = (value, meta, now)
+        while len(self.pending) > REPLICATION_MAX_PENDING:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+    
+    
+    # The first pending entries, in the limit of what we can send in one request
+    def get_batch(self):
+        batch = []
+        size = 0
+        for (ukey, (value, meta, _)) in self.pending.items():
+            if batch and (len(batch) >= REPLICATION_BATCH_SIZE or size + len(value) > REPLICATION_BATCH_MAX_BYTES):
+                break
+            batch.append((ukey, value, meta))
+            size += len(value)
+        return batch
+    
+    
+    def get_connection(self, node):
+        addr = (node['addr'], node['port'])
+        if self.connection is None or self.connection_addr != addr:
+            self.close_connection()
+            self.connection = HTTPConnection(node['addr'], node['port'], timeout=10)
+            self.connection_addr = addr
+        return self.connection
+    
+    
+    def close_connection(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+    
+    
+    def set_success(self, batch, now):
+        for (ukey, _, _) in batch:
+            self.pending.pop(ukey, None)
+        self.sent += len(batch)
+        self.errors = 0
+        self.next_try = 0
+        self.last_success = now
+    
+    
+    # Do not hammer a replica that is in error
+    def set_error(self, now):
+        self.close_connection()
+        self.errors += 1
+        self.next_try = now + min(2 ** self.errors, REPLICATION_MAX_BACKOFF)
+    
+    
+    def get_lag(self, now):
+        oldest = 0
+        if self.pending:
+            oldest = now - next(iter(self.pending.values()))[2]
+        return {'pending': len(self.pending), 'oldest_pending_age': oldest, 'errors': self.errors, 'sent': self.sent,
+                'dropped': self.dropped, 'last_success': self.last_success, 'batch': self.batch_capable}
+
+
 # Main KV backend. Reply on a local leveldb database. It's up to the
 # cluster to know if we should manage a key or not, if someone give us it,
 # we save it :)
@@ -35,12 +149,12 @@ class KVBackend:
         self.db = None
         self.ttldb = None
         
-        self.update_db_time = 0
-        self.update_db = None
-        self.lock = threading.RLock()
+        self.update_log = None
         
         # We have a backlog to manage our replication by threads
         self.replication_backlog = {}
+        # replica uuid -> ReplicaState
+        self.replicas_states = {}
         
         # Massif send KV
         self.put_key_buffer = []
@@ -50,10 +164,21 @@ class KVBackend:
     
     
     # Really load data dir and so open database
-    def init(self, data_dir):
+    def init(self, data_dir, fsync_policy='interval'):
         self.data_dir = data_dir
         self.db_dir = os.path.join(data_dir, 'kv')
         self.db = dbwrapper.get_db(self.db_dir)
+        self.__build_changes_index()
+        
+        # Replay the updates that did not go in the database before a crash
+        try:
+            applied_seqno = int(self.db.Get(UPDATE_LOG_SEQNO_KEY))
+        except (KeyError, ValueError):
+            applied_seqno = 0
+        self.update_log = UpdateLog(os.path.join(data_dir, 'updates'), fsync_policy=fsync_policy, sync_db=self.db.Sync)
+        self.update_log.open(applied_seqno, self.__write_in_db)
+        
+        # NOTE: the ttl cleaning thread is deleting keys, so only once the update log is ready
         self.ttldb = TTLDatabase(os.path.join(data_dir, 'ttl'))
         
         # We can now export our http interface
@@ -61,12 +186,24 @@ class KVBackend:
     
     
     def get_info(self):
-        r = {'stats': self.db.GetStats(), 'backend': {}}
+        r = {'stats': self.db.GetStats(), 'backend': {}, 'replication': self.get_replication_lag()}
         if self.db:
             r['backend']['name'] = self.db.name
         return r
     
     
+    # For each replica: how much keys are waiting, and since when
+    def get_replication_lag(self):
+        now = time.time()
+        r = {}
+        for (uuid, state) in list(self.replicas_states.items()):
+            lag = state.get_lag(now)
+            node = gossiper.get(uuid)
+            lag['name'] = node['name'] if node else ''
+            r[uuid] = lag
+        return r
+    
+    
     # We did receive a UDP packet
     def manage_message(self, message_type, message, source_addr):
         if message_type == KV_PACKET_TYPES.PUT:
@@ -79,28 +216,58 @@ class KVBackend:
             logger.error('We do not manage such type of udp message: %s' % message_type)
     
     
-    # We will open a file with the keys writen during a minute
-    # so we can easily look at previous changed
-    def get_update_db(self, t):
-        cmin = divmod(t, 60)[0] * 60
-        if cmin == self.update_db_time and self.update_db:
-            # print "UPDATE DB CACHE HIT"
-            return self.update_db
-        else:  # not the good time
-            if self.update_db:
-                logger.debug("FLUSINH PREVIOUS DB")
-                t0 = time.time()
-                self.update_db.flush()
-                logger.debug("FLUSH TIME: %.4f" % (time.time() - t0))
-                self.update_db.close()
-                self.update_db = None
-            db_dir = os.path.join(self.data_dir, 'updates')
-            db_path = os.path.join(db_dir, '%d.lst' % cmin)
-            if not os.path.exists(db_dir):
-                os.mkdir(db_dir)
-            self.update_db = open(db_path, 'a')
-            self.update_db_time = cmin
-            return self.update_db
+    # All the updates are written in the update log and then in the database, with the sequence number
+    # of the update log record, so we know at startup which ones are missing in the database
+    def __write(self, puts, deletes=()):
+        self.update_log.write(puts, deletes, self.__write_in_db)
+    
+    
+    def __write_in_db(self, puts, deletes, seqno):
+        puts = list(puts)
+        puts.append((UPDATE_LOG_SEQNO_KEY, '%d' % seqno))
+        self.db.WriteBatch(puts, deletes=deletes)
+    
+    
+    @staticmethod
+    def __get_changes_key(mtime, key):
+        return '%s%010d/%s' % (CHANGES_INDEX_PREFIX, int(mtime), key)
+    
+    
+    # The modify time of the current meta entry of a key, None if there is no meta entry
+    def __get_modify_time(self, key):
+        try:
+            return jsoner.loads(self.db.Get('__meta/%s' % key))['modify_time']
+        except (ValueError, KeyError, TypeError):
+            return None
+    
+    
+    # The old changes key of a key must be deleted when its modify time change
+    # NOTE: the deletes are done after the puts in a batch, so do not delete the one we are putting
+    def __stack_changes_key_delete(self, old_mtime, new_mtime, key, deletes):
+        if old_mtime is not None and int(old_mtime) != int(new_mtime):
+            deletes.append(self.__get_changes_key(old_mtime, key))
+    
+    
+    # Databases of old versions do not have the changes index, so create it (only once)
+    def __build_changes_index(self):
+        try:
+            self.db.Get(CHANGES_INDEX_VERSION_KEY)
+            return
+        except KeyError:
+            pass
+        logger.info('Building the key/value changes index')
+        puts = []
+        for (mkey, metaraw) in self.db.RangeIter(key_from='__meta', key_to='__n'):
+            try:
+                mtime = jsoner.loads(metaraw)['modify_time']
+            except (ValueError, KeyError, TypeError):
+                continue
+            puts.append((self.__get_changes_key(mtime, mkey[len('__meta') + 1:]), ''))
+            if len(puts) >= CHANGES_PAGE_SIZE:
+                self.db.WriteBatch(puts)
+                puts = []
+        puts.append((CHANGES_INDEX_VERSION_KEY, CHANGES_INDEX_VERSION))
+        self.db.WriteBatch(puts)
     
     
     # Raw get in our db for a key
@@ -119,50 +286,78 @@ class KVBackend:
     # entry and increate the modify_index (+1) and modify_time too
     # If ttl is et (!=0) then add an entry in a TTL database
     def put(self, key, value, ttl=0):
-        # manage the meta data for this entry
-        # like modification index
-        metakey = '__meta/%s' % key
-        try:
-            metavalue = jsoner.loads(self.db.Get(metakey))
-        except (ValueError, KeyError):
-            metavalue = {'modify_index': 0, 'modify_time': 0}
-        
-        metavalue['modify_index'] += 1
+        self.put_batch([(key, value, ttl)])
+    
+    
+    # Put a list of (key, value, ttl) in one database write, with their meta entries. The ttl entries
+    # are also written once by hour database.
+    # Returns the new meta entries by key
+    def put_batch(self, entries):
         mtime = NOW.now
-        metavalue['modify_time'] = mtime
-        
-        # Update our meta values
-        self.put_meta(key, metavalue)
+        metas = {}
+        puts = []
+        deletes = []
+        ttls = []
+        for (key, value, ttl) in entries:
+            # manage the meta data for this entry
+            # like modification index
+            metavalue = metas.get(key, None)
+            if metavalue is None:
+                try:
+                    metavalue = jsoner.loads(self.db.Get('__meta/%s' % key))
+                    self.__stack_changes_key_delete(metavalue['modify_time'], mtime, key, deletes)
+                except (ValueError, KeyError):
+                    metavalue = {'modify_index': 0, 'modify_time': 0}
+                metas[key] = metavalue
+            metavalue['modify_index'] += 1
+            metavalue['modify_time'] = mtime
+            
+            # if we got a tll, compute the dead time, and set it
+            if ttl > 0:
+                ttls.append((key, mtime + ttl))
+            puts.append((key, value))
         
-        # if we got a tll, compute the dead time, and set it
-        if ttl > 0:
-            dead_t = NOW.now + ttl
-            self.ttldb.set_ttl(key, dead_t)
+        for (key, metavalue) in metas.items():
+            puts.append(('__meta/%s' % key, jsoner.dumps(metavalue)))
+            puts.append((self.__get_changes_key(mtime, key), ''))
         
-        # also put an entry to the update_db
-        with self.lock:  # protect to not have flush and close mixed in different threads
-            f = self.get_update_db(mtime)
-            f.write('%s\n' % key)
-        # print "write", time.time() - t0
+        if ttls:
+            self.ttldb.set_ttls(ttls)
         
-        t0 = time.time()
         # and in the end save the real data :)
-        self.db.Put(key, value)
-        # print "write db", time.time() - t0
+        self.__write(puts, deletes)
+        return metas
+    
+    
+    # Put a list of (key, value, meta) from the master node of theses keys, in one database write.
+    # We keep the master meta entries
+    def put_replicated_batch(self, entries):
+        puts = []
+        deletes = []
+        for (key, value, meta) in entries:
+            puts.append((key, value))
+            puts.append(('__meta/%s' % key, jsoner.dumps(meta)))
+            self.__stack_changes_key_delete(self.__get_modify_time(key), meta['modify_time'], key, deletes)
+            puts.append((self.__get_changes_key(meta['modify_time'], key), ''))
+        
+        self.__write(puts, deletes)
     
     
     # Delete both leveldb and metadata entry
     def delete(self, key):
-        try:
-            self.db.Delete(key)
-        except KeyError:
-            pass
-        # also delete the meta entry
-        metakey = '__meta/%s' % key
-        try:
-            self.db.Delete(metakey)
-        except KeyError:
-            pass
+        self.delete_batch([key])
+    
+    
+    # Delete a lot of keys and their metadata entries in one write
+    def delete_batch(self, keys):
+        deletes = []
+        for key in keys:
+            mtime = self.__get_modify_time(key)
+            if mtime is not None:
+                deletes.append(self.__get_changes_key(mtime, key))
+            deletes.append(key)
+            deletes.append('__meta/%s' % key)
+        self.__write([], deletes)
     
     
     # Get a json dump of a metadata entry
@@ -183,29 +378,60 @@ class KVBackend:
         metadata = meta
         if isinstance(meta, dict):
             metadata = jsoner.dumps(meta)
-        self.db.Put(metakey, metadata)
+        else:
+            meta = jsoner.loads(meta)
+        deletes = []
+        self.__stack_changes_key_delete(self.__get_modify_time(key), meta['modify_time'], key, deletes)
+        self.__write([(metakey, metadata), (self.__get_changes_key(meta['modify_time'], key), '')], deletes)
     
     
-    # Look at meta entries for data that changed since t
-    def changed_since(self, t):
-        # Lookup all __meta keys
-        _all = list(self.db.RangeIter(key_from='__meta', key_to='__n'))
-        
+    # Increased for each write in the database (the last applied update log record)
+    def get_version(self):
+        return self.update_log.applied_seqno
+    
+    
+    # Give a page of the (key, value, meta) that changed since t, ordered by modify time, and the
+    # cursor to give back to have the next page (None if it was the last one).
+    # The changes index is read from the after cursor (excluded), or from the t time
+    def get_changed_page(self, t, after=None, limit=CHANGES_PAGE_SIZE):
+        key_from = after if after is not None else '%s%010d' % (CHANGES_INDEX_PREFIX, int(t))
+        key_to = CHANGES_INDEX_PREFIX + '\x7f'
         r = []
-        for (mkey, metaraw) in _all:
-            meta = jsoner.loads(metaraw)
-            
-            # maybe this key is too old to be interesting
-            if meta['modify_time'] <= t:
+        last_ckey = None
+        for ckey in self.db.RangeIter(key_from=key_from, key_to=key_to, include_value=False):
+            if ckey == after:
                 continue
-            
-            ukey = mkey[len('__meta') + 1:]
+            if len(r) >= limit:
+                return r, last_ckey
+            last_ckey = ckey
+            ukey = ckey.split('/', 2)[2]
             try:
+                meta = jsoner.loads(self.db.Get('__meta/%s' % ukey))
                 v = self.db.Get(ukey)
-            except KeyError:  # should never be possible
+            except (ValueError, KeyError):  # deleted since we did read the index
+                continue
+            # maybe this key is too old to be interesting (same second)
+            if meta['modify_time'] <= t:
                 continue
             r.append((ukey, v, meta))
-        return r
+        return r, None
+    
+    
+    # Stream the (key, value, meta) that changed since t, ordered by modify time, reading the
+    # changes index by pages
+    def iter_changed_since(self, t):
+        after = None
+        while True:
+            entries, after = self.get_changed_page(t, after=after)
+            for entry in entries:
+                yield entry
+            if after is None:
+                return
+    
+    
+    # Look at meta entries for data that changed since t
+    def changed_since(self, t):
+        return list(self.iter_changed_since(t))
     
     
     def stack_put_key(self, k, v, ttl=0, force=False):
@@ -214,6 +440,7 @@ class KVBackend:
     
     # put from udp should be clean quick from the thread so it can listen to udp again and
     # not lost any udp message
+    # The keys we are managing are written all in one batch, the others are sent to their node
     def put_key_reaper(self):
         while not stopper.is_stop():
             put_key_buffer = self.put_key_buffer
@@ -221,8 +448,21 @@ class KVBackend:
             _t = time.time()
             if len(put_key_buffer) != 0:
                 logger.debug("PUT KEY BUFFER LEN", len(put_key_buffer))
+            local_entries = []
+            to_replicate = []
             for (k, v, ttl, force) in put_key_buffer:
-                kvmgr.put_key(k, v, ttl=ttl, allow_udp=True, force=force)
+                if not force:
+                    hkey = get_sha1_hash(k)
+                    if gossiper.find_group_node('kv', hkey) != gossiper.uuid:
+                        kvmgr.put_key(k, v, ttl=ttl, allow_udp=True, force=force)
+                        continue
+                    to_replicate.append((k, v, hkey))
+                local_entries.append((k, v, ttl))
+            if local_entries:
+                metas = self.put_batch(local_entries)
+                # We are the master node of theses keys, so we must replicate them
+                for (k, v, hkey) in to_replicate:
+                    self.replication_backlog[k] = {'value': (k, v), 'repl': [], 'hkey': hkey, 'meta': metas[k]}
             if len(put_key_buffer) != 0:
                 logger.debug("PUT KEY BUFFER DONE IN", time.time() - _t)
             
@@ -243,7 +483,7 @@ class KVBackend:
             # If the other mod_index is higer, we import it :)
             if meta['modify_index'] > lmeta['modify_index']:
                 self.put_meta(ukey, meta)
-                self.db.Put(ukey, v)
+                self.__write([(ukey, v)])
             else:
                 pass
     
@@ -339,7 +579,7 @@ class KVBackend:
             # remember to save the replication back log entry too
             meta = self.get_meta(ukey)
             bl = {'value': (ukey, value), 'repl': [], 'hkey': hkey, 'meta': meta}
-            logger.debug('REPLICATION adding backlog entry %s' % bl)
+            logger.debug('REPLICATION adding backlog entry', bl)
             self.replication_backlog[ukey] = bl
             return None
         else:
@@ -350,13 +590,11 @@ class KVBackend:
             if allow_udp:
                 try:
                     payload = {'type': KV_PACKET_TYPES.PUT, 'k': ukey, 'v': value, 'ttl': ttl, 'fw': True}
-                    packet = jsoner.dumps(payload)
+                    packet = encode_for_node(payload, n)
                     encrypter = libstore.get_encrypter()
                     enc_packet = encrypter.encrypt(packet)
                     logger.debug('KV: PUT(udp) asking %s: %s:%s' % (n['name'], n['addr'], n['port']))
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                    sock.sendto(enc_packet, (n['addr'], n['port']))
-                    sock.close()
+                    udptransport.sendto(enc_packet, (n['addr'], n['port']))
                     return None
                 except Exception as exp:
                     logger.debug('KV: PUT (udp) error asking to %s: %s' % (n['name'], str(exp)))
@@ -407,6 +645,60 @@ class KVBackend:
         return replicats
     
     
+    # Send the first pending keys of this replica in one request. Return True if it did send something
+    def __send_replication_batch(self, state, node, now):
+        batch = state.get_batch()
+        if not state.batch_capable:
+            return self.__send_replication_legacy(state, node, batch, now)
+        
+        # values can be binary, so they are sent in base64
+        body = jsoner.dumps({'entries': [(ukey, string_to_b64unicode(value if isinstance(value, bytes) else value.encode('utf8')), meta) for (ukey, value, meta) in batch]})
+        try:
+            conn = state.get_connection(node)
+            logger.debug('KV: REPLICATION sending %d keys to %s' % (len(batch), node['name']))
+            conn.request('POST', '/kv-replication/batch', body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()  # always read it, so the connection can be reused
+            # old node, without the batch interface
+            if response.status == 404:
+                logger.info('KV: REPLICATION the node %s do not manage batch replication, switching to one put by key' % node['name'])
+                state.batch_capable = False
+                state.close_connection()
+                return False
+            if response.status != 200:
+                logger.error('KV: REPLICATION error from %s: %s %s' % (node['name'], response.status, response.reason))
+                state.set_error(now)
+                return False
+        except get_http_exceptions() as exp:
+            logger.debug('KV: REPLICATION error asking to %s: %s' % (node['name'], str(exp)))
+            state.set_error(now)
+            return False
+        state.set_success(batch, now)
+        return True
+    
+    
+    # Nodes without the batch interface: one put by key
+    def __send_replication_legacy(self, state, node, batch, now):
+        done = []
+        for (ukey, value, meta) in batch:
+            uri = 'http://%s:%s/kv/%s' % (node['addr'], node['port'], ukey)
+            try:
+                logger.debug('KV: PUT(force) asking %s: %s' % (node['name'], uri))
+                params = {'force': True, 'meta': jsoner.dumps(meta)}
+                r = httper.put(uri, data=value, params=params)
+                logger.debug('KV: PUT(force) return %s' % r)
+                done.append((ukey, value, meta))
+            except get_http_exceptions() as exp:
+                logger.debug('KV: PUT(force) error asking to %s: %s' % (node['name'], str(exp)))
+                state.set_error(now)
+                break
+        if done:
+            state.set_success(done, now)
+        return len(done) != 0
+    
+    
+    # The backlog entries are given to each replica state (so the keys are coalesced), and then
+    # each replica is sent its pending keys by batches
     def do_replication_backlog_thread(self):
         logger.log('REPLICATION thread launched')
         while not stopper.is_stop():
@@ -414,30 +706,34 @@ class KVBackend:
             replication_backlog = self.replication_backlog
             self.replication_backlog = {}
             
+            now = time.time()
             replicats = self.get_my_replicats()
-            if len(replicats) == 0:
-                time.sleep(1)
-            for (ukey, bl) in replication_backlog.items():
-                # REF: bl = {'value':(ukey, value), 'repl':[], 'hkey':hkey, 'meta':meta}
-                _, value = bl['value']
-                for uuid in replicats:
-                    _node = gossiper.get(uuid)
-                    # Someone just delete my node, not fair :)
-                    if _node is None:
-                        continue
-                    logger.debug('REPLICATION thread manage entry to %s(%s) : %s' % (_node['name'], uuid, bl))
-                    
-                    # Now send it :)
-                    n = _node
-                    uri = 'http://%s:%s/kv/%s' % (n['addr'], n['port'], ukey)
-                    try:
-                        logger.debug('KV: PUT(force) asking %s: %s' % (n['name'], uri))
-                        params = {'force': True, 'meta': jsoner.dumps(bl['meta'])}
-                        r = httper.put(uri, data=value, params=params)
-                        logger.debug('KV: PUT(force) return %s' % r)
-                    except get_http_exceptions() as exp:
-                        logger.debug('KV: PUT(force) error asking to %s: %s' % (n['name'], str(exp)))
-            time.sleep(1)
+            # Maybe some nodes are no more our replicas
+            for uuid in list(self.replicas_states.keys()):
+                if uuid not in replicats:
+                    self.replicas_states.pop(uuid).close_connection()
+            
+            did_send = False
+            for uuid in replicats:
+                state = self.replicas_states.get(uuid, None)
+                if state is None:
+                    state = self.replicas_states[uuid] = ReplicaState(uuid)
+                for (ukey, bl) in replication_backlog.items():
+                    # REF: bl = {'value':(ukey, value), 'repl':[], 'hkey':hkey, 'meta':meta}
+                    state.stack(ukey, bl['value'][1], bl['meta'], now)
+                
+                if not state.pending or now < state.next_try:
+                    continue
+                _node = gossiper.get(uuid)
+                # Someone just delete my node, not fair :)
+                if _node is None:
+                    continue
+                if self.__send_replication_batch(state, _node, now):
+                    did_send = True
+            
+            # only sleep if we did not send anything, so we let the backlog grow a bit
+            if not did_send:
+                time.sleep(0.1)
     
     
     # main method to export http interface. Must be in a method that got
@@ -445,19 +741,40 @@ class KVBackend:
     def export_http(self):
         from .httpdaemon import response, http_export, abort, request
         
-        @http_export('/kv/')
-        @http_export('/kv')
+        @http_export('/kv/', cache_version=self.get_version)
+        @http_export('/kv', cache_version=self.get_version)
         def list_keys():
             response.content_type = 'application/json'
             l = list(self.db.RangeIter(include_value=False))
             return jsoner.dumps(l)
         
         
+        # If a limit is given, the changes are given by pages: {'entries': [...], 'next': cursor}
+        # and the next page is asked with after=cursor
         @http_export('/kv-meta/changed/:t', method='GET')
         def changed_since(t):
             response.content_type = 'application/json'
             t = int(t)
-            return jsoner.dumps(self.changed_since(t))
+            limit = request.GET.get('limit', None)
+            if limit is None:
+                return jsoner.dumps(self.changed_since(t))
+            after = request.GET.get('after', None)
+            entries, next_cursor = self.get_changed_page(t, after=after, limit=int(limit))
+            return jsoner.dumps({'entries': entries, 'next': next_cursor})
+        
+        
+        # Our master node is sending us a batch of keys to replicate
+        @http_export('/kv-replication/batch', method='POST')
+        def interface_replication_batch():
+            response.content_type = 'application/json'
+            try:
+                entries = jsoner.loads(request.body.getvalue())['entries']
+                entries = [(ukey, b64_into_bytes(value), meta) for (ukey, value, meta) in entries]
+            except (ValueError, KeyError, TypeError):  # bad json...
+                return abort(400, 'Bad replication data')
+            logger.debug("KV: REPLICATION received %d keys" % len(entries))
+            self.put_replicated_batch(entries)
+            return jsoner.dumps(len(entries))
         
         
         @http_export('/kv/:ukey#.+#', method='GET')
@@ -9,7 +9,9 @@ import logging
 import json
 import codecs
 import shutil
+import atexit
 from glob import glob
+from collections import deque
 from threading import Lock as ThreadLock
 from multiprocessing.sharedctypes import Value
 from ctypes import c_int
@@ -34,6 +36,18 @@ if 'FORCE_LOG_ROTATION_PERIOD' in os.environ:
 
 DEFAULT_LOG_PART = 'daemon'
 
+# When the log writer is launched, the logs are stacked and then formatted and written by it:
+# * it wakes up every LOG_WRITER_WAIT seconds if there is nothing to write
+# * it writes at most LOG_BATCH_SIZE logs at once
+# * the log files are flushed every LOG_FLUSH_INTERVAL seconds, or when LOG_FLUSH_SIZE bytes are not flushed
+LOG_WRITER_WAIT = 0.05
+LOG_BATCH_SIZE = 1000
+LOG_FLUSH_INTERVAL = 1.0
+LOG_FLUSH_SIZE = 65536
+
+# The part loggers look if someone is following them (cli) only every this seconds
+LISTENER_CHECK_INTERVAL = 1.0
+
 
 def is_tty():
     # TODO: what about windows? how to have beautiful & Windows?
@@ -157,6 +171,12 @@ class Logger(object):
         # the master process can have aquire() it and so will never unset it in your new process
         self.log_lock = None
         self.current_lock_pid = os.getpid()
+        
+        # Logs waiting for the writer thread, deque append/popleft do not need a lock
+        self.pending_logs = deque()
+        self.writer_pid = None  # the writer thread is only in the process that did launch it
+        self.last_flush = 0
+        self.not_flushed_size = 0
     
     
     # Get (NOT aquire) current lock, but beware: if we did change process, recreate it
@@ -227,8 +247,8 @@ class Logger(object):
         return self.last_errors_stack
     
     
-    def __get_time_display(self):
-        now = int(time.time())
+    def __get_time_display(self, t):
+        now = int(t)
         # Cache hit or not?
         if now == self.last_date_print_time:
             return self.last_date_print_value
@@ -303,7 +323,10 @@ class Logger(object):
     
     def _get_log_file_and_rotate_it_if_need(self, part):
         self._check_log_rotation()
-        
+        return self._get_log_file(part)
+    
+    
+    def _get_log_file(self, part):
         # classic part log
         f = self.logs.get(part, None)
         if f is None:  # was rotated or maybe rotated
@@ -313,22 +336,43 @@ class Logger(object):
         return self.logs[part]
     
     
+    # The logs are formatted only when written, by the writer thread if launched (and if we
+    # are not in a sub-process), or here if not
     def log(self, *args, **kwargs):
+        record = (time.time(), kwargs.get('level', 'UNSET  '), kwargs.get('part', DEFAULT_LOG_PART), args, kwargs.get('color', None),
+                  kwargs.get('do_print', True), kwargs.get('stack', False), kwargs.get('listener', ''))
+        if self.writer_pid == os.getpid():
+            self.pending_logs.append(record)
+            return
         # We must protect logs against thread access, and even sub-process ones
         with self._get_lock():
-            part = kwargs.get('part', DEFAULT_LOG_PART)
-            s_part = '' if not part else '[%s]' % part.upper()
-            
-            d_display = self.__get_time_display()
-            s = '[%s][%s][%s] %s: %s' % (d_display, kwargs.get('level', 'UNSET  '), self.name, s_part, u' '.join([get_unicode_string(s) for s in args]))
+            self.__write_records([record], force_flush=True)
+    
+    
+    def __format_record(self, record):
+        t, level, part, args, _, _, _, _ = record
+        s_part = '' if not part else '[%s]' % part.upper()
+        try:
+            message = u' '.join([get_unicode_string(s) for s in args])
+        except Exception as exp:  # the args can be changed by another thread since the log call
+            message = u'(cannot format the log: %s)' % exp
+        return '[%s][%s][%s] %s: %s' % (self.__get_time_display(t), level, self.name, s_part, message)
+    
+    
+    # Write logs, with only one write by part file and listener, and the rotation checked once
+    def __write_records(self, records, force_flush=False):
+        by_parts = {}
+        by_listeners = {}
+        for record in records:
+            s = self.__format_record(record)
+            _, _, part, _, color, do_print, stack, listener = record
             
             # Sometime we want a log output, but not in the stdout
-            if kwargs.get('do_print', True):
-                if 'color' in kwargs:
-                    cprint(s, color=kwargs['color'])
+            if do_print:
+                if color is not None:
+                    cprint(s, color=color)
                 else:
                     print(s)
-            stack = kwargs.get('stack', False)
             
             # Not a perf problems as it's just for errors and a limited size
             if stack:
@@ -338,25 +382,89 @@ class Logger(object):
             
             # if no data_dir, we cannot save anything...
             if self.data_dir == '':
-                return
+                continue
             s = s + '\n'
-            
-            # Now get the log file and write into it
-            # NOTE: if need, will rotate all files
-            f = self._get_log_file_and_rotate_it_if_need(part)
-            f.write(s)
+            if part not in by_parts:
+                by_parts[part] = []
+            by_parts[part].append(s)
+            if listener:
+                if listener not in by_listeners:
+                    by_listeners[listener] = []
+                by_listeners[listener].append(s)
+        
+        if not by_parts:
+            return
+        
+        # NOTE: if need, will rotate all files
+        self._check_log_rotation()
+        for (part, lines) in by_parts.items():
+            data = u''.join(lines)
+            f = self._get_log_file(part)
+            f.write(data)
+            self.not_flushed_size += len(data)
+        
+        now = time.time()
+        if force_flush or self.not_flushed_size >= LOG_FLUSH_SIZE or now - self.last_flush >= LOG_FLUSH_INTERVAL:
+            self.__flush(now)
+        
+        # Now update the log listeners if exists
+        for (listener, lines) in by_listeners.items():
+            if not hasattr(os, 'O_NONBLOCK'):  # no named pipe on windows
+                break
+            try:
+                fd = os.open(listener, os.O_WRONLY | os.O_NONBLOCK)
+                os.write(fd, u''.join(lines).encode('utf8'))
+                os.close(fd)
+            except Exception as exp:  # maybe the path did just disapear
+                f = self._get_log_file(DEFAULT_LOG_PART)
+                f.write("ERROR LISTERNER %s\n" % exp)
+    
+    
+    def __flush(self, now):
+        for f in self.logs.values():
             f.flush()
-            
-            # Now update the log listener if exis
-            listener = kwargs.get('listener', '')
-            if listener and hasattr(os, 'O_NONBLOCK') and f is not None:  # no named pipe on windows
-                try:
-                    fd = os.open(listener, os.O_WRONLY | os.O_NONBLOCK)
-                    os.write(fd, s)
-                    os.close(fd)
-                except Exception as exp:  # maybe the path did just disapear
-                    s = "ERROR LISTERNER %s" % exp
-                    f.write(s)
+        self.last_flush = now
+        self.not_flushed_size = 0
+    
+    
+    # Write the pending logs, in batches
+    def __write_pending_logs(self):
+        did_write = False
+        while self.pending_logs:
+            records = []
+            while self.pending_logs and len(records) < LOG_BATCH_SIZE:
+                records.append(self.pending_logs.popleft())
+            with self._get_lock():
+                self.__write_records(records)
+            did_write = True
+        return did_write
+    
+    
+    def do_writer_thread(self):
+        while True:
+            if self.__write_pending_logs():
+                continue
+            # Nothing to write: maybe some logs are still not flushed
+            now = time.time()
+            if self.not_flushed_size and now - self.last_flush >= LOG_FLUSH_INTERVAL:
+                with self._get_lock():
+                    self.__flush(now)
+            time.sleep(LOG_WRITER_WAIT)
+    
+    
+    # At exit, or if a sub process want them, write all the stacked logs
+    def flush(self):
+        self.__write_pending_logs()
+        with self._get_lock():
+            self.__flush(time.time())
+    
+    
+    # Once launched, the logs are stacked and written by a dedicated thread
+    def launch_writer(self):
+        from .threadmgr import threader
+        self.writer_pid = os.getpid()
+        threader.create_and_launch(self.do_writer_thread, name='Log writer', essential=True, part='agent')
+        atexit.register(self.flush)
     
     
     def do_debug(self, *args, **kwargs):
@@ -394,11 +502,22 @@ class PartLogger(object):
     def __init__(self, part):
         self.part = part
         self.listener_path = '/tmp/opsbro-follow-%s' % part
+        self.is_followed = False
+        self.last_listener_check = 0
+    
+    
+    # Look if the cli is following this part (it creates the listener named pipe), but not at each log
+    def __is_followed(self):
+        now = time.time()
+        if now - self.last_listener_check >= LISTENER_CHECK_INTERVAL:
+            self.is_followed = os.path.exists(self.listener_path)
+            self.last_listener_check = now
+        return self.is_followed
     
     
     def debug(self, *args, **kwargs):
         kwargs['part'] = kwargs.get('part', self.part)
-        if os.path.exists(self.listener_path):
+        if self.__is_followed():
             kwargs['listener'] = self.listener_path
             kwargs['level'] = 'DEBUG  '
             core_logger.log(*args, color='magenta', **kwargs)
@@ -408,7 +527,7 @@ class PartLogger(object):
     
     def info(self, *args, **kwargs):
         kwargs['part'] = kwargs.get('part', self.part)
-        if os.path.exists(self.listener_path):
+        if self.__is_followed():
             kwargs['listener'] = self.listener_path
             kwargs['level'] = 'INFO   '
             core_logger.log(*args, color='blue', **kwargs)
@@ -418,7 +537,7 @@ class PartLogger(object):
     
     def warning(self, *args, **kwargs):
         kwargs['part'] = kwargs.get('part', self.part)
-        if os.path.exists(self.listener_path):
+        if self.__is_followed():
             kwargs['listener'] = self.listener_path
             kwargs['level'] = 'WARNING'
             core_logger.log(*args, color='yellow', **kwargs)
@@ -428,7 +547,7 @@ class PartLogger(object):
     
     def error(self, *args, **kwargs):
         kwargs['part'] = kwargs.get('part', self.part)
-        if os.path.exists(self.listener_path):
+        if self.__is_followed():
             kwargs['listener'] = self.listener_path
             kwargs['level'] = 'ERROR  '
             core_logger.log(*args, color='red', **kwargs)
@@ -438,7 +557,7 @@ class PartLogger(object):
     
     def log(self, *args, **kwargs):
         kwargs['part'] = kwargs.get('part', self.part)
-        if os.path.exists(self.listener_path):
+        if self.__is_followed():
             kwargs['listener'] = self.listener_path
             core_logger.log(*args, **kwargs)
             return
@@ -404,6 +404,23 @@ class SqliteMultithread(Thread):
                 conn.commit()
                 if res:
                     res.put('--no more--')
+            elif req == '--batch--':
+                # all the (req, items) in one transaction, see execute_batch
+                try:
+                    if not self.autocommit:
+                        conn.commit()
+                    cursor.execute('BEGIN')
+                    try:
+                        for (batch_req, items) in arg:
+                            cursor.executemany(batch_req, items)
+                        cursor.execute('COMMIT')
+                    except Exception:
+                        cursor.execute('ROLLBACK')
+                        raise
+                except Exception:
+                    self.exception = sys.exc_info()
+                    self.log.error('Exception during a batch, will be re-raised')
+                res.put('--no more--')
             else:
                 try:
                     cursor.execute(req, arg)
@@ -496,6 +513,18 @@ class SqliteMultithread(Thread):
             self.execute(req, item)
         self.check_raise_error()
 
+    def execute_batch(self, reqs):
+        """
+        Run each (req, items) with executemany, all in one transaction, and wait for it.
+        Raise the error if the transaction did fail (and so was rolled back).
+        """
+        self.check_raise_error()
+        res = Queue()
+        stack = traceback.extract_stack()[:-1]
+        self.reqs.put(('--batch--', reqs, res, stack))
+        res.get()
+        self.check_raise_error()
+
     def select(self, req, arg=None):
         """
         Unlike sqlite's native select, this select doesn't handle iteration efficiently.
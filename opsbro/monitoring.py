@@ -4,9 +4,15 @@ import tempfile
 import shutil
 import copy
 import time
-import random
-import socket
 import hashlib
+import heapq
+import threading
+import traceback
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 
 from .log import LoggerFactory
 from .gossip import gossiper
@@ -20,7 +26,8 @@ from .handlermgr import handlermgr
 from .topic import topiker, TOPIC_MONITORING
 from .basemanager import BaseManager
 from .jsonmgr import jsoner
-from .util import exec_command
+from .udptransport import udptransport
+from .util import exec_command, parse_duration, unicode_to_bytes
 
 # Global logger for this part
 logger = LoggerFactory.create_logger('monitoring')
@@ -29,6 +36,18 @@ CHECK_STATES = ['ok', 'warning', 'critical', 'unknown', 'pending']
 STATE_ID_COLORS = {0: 'green', 2: 'red', 1: 'yellow', 3: 'cyan'}
 STATE_COLORS = {'ok': 'green', 'warning': 'yellow', 'critical': 'red', 'unknown': 'grey', 'pending': 'grey'}
 
+DEFAULT_CHECK_INTERVAL = 10
+DEFAULT_CHECK_TIMEOUT = 30
+
+# Number of threads that are running the checks, by lane: the expression checks are only
+# evaluations in memory, the script ones are mostly waiting for their sub-process
+NB_EXPRESSION_CHECK_WORKERS = 2
+NB_SCRIPT_CHECK_WORKERS = 8
+
+# Properties of the checks and services that are saved in the retention
+CHECK_RETENTION_PROPERTIES = ('last_check', 'output', 'state', 'state_id', 'old_state', 'old_state_id')
+SERVICE_RETENTION_PROPERTIES = ('state_id', 'incarnation')
+
 
 class MonitoringManager(BaseManager):
     history_directory_suffix = 'monitoring'
@@ -46,6 +65,25 @@ class MonitoringManager(BaseManager):
         
         # Compile the macro pattern once
         self.macro_pat = re.compile(r'(\$ *(.*?) *\$)+')
+        
+        # heap of (next_run, check id), so we only look at the checks we need to launch
+        self.checks_schedule = []
+        # check id -> schedule entry, with the interval and timeout already parsed
+        self.checks_schedule_entries = {}
+        # the active checks did change, so the schedule must be computed again
+        self.checks_schedule_need_rebuild = True
+        # checks to run, for the workers
+        self.expression_checks_queue = Queue()
+        self.script_checks_queue = Queue()
+        self.check_workers_launched = False
+        
+        # checks and services that did change since the last retention write
+        self.retention_lock = threading.RLock()
+        self.retention_dirty_checks = set()
+        self.retention_dirty_services = set()
+        
+        # Increased each time a check or service did change, so the http responses can be cached
+        self.state_version = 0
     
     
     def load(self, cfg_dir, cfg_data):
@@ -87,6 +125,7 @@ class MonitoringManager(BaseManager):
         check['variables'] = check.get('variables', {})
         check['computed_variables'] = {}
         self.checks[check['id']] = check
+        self.state_version += 1
     
     
     # We have a new check from the HTTP, save it where it need to be
@@ -130,7 +169,7 @@ class MonitoringManager(BaseManager):
                 pass
         
         o = {'check': check}
-        logger.debug('HTTP check saving the object %s into the file %s' % (o, p))
+        logger.debug('HTTP check saving the object', o, 'into the file', p)
         buf = jsoner.dumps(o, sort_keys=True, indent=4)
         tempdir = tempfile.mkdtemp()
         f = open(os.path.join(tempdir, 'temp.json'), 'w')
@@ -170,36 +209,51 @@ class MonitoringManager(BaseManager):
         
         # Add it into the services list
         self.services[service['id']] = service
+        self.state_version += 1
     
     
-    def load_check_retention(self, check_retention):
-        if not os.path.exists(check_retention):
-            return
-        
-        logger.log('CHECK loading check retention file %s' % check_retention)
-        with open(check_retention, 'r') as f:
-            loaded = jsoner.loads(f.read())
-            for (cid, c) in loaded.items():
-                if cid in self.checks:
-                    check = self.checks[cid]
-                    to_load = ['last_check', 'output', 'state', 'state_id', 'old_state', 'old_state_id']
-                    for prop in to_load:
-                        check[prop] = c[prop]
+    def load_check_retention(self, loaded):
+        for (cid, c) in loaded.items():
+            if cid in self.checks:
+                check = self.checks[cid]
+                for prop in CHECK_RETENTION_PROPERTIES:
+                    check[prop] = c[prop]
+        self.state_version += 1
     
     
-    def load_service_retention(self, service_retention):
-        if not os.path.exists(service_retention):
-            return
-        
-        logger.log('Service loading service retention file %s' % service_retention)
-        with open(service_retention, 'r') as f:
-            loaded = jsoner.loads(f.read())
-            for (cid, c) in loaded.items():
-                if cid in self.services:
-                    service = self.services[cid]
-                    to_load = ['state_id', 'incarnation']
-                    for prop in to_load:
-                        service[prop] = c[prop]
+    def load_service_retention(self, loaded):
+        for (cid, c) in loaded.items():
+            if cid in self.services:
+                service = self.services[cid]
+                for prop in SERVICE_RETENTION_PROPERTIES:
+                    service[prop] = c[prop]
+        self.state_version += 1
+    
+    
+    @staticmethod
+    def __get_retention_entry(e, properties):
+        return dict((prop, e[prop]) for prop in properties)
+    
+    
+    def get_check_retention(self):
+        return dict((cid, self.__get_retention_entry(check, CHECK_RETENTION_PROPERTIES)) for (cid, check) in list(self.checks.items()))
+    
+    
+    def get_service_retention(self):
+        return dict((sid, self.__get_retention_entry(service, SERVICE_RETENTION_PROPERTIES)) for (sid, service) in list(self.services.items()))
+    
+    
+    # Only the checks that did change since the last call
+    def pop_check_retention_changes(self):
+        with self.retention_lock:
+            dirty, self.retention_dirty_checks = self.retention_dirty_checks, set()
+        return dict((cid, self.__get_retention_entry(self.checks[cid], CHECK_RETENTION_PROPERTIES)) for cid in dirty if cid in self.checks)
+    
+    
+    def pop_service_retention_changes(self):
+        with self.retention_lock:
+            dirty, self.retention_dirty_services = self.retention_dirty_services, set()
+        return dict((sid, self.__get_retention_entry(self.services[sid], SERVICE_RETENTION_PROPERTIES)) for sid in dirty if sid in self.services)
     
     
     # We have a new service from the HTTP, save it where it need to be
@@ -232,7 +286,7 @@ class MonitoringManager(BaseManager):
                 pass
         
         o = {'service': service}
-        logger.debug('HTTP service saving the object %s into the file %s' % (o, p))
+        logger.debug('HTTP service saving the object', o, 'into the file', p)
         buf = jsoner.dumps(o, sort_keys=True, indent=4)
         tempdir = tempfile.mkdtemp()
         f = open(os.path.join(tempdir, 'temp.json'), 'w')
@@ -269,6 +323,7 @@ class MonitoringManager(BaseManager):
                 if_group = service.get('if_group', '')
                 if if_group and if_group in groups:
                     node['services'][sname] = service
+        self.state_version += 1
     
     
     # For checks we will only populate our active_checks list
@@ -293,6 +348,8 @@ class MonitoringManager(BaseManager):
                     continue
                 checks_entry[cname] = {'state_id': check['state_id']}  # by default state are unknown
             node['checks'] = checks_entry
+            self.checks_schedule_need_rebuild = True
+        self.state_version += 1
     
     
     def __get_variables(self, check):
@@ -366,8 +423,8 @@ class MonitoringManager(BaseManager):
         return (founded, d)
     
     
-    # Launch a check sub-process as a thread
-    def launch_check(self, check):
+    # Launch a check, from a check worker thread
+    def launch_check(self, check, timeout=None):
         # If critical_if available, try it
         critical_if = check.get('critical_if')
         warning_if = check.get('warning_if')
@@ -423,11 +480,15 @@ class MonitoringManager(BaseManager):
                 script = script.replace(to_repl, change_to)
             logger.debug("MACRO finally computed", script)
             
-            rc, output, err = exec_command(script)
+            rc, output, err = exec_command(script, timeout=timeout)
+            # killed by a signal, like at the timeout
+            if rc < 0:
+                output = 'UNKNOWN: the check was killed after its %ss timeout (signal %d)' % (timeout, -rc)
+                rc = 3
             # not found error like (127) should be catch as unknown check
             if rc > 3:
                 rc = 3
-        logger.debug("CHECK RETURN %s : %s %s %s" % (check['id'], rc, output, err))
+        logger.debug('CHECK RETURN', check['id'], ':', rc, output, err)
         did_change = (check['state_id'] != rc)
         if did_change:
             # Then save the old state values
@@ -442,7 +503,10 @@ class MonitoringManager(BaseManager):
         
         check['output'] = output + err
         check['last_check'] = int(time.time())
+        with self.retention_lock:
+            self.retention_dirty_checks.add(check['id'])
         self.__analyse_check(check, did_change)
+        self.state_version += 1
         
         # Launch the handlers, some need the data if the element did change or not
         handlermgr.launch_check_handlers(check, did_change)
@@ -459,7 +523,7 @@ class MonitoringManager(BaseManager):
     # get a check return and look it it did change a service state. Also save
     # the result in the __health KV
     def __analyse_check(self, check, did_change):
-        logger.debug('CHECK we got a check return, deal with it for %s' % check)
+        logger.debug('CHECK we got a check return, deal with it for', check)
         
         # if did change, update the node check entry about it
         if did_change:
@@ -476,11 +540,13 @@ class MonitoringManager(BaseManager):
         sname = check.get('service', '')
         if sname and sname in self.services:
             service = self.services.get(sname)
-            logger.debug('CHECK is related to a service, deal with it! %s => %s' % (check, service))
+            logger.debug('CHECK is related to a service, deal with it!', check, '=>', service)
             sstate_id = service.get('state_id')
             cstate_id = check.get('state_id')
             if cstate_id != sstate_id:
                 service['state_id'] = cstate_id
+                with self.retention_lock:
+                    self.retention_dirty_services.add(sname)
                 logger.log('CHECK: we got a service state change from %s to %s for %s' % (sstate_id, cstate_id, service['name']))
                 warn_about_our_change = True
             else:
@@ -498,7 +564,7 @@ class MonitoringManager(BaseManager):
     def put_check(self, check):
         value = jsoner.dumps(check)
         key = '__health/%s/%s' % (gossiper.uuid, check['name'])
-        logger.debug('CHECK SAVING %s:%s(len=%d)' % (key, value, len(value)))
+        logger.debug('CHECK SAVING', key, value, '(len=%d)' % len(value))
         kvmgr.put_key(key, value, allow_udp=True)
         
         # Now groking metrics from check
@@ -544,46 +610,133 @@ class MonitoringManager(BaseManager):
         kvmgr.put_key(key, all_checks)
     
     
-    # Main thread for launching checks (each with its own thread)
+    # Each check have its own stable jitter, between 0.9 and 1.1 of its interval, so the checks
+    # with the same interval are not all launched at the same time, but keep their rythm
+    @staticmethod
+    def __get_check_jitter(cid):
+        h = int(hashlib.md5(unicode_to_bytes(cid)).hexdigest()[:8], 16)
+        return 0.9 + 0.2 * (h % 1000) / 1000.0
+    
+    
+    # Parse the interval and timeout of the active checks and compute their next run
+    # NOTE: the existing entries are updated, as a worker can be running them
+    def __rebuild_checks_schedule(self, now):
+        self.checks_schedule_need_rebuild = False
+        entries = {}
+        schedule = []
+        for cid in self.active_checks:
+            check = self.checks.get(cid, None)
+            if check is None:
+                continue
+            try:
+                interval = parse_duration(check['interval'])
+                timeout = parse_duration(check.get('timeout', DEFAULT_CHECK_TIMEOUT))
+            except (ValueError, TypeError, AttributeError):
+                logger.error('CHECK: the check %s have an invalid interval (%s) or timeout (%s), using the default ones' % (cid, check['interval'], check.get('timeout', '')))
+                interval, timeout = DEFAULT_CHECK_INTERVAL, DEFAULT_CHECK_TIMEOUT
+            interval = max(1, interval * self.__get_check_jitter(cid))
+            e = self.checks_schedule_entries.get(cid, None)
+            if e is None or e['check'] is not check:
+                next_run = check['last_check'] + interval
+                if e is None:
+                    e = {'id': cid, 'queued': False, 'running_since': 0, 'overrun': False}
+            else:
+                next_run = e['next_run']
+            e['check'] = check
+            e['interval'] = interval
+            e['timeout'] = timeout
+            e['is_script'] = not (check.get('critical_if') or check.get('warning_if'))
+            e['next_run'] = max(next_run, now)
+            entries[cid] = e
+            schedule.append((e['next_run'], cid))
+        heapq.heapify(schedule)
+        self.checks_schedule_entries = entries
+        self.checks_schedule = schedule
+    
+    
+    def __launch_check_workers(self):
+        if self.check_workers_launched:
+            return
+        self.check_workers_launched = True
+        for i in range(NB_EXPRESSION_CHECK_WORKERS):
+            threader.create_and_launch(self.do_check_worker, name='check-expression-worker-%d' % i, essential=True, part='monitoring', args=(self.expression_checks_queue,))
+        for i in range(NB_SCRIPT_CHECK_WORKERS):
+            threader.create_and_launch(self.do_check_worker, name='check-script-worker-%d' % i, essential=True, part='monitoring', args=(self.script_checks_queue,))
+    
+    
+    def do_check_worker(self, q):
+        while not stopper.is_stop():
+            try:
+                e = q.get(timeout=1)
+            except Empty:
+                continue
+            e['running_since'] = time.time()
+            e['queued'] = False
+            logger.debug('CHECK: launching check %s' % e['id'])
+            try:
+                self.launch_check(e['check'], timeout=e['timeout'])
+            except Exception:
+                logger.error('CHECK: the check %s did fail: %s' % (e['id'], traceback.format_exc()))
+            finally:
+                e['running_since'] = 0
+                e['overrun'] = False
+    
+    
+    # An expression check cannot be killed (it's a thread), but we can flag it
+    # NOTE: the script checks are killed at their timeout
+    def __look_for_checks_overruns(self, now):
+        for e in self.checks_schedule_entries.values():
+            running_since = e['running_since']
+            if not running_since or e['overrun']:
+                continue
+            if now - running_since > e['timeout']:
+                e['overrun'] = True
+                logger.warning('CHECK: the check %s is running since %ds, more than its %ss timeout' % (e['id'], now - running_since, e['timeout']))
+    
+    
+    def __launch_due_checks(self, now):
+        if self.checks_schedule_need_rebuild:
+            self.__rebuild_checks_schedule(now)
+        self.__look_for_checks_overruns(now)
+        
+        schedule = self.checks_schedule
+        while schedule and schedule[0][0] <= now:
+            next_run, cid = heapq.heappop(schedule)
+            e = self.checks_schedule_entries.get(cid, None)
+            # the check was removed or rescheduled
+            if e is None or e['next_run'] != next_run:
+                continue
+            # Keep the same rythm, but if we are too late, do not try to catch up with a burst of runs
+            next_run += e['interval']
+            if next_run <= now:
+                next_run = now + e['interval']
+            e['next_run'] = next_run
+            heapq.heappush(schedule, (next_run, cid))
+            
+            # maybe the check is already running, skip this turn
+            if e['queued'] or e['running_since']:
+                logger.debug('CHECK: skipping check %s as its previous run is not finished' % cid)
+                continue
+            e['queued'] = True
+            if e['is_script']:
+                self.script_checks_queue.put(e)
+            else:
+                self.expression_checks_queue.put(e)
+    
+    
+    # Main thread for launching checks, they are run by the check workers
     def do_check_thread(self):
         # Before run, be sure we have a history directory ready
         self.prepare_history_directory()
         
         logger.log('CHECK thread launched')
-        cur_launchs = {}
+        self.__launch_check_workers()
         while not stopper.is_stop():
             # If we are not allowed to do monitoring stuff, do nothing
             if not topiker.is_topic_enabled(TOPIC_MONITORING):
                 time.sleep(1)
                 continue
-            now = int(time.time())
-            for (cid, check) in self.checks.items():
-                # maybe this chck is not a activated one for us, if so, bail out
-                if cid not in self.active_checks:
-                    continue
-                # maybe a check is already running
-                if cid in cur_launchs:
-                    continue
-                # else look at the time
-                last_check = check['last_check']
-                interval = int(check['interval'].split('s')[0])  # todo manage like it should
-                # in the conf reading phase
-                interval = random.randint(int(0.9 * interval), int(1.1 * interval))
-                
-                if last_check < now - interval:
-                    # randomize a bit the checks
-                    script = check['script']
-                    logger.debug('CHECK: launching check %s:%s' % (cid, script))
-                    t = threader.create_and_launch(self.launch_check, name='check-%s' % cid, args=(check,), part='monitoring')
-                    cur_launchs[cid] = t
-            
-            to_del = []
-            for (cid, t) in cur_launchs.items():
-                if not t.is_alive():
-                    t.join()
-                    to_del.append(cid)
-            for cid in to_del:
-                del cur_launchs[cid]
+            self.__launch_due_checks(time.time())
             
             # each seconds we try to look if there are history info to save
             self.write_history_entry()
@@ -634,11 +787,8 @@ class MonitoringManager(BaseManager):
                 packets.append(buf)
             
             # UDP
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            for packet in packets:
-                # do NOT use the node['port'], it's the internal communication, not the graphite one!
-                sock.sendto(packet, (node['addr'], 2003))
-            sock.close()
+            # do NOT use the node['port'], it's the internal communication, not the graphite one!
+            udptransport.send_many([(packet, (node['addr'], 2003)) for packet in packets])
     
     
     def get_infos(self):
@@ -655,7 +805,7 @@ class MonitoringManager(BaseManager):
         from .httpdaemon import http_export, response, request, abort
         
         @http_export('/monitoring/state/:nuuid')
-        @http_export('/monitoring/state')
+        @http_export('/monitoring/state', cache_version=lambda: (self.state_version, gossiper.get_nodes_version()))
         def get_state(nuuid=''):
             response.content_type = 'application/json'
             r = {'checks': {}, 'services': {}}
@@ -696,7 +846,7 @@ class MonitoringManager(BaseManager):
                 return r
         
         
-        @http_export('/monitoring/checks')
+        @http_export('/monitoring/checks', cache_version=lambda: self.state_version)
         def agent_checks():
             response.content_type = 'application/json'
             return self.checks
@@ -729,7 +879,7 @@ class MonitoringManager(BaseManager):
             return
         
         
-        @http_export('/monitoring/services')
+        @http_export('/monitoring/services', cache_version=lambda: self.state_version)
         def agent_services():
             response.content_type = 'application/json'
             return self.services
@@ -763,7 +913,7 @@ class MonitoringManager(BaseManager):
         
         
         # We want a state of all our services, with the members
-        @http_export('/state/services')
+        @http_export('/state/services', cache_version=lambda: (self.state_version, gossiper.get_nodes_version()))
         def state_services():
             response.content_type = 'application/json'
             # We don't want to modify our services objects
@@ -0,0 +1,196 @@
+import io
+import threading
+
+from .misc.monotonic import monotonic
+from .collector import Collector
+
+# A sample younger than this is given again instead of reading the file, so all the
+# collectors share only one read even if their runs are spread over their interval
+SAMPLE_MAX_AGE = float(Collector.interval)
+
+# Rates computed on a shorter time are not precise (like the cpu counters that are in 1/100s),
+# so the collectors that compute rates have their first run at least this time after their baseline
+MIN_RATE_INTERVAL = 1.0
+
+# First read size, the buffer is grown if a file is bigger (like /proc/stat with a lot of cpus)
+INITIAL_BUFFER_SIZE = 16384
+
+# /proc/stat cpu columns
+CPU_COLUMNS = (r'%user', r'%nice', r'%system', r'%idle', r'%iowait', r'%irq', r'%softirq', r'%steal', r'%guest', r'%guest_nice')
+
+# /proc/diskstats columns we are interested in, and their index in the line
+# ref: http://lxr.osuosl.org/source/Documentation/iostats.txt
+DISK_COLUMNS = (('reads', 3), ('reads_merged', 4), ('read_sectors', 5), ('writes', 7), ('writes_merged', 8), ('write_sectors', 9), ('total_io_ms', 12))
+DISK_NB_COLUMNS = 14  # lines with another number of columns are partitions (old kernels)
+
+
+# A parsed file at a time (monotonic)
+class ProcFSSample(object):
+    __slots__ = ('values', 'time')
+    
+    
+    def __init__(self, values, sample_time):
+        self.values = values
+        self.time = sample_time
+
+
+# /proc/stat: cpu lines are in 'cpus' (cpu => cpu_all), the others int lines in 'counters'
+def parse_stat(lines):
+    cpus = {}
+    counters = {}
+    for line in lines:
+        elts = line.split()
+        if len(elts) < 2:
+            continue
+        name = elts[0]
+        if name.startswith('cpu'):
+            if name == 'cpu':
+                name = 'cpu_all'
+            cpus[name] = dict(zip(CPU_COLUMNS, [int(v) for v in elts[1:]]))
+        elif len(elts) == 2:
+            try:
+                counters[name] = int(elts[1])
+            except ValueError:  # not an int? skip this value
+                continue
+    return {'cpus': cpus, 'counters': counters}
+
+
+# /proc/vmstat: name value
+def parse_vmstat(lines):
+    r = {}
+    for line in lines:
+        elts = line.split()
+        if len(elts) != 2:
+            continue
+        try:
+            r[elts[0]] = int(elts[1])
+        except ValueError:
+            continue
+    return r
+
+
+# /proc/diskstats: device -> {column: value}
+def parse_diskstats(lines):
+    r = {}
+    for line in lines:
+        elts = line.split()
+        # NOTE: new kernels are adding discard/flush columns, we only need the first ones
+        if len(elts) < DISK_NB_COLUMNS:
+            continue
+        r[elts[2]] = dict((name, int(elts[idx])) for (name, idx) in DISK_COLUMNS)
+    return r
+
+
+# /proc/meminfo: lower case name -> value (kB for most of them)
+def parse_meminfo(lines):
+    r = {}
+    for line in lines:
+        name, _, value = line.partition(':')
+        elts = value.split()
+        if not elts:
+            continue
+        try:
+            r[name.lower()] = int(elts[0])
+        except ValueError:
+            continue
+    return r
+
+
+# /proc/net/dev: interface -> {recv_xxx/trans_xxx: value}, the columns are taken from the header line
+def parse_net_dev(lines):
+    r = {}
+    if len(lines) < 2:
+        return r
+    _, receive_cols, transmit_cols = lines[1].split('|')
+    cols = ['recv_' + c for c in receive_cols.split()] + ['trans_' + c for c in transmit_cols.split()]
+    for line in lines[2:]:
+        face, sep, data = line.partition(':')
+        if not sep:
+            continue
+        r[face.strip()] = dict(zip(cols, [int(v) for v in data.split()]))
+    return r
+
+
+# name -> (path, parser)
+SOURCES = {
+    'stat'     : ('/proc/stat', parse_stat),
+    'vmstat'   : ('/proc/vmstat', parse_vmstat),
+    'diskstats': ('/proc/diskstats', parse_diskstats),
+    'meminfo'  : ('/proc/meminfo', parse_meminfo),
+    'net_dev'  : ('/proc/net/dev', parse_net_dev),
+}
+
+
+# Read the procfs files for all the system collectors:
+# * a file is read only once by tick, whatever the number of collectors that need it
+# * each file have its own read buffer that is reused
+# * the previous sample is kept, so a collector that need a rate can have one at its first run
+#   if another collector did already read the file
+# NOTE: the samples values are shared, the collectors must not modify them
+class ProcFSSampler(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.buffers = {}
+        self.samples = {}  # name -> (current sample, previous sample)
+    
+    
+    def __read_file(self, path):
+        buf = self.buffers.get(path, None)
+        if buf is None:
+            buf = self.buffers[path] = bytearray(INITIAL_BUFFER_SIZE)
+        # procfs files do not give their size, so we read until the end, and grow the buffer if need
+        with io.open(path, 'rb', buffering=0) as f:
+            size = 0
+            while True:
+                if size == len(buf):
+                    buf.extend(bytearray(len(buf)))
+                    self.buffers[path] = buf
+                view = memoryview(buf)[size:]
+                n = f.readinto(view)
+                del view  # python3 cannot grow a buffer that still have a view
+                if not n:
+                    break
+                size += n
+        return bytes(buf[:size]).decode('utf8', 'replace').splitlines()
+    
+    
+    # Get the (current, previous) samples of a source, previous can be None. If force, the file
+    # is read even if the current sample is young
+    # Can raise IOError if the file cannot be read
+    def get_samples(self, name, force=False):
+        with self.lock:
+            now = monotonic()
+            current, previous = self.samples.get(name, (None, None))
+            if not force and current is not None and now - current.time < SAMPLE_MAX_AGE:
+                return current, previous
+            path, parser = SOURCES[name]
+            sample = ProcFSSample(parser(self.__read_file(path)), now)
+            self.samples[name] = (sample, current)
+            return sample, current
+    
+    
+    def get_sample(self, name):
+        return self.get_samples(name)[0]
+    
+    
+    # A first sample for a collector that compute rates, taken when it is loaded so its first
+    # run already have something to compare with. None if the file cannot be read
+    def get_baseline(self, name):
+        try:
+            return self.get_sample(name)
+        except IOError:
+            return None
+    
+    
+    # For collectors that compute rates: give the new sample, and the one to compare with, the
+    # collector one if it already have one, or the sampler previous one if not
+    def get_samples_since(self, name, last_sample):
+        current, previous = self.get_samples(name)
+        # this collector did already use this sample, it need a new one
+        if last_sample is current:
+            current, previous = self.get_samples(name, force=True)
+        since = last_sample if last_sample is not None else previous
+        return current, since
+
+
+procfs_sampler = ProcFSSampler()
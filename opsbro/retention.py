@@ -0,0 +1,124 @@
+import os
+
+from .jsonmgr import jsoner
+from .log import LoggerFactory, DEFAULT_LOG_PART
+
+# Global logger for this part
+logger = LoggerFactory.create_logger(DEFAULT_LOG_PART)
+
+# The log is rewritten with only the current items when it is this ratio bigger than them,
+# and at least this size
+RETENTION_COMPACT_RATIO = 2
+RETENTION_COMPACT_MIN_SIZE = 64 * 1024
+
+
+def _encode_line(key, item):
+    line = '%s\t%s\n' % (jsoner.dumps(key), jsoner.dumps(item))
+    if not isinstance(line, bytes):
+        line = line.encode('utf8')
+    return line
+
+
+# Retention of a section (checks, services, collectors...) as an append only file of
+# "key<TAB>item" json lines, the last line of a key wins. So only the items that did change
+# since the last write are written, and the file is compacted when it is too big.
+# When loading, only the last line of each key is parsed.
+class RetentionLog(object):
+    def __init__(self, path, old_path=None):
+        self.path = path
+        # The json dump of all the items of the previous versions, imported if we do not have a log
+        self.old_path = old_path
+        self.sizes = {}  # key -> size of its last line
+        self.file_size = 0
+        # No log yet, or a write did fail: next write is a full one
+        self.need_full_write = True
+    
+    
+    # Give the key -> item of the last write
+    def load(self):
+        if not os.path.exists(self.path):
+            return self.__load_old()
+        last_lines = {}
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                # a line without its end is an item we did not finish to write
+                if not line.endswith(b'\n'):
+                    break
+                last_lines[line.split(b'\t', 1)[0]] = line
+                offset += len(line)
+        if offset != os.path.getsize(self.path):
+            logger.warning('The retention file %s is truncated after %d bytes' % (self.path, offset))
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+        items = {}
+        for (raw_key, line) in last_lines.items():
+            try:
+                key = jsoner.loads(raw_key.decode('utf8'))
+                items[key] = jsoner.loads(line[len(raw_key) + 1:].decode('utf8'))
+            except ValueError as exp:
+                logger.error('Bad entry in the retention file %s: %s' % (self.path, exp))
+                continue
+            self.sizes[key] = len(line)
+        self.file_size = offset
+        self.need_full_write = False
+        return items
+    
+    
+    def __load_old(self):
+        if self.old_path is None or not os.path.exists(self.old_path):
+            return {}
+        logger.info('Importing the old retention file %s' % self.old_path)
+        try:
+            with open(self.old_path, 'r') as f:
+                return jsoner.loads(f.read())
+        except (IOError, ValueError) as exp:
+            logger.error('Cannot load the old retention file %s: %s' % (self.old_path, exp))
+            return {}
+    
+    
+    # Append the changed items (key -> item). get_all_items() must give all the current items, it is
+    # only called if the log must be rewritten
+    def write(self, changes, get_all_items):
+        try:
+            if self.need_full_write or self.__need_compact():
+                self.__write_all(get_all_items())
+                return
+            if not changes:
+                return
+            lines = []
+            for (key, item) in changes.items():
+                line = _encode_line(key, item)
+                self.sizes[key] = len(line)
+                lines.append(line)
+            data = b''.join(lines)
+            with open(self.path, 'ab') as f:
+                f.write(data)
+            self.file_size += len(data)
+        except (IOError, OSError) as exp:
+            logger.error('Cannot write the retention file %s: %s' % (self.path, exp))
+            self.need_full_write = True
+    
+    
+    def __need_compact(self):
+        live_size = sum(self.sizes.values())
+        return self.file_size > RETENTION_COMPACT_MIN_SIZE and self.file_size > RETENTION_COMPACT_RATIO * live_size
+    
+    
+    def __write_all(self, items):
+        sizes = {}
+        lines = []
+        for (key, item) in items.items():
+            line = _encode_line(key, item)
+            sizes[key] = len(line)
+            lines.append(line)
+        data = b''.join(lines)
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(self.path + '.tmp', self.path)
+        self.sizes = sizes
+        self.file_size = len(data)
+        self.need_full_write = False
+        # the old file is now useless
+        if self.old_path is not None and os.path.exists(self.old_path):
+            os.unlink(self.old_path)
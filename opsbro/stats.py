@@ -1,53 +1,154 @@
-import socket
+import time
+import bisect
+import threading
 
-from .util import string_encode
+# Timers buckets upper bounds, in ms. The last bucket is for all the bigger values
+TIMER_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
 
-UDP_IP = "192.168.56.104"
-UDP_PORT = 18125  # curently disable
+# Every this seconds, the metrics are given to the time series if enabled
+TS_PUSH_INTERVAL = 10
 
 
-### Don't espect this part to work on your server without modifing the IP :)
-
-
-# gauge = ' moncul.cpu.used : 90 |g'
-# counter = ' mabite : 2 |c|@0.1'
-# timer = ' montimer : 0.001 | ms'
+# Metrics of one thread. Only its thread is writing in it, so no lock is need
+class StatsShard(object):
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}  # name -> [bucket counts, count, sum]
+    
+    
+    def incr(self, k, v):
+        counters = self.counters
+        counters[k] = counters.get(k, 0) + v
+    
+    
+    def timer(self, k, v):
+        t = self.timers.get(k, None)
+        if t is None:
+            t = self.timers[k] = [[0] * (len(TIMER_BUCKETS) + 1), 0, 0.0]
+        t[0][bisect.bisect_left(TIMER_BUCKETS, v)] += 1
+        t[1] += 1
+        t[2] += v
 
 
+# In process metrics of the agent:
+# * counters, incremented with incr
+# * gauges, set with gauge
+# * timers (in ms), with their count, sum and counts by fixed buckets
+# Each thread writes in its own shard, and the shards are only merged when the metrics are read.
 class Stats(object):
     def __init__(self):
-        self.stats = {}
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.buf = []
+        self.shards = []
+        self.shards_lock = threading.RLock()
+        self.local = threading.local()
+        self.gauges = {}
     
     
-    def stack(self, s):
-        self.buf.append(s)
-        if len(self.buf) > 20:
-            pkt = string_encode('\n'.join(self.buf))
-            self.sock.sendto(pkt, (UDP_IP, UDP_PORT))
-            self.buf = []
+    def __get_shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = StatsShard()
+            with self.shards_lock:
+                self.shards.append(shard)
+        return shard
     
     
     # Will increment a stat key, if None, start at 0
-    def incr(self, k, v):
-        self.stats[k] = self.stats.get(k, 0) + v
-        s = '%s: %d |c' % (k, v)
-        self.stack(s)
+    def incr(self, k, v=1):
+        self.__get_shard().incr(k, v)
     
     
-    # Will increment a stat key, if None, start at 0
+    # Add a time (in ms) to a timer
     def timer(self, k, v):
-        s = '%s: %f |ms' % (k, v)
-        self.stack(s)
+        self.__get_shard().timer(k, v)
+    
+    
+    def gauge(self, k, v):
+        self.gauges[k] = v
+    
+    
+    def get_counters(self):
+        r = {}
+        with self.shards_lock:
+            shards = self.shards[:]
+        for shard in shards:
+            for (k, v) in list(shard.counters.items()):
+                r[k] = r.get(k, 0) + v
+        return r
+    
+    
+    def get_timers(self):
+        merged = {}
+        with self.shards_lock:
+            shards = self.shards[:]
+        for shard in shards:
+            for (k, t) in list(shard.timers.items()):
+                m = merged.get(k, None)
+                if m is None:
+                    m = merged[k] = [[0] * (len(TIMER_BUCKETS) + 1), 0, 0.0]
+                m[0] = [a + b for (a, b) in zip(m[0], t[0])]
+                m[1] += t[1]
+                m[2] += t[2]
+        r = {}
+        for (k, (buckets, count, total)) in merged.items():
+            bounds = list(TIMER_BUCKETS) + ['+Inf']
+            r[k] = {'count'  : count,
+                    'sum'    : total,
+                    'avg'    : total / count if count else 0.0,
+                    'buckets': [[bound, nb] for (bound, nb) in zip(bounds, buckets)],
+                    }
+        return r
+    
+    
+    def get_metrics(self):
+        return {'counters': self.get_counters(), 'gauges': dict(self.gauges), 'timers': self.get_timers()}
     
     
     def get(self, k):
-        return self.stats.get(k, 0)
+        return self.get_counters().get(k, 0)
     
     
     def show(self):
-        return ', '.join(['%s:%.4f' % (k, v) for (k, v) in self.stats.items()])
+        return ', '.join(['%s:%.4f' % (k, v) for (k, v) in self.get_counters().items()])
+    
+    
+    # Give our metrics to the local time series: counters and gauges values, and timers count and
+    # average since the last push
+    def do_ts_push_thread(self):
+        from .stop import stopper
+        from .gossip import gossiper
+        from .ts import tsmgr
+        last_timers = {}
+        while not stopper.is_stop():
+            time.sleep(TS_PUSH_INTERVAL)
+            now = int(time.time())
+            prefix = '%s.opsbro.' % gossiper.name
+            for (k, v) in self.get_counters().items():
+                tsmgr.tsb.add_value(now, prefix + k, v, local=True)
+            for (k, v) in list(self.gauges.items()):
+                tsmgr.tsb.add_value(now, prefix + k, v, local=True)
+            timers = self.get_timers()
+            for (k, t) in timers.items():
+                last_count, last_sum = last_timers.get(k, (0, 0.0))
+                count = t['count'] - last_count
+                tsmgr.tsb.add_value(now, prefix + k + '.count', count, local=True)
+                if count:
+                    tsmgr.tsb.add_value(now, prefix + k + '.avg', (t['sum'] - last_sum) / count, local=True)
+                last_timers[k] = (t['count'], t['sum'])
+    
+    
+    def launch_ts_push_thread(self):
+        from .threadmgr import threader
+        threader.create_and_launch(self.do_ts_push_thread, name='Agent metrics to time series', essential=True, part='agent')
+    
+    
+    def export_http(self):
+        from .httpdaemon import http_export, response
+        from .jsonmgr import jsoner
+        
+        @http_export('/agent/metrics')
+        def get_metrics():
+            response.content_type = 'application/json'
+            return jsoner.dumps(self.get_metrics())
 
 
 STATS = Stats()
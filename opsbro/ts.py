@@ -1,7 +1,11 @@
 import os
 import time
+import sys
+import math
 import threading
+import fnmatch
 import base64
+from array import array
 
 try:
     import cPickle as pickle
@@ -9,6 +13,9 @@ except ImportError:
     import pickle
 import json
 
+if sys.version_info >= (3,):
+    from sys import intern
+
 from .stats import STATS
 from .log import LoggerFactory
 from .threadmgr import threader
@@ -26,9 +33,182 @@ SERIALIZER = pickle
 logger = LoggerFactory.create_logger('time-series')
 
 
+# NaN is used as the "no value" in the arrays, and is given back as None in the records
+_NO_VALUE = float('nan')
+_NO_VALUE_60 = [_NO_VALUE] * 60
+_NO_VALUE_1440 = [_NO_VALUE] * 1440
+
+
+def _values_to_list(values):
+    # NOTE: NaN is the only value that is not equal to itself
+    return [(v if v == v else None) for v in values]
+
+
+# Copy the src[src_idx:src_idx+nb] values (array or records list with None) into dest array
+def _copy_values(dest, dest_idx, src, src_idx, nb):
+    chunk = src[src_idx:src_idx + nb]
+    if isinstance(chunk, list):
+        chunk = [(v if v is not None else _NO_VALUE) for v in chunk]
+    dest[dest_idx:dest_idx + nb] = array('d', chunk)
+
+
+# Same as _copy_values, but only in the dest slots without value
+def _fill_missing_values(dest, dest_idx, src, src_idx, nb):
+    for i in range(nb):
+        if dest[dest_idx + i] == dest[dest_idx + i]:
+            continue
+        v = src[src_idx + i]
+        if v is not None:
+            dest[dest_idx + i] = v
+
+
+# Graphite like glob: * ? and [] are allowed, but only inside a metric name part (between .)
+def _is_glob(target):
+    for c in '*?[':
+        if c in target:
+            return True
+    return False
+
+
+def _glob_prefix(target):
+    idx = min([i for i in (target.find(c) for c in '*?[') if i != -1])
+    return target[:idx]
+
+
+def _match_glob(pattern_parts, name):
+    name_parts = name.split('.')
+    if len(name_parts) != len(pattern_parts):
+        return False
+    for (name_part, pattern_part) in zip(name_parts, pattern_parts):
+        if not fnmatch.fnmatchcase(name_part, pattern_part):
+            return False
+    return True
+
+
+def _avg(values):
+    return sum(values) / float(len(values))
+
+
+CONSOLIDATION_FUNCTIONS = {'avg': _avg, 'average': _avg, 'min': min, 'max': max, 'sum': sum}
+
+
+# Give the (value, time) datapoints for values (array with NaN as no value) that start at start and
+# are separated by step seconds. If there are more than max_points values, we consolidate them
+# with the function (avg, min, max or sum) so we have no more than max_points points
+def consolidate(values, start, step, max_points=0, func='avg'):
+    nb = len(values)
+    if not max_points or nb <= max_points:
+        # NOTE: NaN is the only value that is not equal to itself
+        return [((v if v == v else None), start + i * step) for (i, v) in enumerate(values)]
+    f = CONSOLIDATION_FUNCTIONS[func]
+    points_size = int(math.ceil(nb / float(max_points)))
+    datapoints = []
+    for i in range(0, nb, points_size):
+        chunk = [v for v in values[i:i + points_size] if v == v]
+        datapoints.append(((f(chunk) if chunk else None), start + i * step))
+    return datapoints
+
+
+# Minute entry of a serie, with one value by second
+class MinuteBucket(object):
+    __slots__ = ('cur_min', 'sum', 'min', 'max', 'nb', 'ctime', 'values')
+    
+    
+    def __init__(self, cur_min, ctime):
+        self.cur_min = cur_min
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.nb = 0
+        self.ctime = ctime
+        self.values = array('d', _NO_VALUE_60)
+    
+    
+    def add(self, t_second, v):
+        self.values[t_second] = v
+        # Check if the new value change the min/max entry
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+        # And sum up the result so we will be able to compute the avg entry
+        self.sum += v
+        self.nb += 1
+    
+    
+    def get_avg(self):
+        if self.nb == 0:
+            return None
+        return self.sum / float(self.nb)
+    
+    
+    # Give the same dict than the one saved in the database
+    def to_record(self):
+        return {'cur_min': self.cur_min, 'sum': self.sum, 'min': self.min, 'max': self.max, 'values': _values_to_list(self.values),
+                'nb'     : self.nb, 'ctime': self.ctime, 'avg': self.get_avg()}
+
+
+# Hour or day entry of a serie, with the minutes averages as values
+class AggregateBucket(object):
+    __slots__ = ('start', 'sum', 'min', 'max', 'nb', 'values')
+    
+    
+    def __init__(self, start, size):
+        self.start = start
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.nb = 0
+        self.values = array('d', _NO_VALUE_60 if size == 60 else _NO_VALUE_1440)
+    
+    
+    # Merge a finished minute into it
+    def add_minute(self, minute, avg):
+        if self.min is None or minute.min < self.min:
+            self.min = minute.min
+        if self.max is None or minute.max > self.max:
+            self.max = minute.max
+        if avg is not None:
+            self.nb += 1
+            self.sum += avg
+            # We try to look at which minute we are in the bucket
+            self.values[(minute.cur_min - self.start) // 60] = avg
+    
+    
+    def get_avg(self):
+        if self.nb == 0:
+            return None
+        return self.sum / float(self.nb)
+    
+    
+    def get_values(self):
+        return _values_to_list(self.values)
+    
+    
+    # Give the same dict than the one saved in the database, start is 'hour' or 'day'
+    def to_record(self, start_key):
+        r = {start_key: self.start, 'sum': self.sum, 'min': self.min, 'max': self.max, 'values': self.get_values(), 'nb': self.nb}
+        if self.nb != 0:
+            r['avg'] = self.get_avg()
+        return r
+
+
+# All in memory entries for one metric
+class Serie(object):
+    __slots__ = ('name', 'minute', 'hour', 'day')
+    
+    
+    def __init__(self, name):
+        self.name = name
+        self.minute = None
+        self.hour = None
+        self.day = None
+
+
 class TSBackend(object):
     def __init__(self):
-        self.data = {}
+        # metric name (interned) -> Serie
+        self.series = {}
         self.data_lock = threading.RLock()
         self.max_data_age = 5 * 60  # number of seconds before an entry is declared too old and is forced archived
     
@@ -45,7 +225,6 @@ class TSBackend(object):
     
     def push_key(self, k, v, ttl=0, local=False):
         T0 = time.time()
-        STATS.incr('ts.graphite.push-key', 1)
         v64 = base64.b64encode(v)
         logger.debug("PUSH KEY", k, "and value", len(v64))
         # If we manage a local data (from collectors), manage directly
@@ -82,56 +261,137 @@ class TSBackend(object):
         return list(r)
     
     
+    def get_serie(self, key):
+        return self.series.get(key, None)
+    
+    
+    # Resolve the targets, with glob patterns, into the metric names we know, without duplicates
+    def expand_targets(self, targets):
+        res = []
+        founded = set()
+        for target in targets:
+            if _is_glob(target):
+                pattern_parts = target.split('.')
+                names = [name for name in self.list_keys(_glob_prefix(target)) if _match_glob(pattern_parts, name)]
+            else:
+                names = [target]
+            for name in names:
+                if name not in founded:
+                    founded.add(name)
+                    res.append(name)
+        return res
+    
+    
+    # Get a minute/hour/day record from the KV, or None if missing
+    @staticmethod
+    def get_record(key):
+        raw64 = kvmgr.get_key(key)
+        if raw64 is None:
+            return None
+        try:
+            return SERIALIZER.loads(base64.b64decode(raw64))
+        except Exception as exp:
+            logger.error('Cannot load the TS record %s: %s' % (key, exp))
+            return None
+    
+    
+    # Get the minute averages of a metric between start and end (both are round to the minute),
+    # as an array with NaN when there is no value.
+    # The current day and hour are taken from memory, and then the past days records. The minutes
+    # missing in the day (no record, or the day did start again after a restart) are looked for in
+    # the hour records.
+    def get_minutes_range(self, key, start, end):
+        start = (start // 60) * 60
+        end = (end // 60) * 60
+        nb_minutes = max(0, (end - start) // 60)
+        values = array('d', [_NO_VALUE]) * nb_minutes
+        
+        serie = self.series.get(key, None)
+        day_e = hour_e = None
+        if serie is not None:
+            day_e = serie.day
+            hour_e = serie.hour
+        
+        day = (start // 86400) * 86400
+        while day < end:
+            # The part of this day we want
+            from_t = max(start, day)
+            to_t = min(end, day + 86400)
+            if day_e is not None and day_e.start == day:
+                _copy_values(values, (from_t - start) // 60, day_e.values, (from_t - day) // 60, (to_t - from_t) // 60)
+            else:
+                record = self.get_record('%s::d%d' % (key, day))
+                if record is not None:
+                    _copy_values(values, (from_t - start) // 60, record['values'], (from_t - day) // 60, (to_t - from_t) // 60)
+            self.__fill_from_hours(key, values, start, from_t, to_t, hour_e)
+            day += 86400
+        return values
+    
+    
+    # Fill the values without a value between from_t and to_t from the hours
+    def __fill_from_hours(self, key, values, start, from_t, to_t, hour_e):
+        hour = (from_t // 3600) * 3600
+        while hour < to_t:
+            h_from_t = max(from_t, hour)
+            h_to_t = min(to_t, hour + 3600)
+            dest_idx = (h_from_t - start) // 60
+            nb = (h_to_t - h_from_t) // 60
+            # this hour is complete, no need to fetch it
+            # NOTE: NaN is the only value that is not equal to itself
+            if all(v == v for v in values[dest_idx:dest_idx + nb]):
+                hour += 3600
+                continue
+            src = None
+            if hour_e is not None and hour_e.start == hour:
+                src = hour_e.values
+            else:
+                record = self.get_record('%s::h%d' % (key, hour))
+                if record is not None:
+                    src = record['values']
+            if src is not None:
+                _fill_missing_values(values, dest_idx, src, (h_from_t - hour) // 60, nb)
+            hour += 3600
+    
+    
     # We consume data and create a new data entry if need
     def add_value(self, t, key, v, local=False):
         # be sure to work with int time
         t = int(t)
         
         T0 = time.time()
-        STATS.incr('ts-add-value', 1)
         
-        # Try to get the minute memory element. If not available, create one and
-        # set it's creation time so the ts-reaper thread can grok it and archive it if too old
-        e = self.data.get('min::%s' % key, None)
-        if e is None:
-            now = NOW.now  # int(time.time())
-            e = {'cur_min': 0, 'sum': 0, 'min': None, 'max': None, 'values': [None] * 60, 'nb': 0, 'ctime': now}
-            self.data['min::%s' % key] = e
-            
-            # Maybe we did not know about it, maybe so, but whatever, we add it
-            self.set_name_if_unset(key)
+        serie = self.series.get(key, None)
+        if serie is None:
+            with self.data_lock:
+                serie = self.series.get(key, None)
+                if serie is None:
+                    # we will have a lot of them, and the name is used in keys, so only keep one string
+                    # NOTE: python 2 cannot intern unicode names (from json or perfdata), keep them as they are
+                    if isinstance(key, str):
+                        key = intern(key)
+                    serie = Serie(key)
+                    self.series[key] = serie
+                    # Maybe we did not know about it, maybe so, but whatever, we add it
+                    self.set_name_if_unset(key)
         
         # Compute the minute start and the second idx inside the
         # minute (0-->59)
-        _div = divmod(t, 60)
-        t_minu = _div[0] * 60
-        t_second = _div[1]
+        t_minu, t_second = divmod(t, 60)
+        t_minu *= 60
         
-        # If we just changed the second
-        if t_minu != e['cur_min']:
+        # Try to get the minute memory element. If not available, create one and
+        # set it's creation time so the ts-reaper thread can grok it and archive it if too old
+        e = serie.minute
+        if e is None or t_minu != e.cur_min:
             # we don't save the first def_e
-            if e['cur_min'] != 0:
-                self.archive_minute(e, key, local=local)
-            now = NOW.now  # int(time.time())
-            e = {'cur_min': t_minu, 'sum': 0, 'min': None, 'max': None, 'values': [None] * 60, 'nb': 0, 'ctime': now}
-            self.data['min::%s' % key] = e
+            if e is not None and e.cur_min != 0:
+                self.archive_minute(e, serie, local=local)
+            e = MinuteBucket(t_minu, NOW.now)
+            serie.minute = e
         
         # We will insert the value at the t_second position, we are sure this place is
-        # available as the structure is already filled when the dict is created
-        e['values'][t_second] = v
-        
-        # Check if the new value change the min/max entry
-        e_min = e['min']
-        e_max = e['max']
-        if not e_min or v < e_min:
-            e['min'] = v
-        if not e_max or v > e_max:
-            e['max'] = v
-        
-        # And sum up the result so we will be able to compute the
-        # avg entry
-        e['sum'] += v
-        e['nb'] += 1
+        # available as the structure is already filled when the bucket is created
+        e.add(t_second, v)
         
         STATS.timer('ts.add_value', (time.time() - T0) * 1000)
     
@@ -139,128 +399,78 @@ class TSBackend(object):
     # Main function for writing in the DB the minute that just
     # finished, update the hour/day entry too, and if need save
     # them too
-    def archive_minute(self, e, ID, local):
-        STATS.incr('ts-archive-minute', 1)
+    def archive_minute(self, e, serie, local):
         T0 = time.time()
         
-        cur_min = e['cur_min']
-        name = ID
-        values = e['values']
-        
-        e['avg'] = None
-        if e['nb'] != 0:
-            e['avg'] = e['sum'] / float(e['nb'])
+        cur_min = e.cur_min
+        name = serie.name
+        avg = e.get_avg()
         
         # the main key we use to save the minute entry in the DB
         key = '%s::m%d' % (name, cur_min)
         
         # Serialize and put the value
         _t = time.time()
-        ser = SERIALIZER.dumps(e, 2)
-        STATS.incr('serializer', time.time() - _t)
+        ser = SERIALIZER.dumps(e.to_record(), 2)
+        STATS.timer('ts.serializer', (time.time() - _t) * 1000)
         # We keep minutes for 1 day
         _t = time.time()
         self.push_key(key, ser, ttl=86400, local=local)
-        STATS.incr('put-key', time.time() - _t)
-        
-        # Also insert the key in a time switching database
-        # (one database by hour)
-        # _t = time.time()
-        # self.its.assume_key(key, cur_min)
-        # STATS.incr('its-assume-key', time.time() - _t)
+        STATS.timer('ts.put-minute', (time.time() - _t) * 1000)
         
         ### Hour now
         # Now look at if we just switch hour
         hour = divmod(cur_min, 3600)[0] * 3600
-        key = '%s::h%d' % (name, hour)
-        
-        # CUR_H_KEY = ALL[ID]['CUR_H_KEY']
-        hour_e = self.data.get('hour::%s' % name, None)
-        if hour_e is None:
-            hour_e = {'hour': 0, 'sum': 0, 'min': None, 'max': None, 'values': [None] * 60, 'nb': 0}
-            self.data['hour::%s' % name] = hour_e
-        old_hour = hour_e['hour']
-        # If we switch to a new hour and we are not the first def_hour value
-        # we must save the hour entry in the database
-        if hour != old_hour:
-            if hour_e['hour'] != 0:
+        hour_e = serie.hour
+        # If we switch to a new hour we must save the previous hour entry in the database
+        if hour_e is None or hour != hour_e.start:
+            if hour_e is not None:
                 _t = time.time()
-                ser = SERIALIZER.dumps(hour_e)
-                STATS.incr('serializer', time.time() - _t)
+                ser = SERIALIZER.dumps(hour_e.to_record('hour'))
+                STATS.timer('ts.serializer', (time.time() - _t) * 1000)
                 
                 # the main key we use to save the hour entry in the DB
-                hkey = '%s::h%d' % (name, old_hour)
+                hkey = '%s::h%d' % (name, hour_e.start)
                 
                 # Keep hour thing for 1 month
                 _t = time.time()
-                self.push_key(key, ser, ttl=86400 * 31, local=local)
-                STATS.incr('put-hour', time.time() - _t)
+                self.push_key(hkey, ser, ttl=86400 * 31, local=local)
+                STATS.timer('ts.put-hour', (time.time() - _t) * 1000)
             
             # Now new one with the good hour of t :)
-            hour_e = {'hour': 0, 'sum': 0, 'min': None, 'max': None, 'values': [None] * 60, 'nb': 0}
-            hour_e['hour'] = hour
-            self.data['hour::%s' % name] = hour_e
+            hour_e = AggregateBucket(hour, 60)
+            serie.hour = hour_e
         
         _t = time.time()
         # Now compute the hour object update
-        h_min = hour_e['min']
-        h_max = hour_e['max']
-        if h_min is None or e['min'] < h_min:
-            hour_e['min'] = e['min']
-        if h_max is None or e['max'] > h_max:
-            hour_e['max'] = e['max']
-        
-        if e['avg'] is not None:
-            hour_e['nb'] += 1
-            hour_e['sum'] += e['avg']
-            # We try to look at which minute we are in the hour object
-            minute_hour_idx = (cur_min - hour) // 60
-            hour_e['values'][minute_hour_idx] = e['avg']
-            hour_e['avg'] = hour_e['sum'] / float(hour_e['nb'])
-        STATS.incr('hour-compute', time.time() - _t)
+        hour_e.add_minute(e, avg)
+        STATS.timer('ts.hour-compute', (time.time() - _t) * 1000)
         
         ### Day now
         # Now look at if we just switch day
         day = divmod(cur_min, 86400)[0] * 86400
-        hkey = '%s::d%d' % (name, day)
-        
-        # Get the in-memory entry, and if none a default one
-        day_e = self.data.get('day::%s' % hkey, None)
-        if day_e is None:
-            day_e = {'day': 0, 'sum': 0, 'min': None, 'max': None, 'values': [None] * 1440, 'nb': 0}
-        old_day = day_e['day']
-        # If we switch to a new day and we are not the first def_day value
-        # we must save the day entry in the database
-        if day != old_day and day_e['day'] != 0:
-            _t = time.time()
-            ser = SERIALIZER.dumps(day_e)
-            STATS.incr('serializer', time.time() - _t)
-            
-            _t = time.time()
-            # And keep day object for 1 year
-            self.push_key(hkey, ser, ttl=86400 * 366, local=local)
-            STATS.incr('put-day', time.time() - _t)
+        day_e = serie.day
+        # If we switch to a new day we must save the previous day entry in the database
+        if day_e is None or day != day_e.start:
+            if day_e is not None:
+                _t = time.time()
+                ser = SERIALIZER.dumps(day_e.to_record('day'))
+                STATS.timer('ts.serializer', (time.time() - _t) * 1000)
+                
+                dkey = '%s::d%d' % (name, day_e.start)
+                _t = time.time()
+                # And keep day object for 1 year
+                self.push_key(dkey, ser, ttl=86400 * 366, local=local)
+                STATS.timer('ts.put-day', (time.time() - _t) * 1000)
             
-            # Now new one :)
-            day_e = {'day': day, 'sum': 0, 'min': None, 'max': None, 'values': [None] * 1440, 'nb': 0}
-            self.data['day::%s' % key] = day_e
+            # Now new one
+            day_e = AggregateBucket(day, 1440)
+            serie.day = day_e
         
         _t = time.time()
         # Now compute the day object update
-        h_min = day_e['min']
-        h_max = day_e['max']
-        if h_min is None or e['min'] < h_min:
-            day_e['min'] = e['min']
-        if h_max is None or e['max'] > h_max:
-            day_e['max'] = e['max']
-        if e['avg'] is not None:
-            day_e['nb'] += 1
-            day_e['sum'] += e['avg']
-            # We try to look at which minute we are in the day object
-            minute_day_idx = (cur_min - day) // 60
-            day_e['values'][minute_day_idx] = e['avg']
-            day_e['avg'] = day_e['sum'] / float(day_e['nb'])
-        STATS.incr('day-compute', time.time() - _t)
+        day_e.add_minute(e, avg)
+        STATS.timer('ts.day-compute', (time.time() - _t) * 1000)
         
         STATS.timer('ts.archive-minute', (time.time() - T0) * 1000)
     
@@ -276,29 +486,23 @@ class TSBackend(object):
             now = NOW.now
             
             with self.data_lock:
-                all_names = list(self.data.keys())  # python3: be sure to have a copy
-            logger.debug("DOING reaper thread on %d elements" % len(all_names))
-            for name in all_names:
+                all_series = list(self.series.values())  # python3: be sure to have a copy
+            logger.debug("DOING reaper thread on %d elements" % len(all_series))
+            for serie in all_series:
                 # Grok all minute entries
-                if name.startswith('min::'):
-                    e = self.data.get(name, None)
-                    # maybe some one delete the entry? should not be possible
-                    if e is None:
-                        continue
-                    ctime = e['ctime']
-                    # if the creation time of this structure is too old and
-                    # really for data, force to save the entry in KV entry
-                    if ctime < now - self.max_data_age and e['nb'] > 0:
-                        STATS.incr('reaper-old-data', 1)
-                        logger.debug("REAPER TOO OLD DATA FOR", name)
-                        # get the raw metric name
-                        _id = name[5:]
-                        self.archive_minute(e, _id, local=True)
-                        # the element was too old, so we can assume it won't be update again. Delete it's entry
-                        try:
-                            del self.data[name]
-                        except:
-                            pass
+                e = serie.minute
+                if e is None:
+                    continue
+                # if the creation time of this structure is too old and
+                # really for data, force to save the entry in KV entry
+                if e.ctime < now - self.max_data_age and e.nb > 0:
+                    STATS.incr('ts.reaper-old-data', 1)
+                    logger.debug("REAPER TOO OLD DATA FOR", serie.name)
+                    self.archive_minute(e, serie, local=True)
+                    # the element was too old, so we can assume it won't be update again. Delete it's entry
+                    # but only if no one did already create a new one
+                    if serie.minute is e:
+                        serie.minute = None
             
             time.sleep(10)
     
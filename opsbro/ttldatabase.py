@@ -1,6 +1,7 @@
 import shutil
 import os
 import time
+import heapq
 import threading
 
 from .now import NOW
@@ -13,103 +14,144 @@ from .stop import stopper
 # Global logger for this part
 logger = LoggerFactory.create_logger('key-value')
 
+# Name of the index database in the ttl directory
+TTL_INDEX_NAME = 'index'
 
-# This class manage the ttl entries for each key with a ttl. Each is with a 1hour precision idx key that we saved
-# in the master db
-# but with keeping a database by hour about the key for the housekeeping
+# Max number of keys deleted in one write
+TTL_CLEAN_BATCH_SIZE = 1000
+
+
+# Index keys are ordered by expire hour, then key: HOUR/KEY with the hour in a fixed size
+def get_index_key(h, key):
+    return '%010d/%s' % (h, key)
+
+
+# Just before all the index keys of this hour
+def get_hour_key(h):
+    return '%010d' % h
+
+
+def get_hour(t):
+    return divmod(t, 3600)[0] * 3600
+
+
+# This class manage the ttl entries for each key with a ttl. All are in one database index, with
+# keys ordered by (expire hour, key), so the expired ones are always at the start of the index and
+# are cleaned with a range read and batch deletes.
+# The expire hours we did see are in a heap, so most of the time we know there is nothing to clean
+# without looking at the database
 class TTLDatabase(object):
     def __init__(self, ttldb_dir):
         self.lock = threading.RLock()
-        self.dbs = {}
-        self.db_cache_size = 100
         self.ttldb_dir = ttldb_dir
         if not os.path.exists(self.ttldb_dir):
             os.mkdir(self.ttldb_dir)
+        self.db = dbwrapper.get_db(os.path.join(self.ttldb_dir, TTL_INDEX_NAME))
+        
+        # min heap of the expire hours we did set, and the same as a set to not push twice
+        self.hours_heap = []
+        self.hours = set()
+        # The entries of a previous run are not in the heap, so we look in the database at each new hour
+        self.last_index_check = 0
+        
+        self.migrate_old_dbs()
         # Launch a thread that will look once a minute the old entries
         threader.create_and_launch(self.ttl_cleaning_thread, name='Cleaning TTL expired key/values', essential=True, part='key-value')
     
     
-    # Load the hour ttl/H base where we will save all master
-    # key for the H hour
-    def get_ttl_db(self, h):
-        cdb = self.dbs.get(h, None)
-        # If missing, look to load it but with a lock to be sure we load it only once
-        if cdb is None:
-            STATS.incr('ttl-db-cache-miss', 1)
-            with self.lock:
-                # Maybe during the lock get one other thread succedd in getting the cdb
-                if h not in self.dbs:
-                    # Ok really load it, but no more than self.db_cache_size
-                    # databases (number of open files can increase quickly)
-                    if len(self.dbs) > self.db_cache_size:
-                        ttodrop = self.dbs.keys()[0]
-                        del self.dbs[ttodrop]
-                    _t = time.time()
-                    cdb = dbwrapper.get_db(os.path.join(self.ttldb_dir, '%d' % h))  # leveldb.LevelDB(os.path.join(self.ttldb_dir, '%d' % h))
-                    STATS.incr('ttl-db-open', time.time() - _t)
-                    self.dbs[h] = cdb
-                # Ok a malicious thread just go before us, good :)
-                else:
-                    cdb = self.dbs[h]
-        # We alrady got it, thanks cache
-        else:
-            STATS.incr('ttl-db-cache-hit', 1)
-        return cdb
+    # Old versions did have one database by hour, import their entries in the index
+    def migrate_old_dbs(self):
+        for d in os.listdir(self.ttldb_dir):
+            name = d
+            if name.endswith('.sqlite'):
+                name = name[:-len('.sqlite')]
+            try:
+                h = int(name)
+            except ValueError:  # our index or who add a dir that is not a int here...
+                continue
+            p = os.path.join(self.ttldb_dir, '%d' % h)
+            logger.info('Importing the old ttl database %s in the ttl index' % p)
+            try:
+                cdb = dbwrapper.get_db(p)
+                puts = [(get_index_key(h, k), '') for k in cdb.RangeIter(include_value=False)]
+                self.db.WriteBatch(puts)
+                del cdb
+            except Exception as exp:
+                logger.error('Cannot import the old ttl database %s: %s' % (p, exp))
+                continue
+            self.__add_hour(h)
+            shutil.rmtree(p, ignore_errors=True)
+            if os.path.isfile(p + '.sqlite'):
+                os.unlink(p + '.sqlite')
     
     
-    # Save a key in the good idx minute database
+    def __add_hour(self, h):
+        with self.lock:
+            if h not in self.hours:
+                self.hours.add(h)
+                heapq.heappush(self.hours_heap, h)
+    
+    
+    # Save a key in the index
     def set_ttl(self, key, ttl_t):
-        # keep keys saved by hour in the future
-        ttl_t = divmod(ttl_t, 3600)[0] * 3600
-        
-        cdb = self.get_ttl_db(ttl_t)
-        logger.debug("TTL save", key, "with ttl", ttl_t, "in", cdb)
-        cdb.Put(key, '')
+        self.set_ttls([(key, ttl_t)])
+    
     
+    # Save a lot of (key, ttl_t) entries, with only one write
+    def set_ttls(self, entries):
+        puts = []
+        for (key, ttl_t) in entries:
+            # keep keys saved by hour in the future
+            h = get_hour(ttl_t)
+            self.__add_hour(h)
+            puts.append((get_index_key(h, key), ''))
+        logger.debug("TTL save %d keys" % len(puts))
+        self.db.WriteBatch(puts)
     
-    # We already droped all entry in a db, so drop it from our cache
-    def drop_db(self, h):
-        # now remove the database
+    
+    # Is there maybe something to clean for hours before h?
+    def __need_clean(self, h):
         with self.lock:
-            try:
-                del self.dbs[h]
-            except (IndexError, KeyError):  # if not there, not a problem...
-                pass
-        
-        # And remove the files of this database
-        p = os.path.join(self.ttldb_dir, '%d' % h)
-        logger.log("Deleting ttl database tree", p)
-        shutil.rmtree(p, ignore_errors=True)
+            if self.hours_heap and self.hours_heap[0] < h:
+                return True
+        # Once by hour (and at startup) look at the database for entries we did not set ourselves
+        return self.last_index_check != h
     
     
-    # Look at the available dbs and clean all olds dbs that time are lower
-    # than current hour
+    # All entries with an hour lower than the next one are deleted, whatever they are
     def clean_old(self):
         from .kv import kvmgr  # avoid recursive import
         
-        logger.debug("TTL clean old")
         now = NOW.now + 3600
-        h = divmod(now, 3600)[0] * 3600
-        # Look at the databses directory that have the hour time set
-        subdirs = os.listdir(self.ttldb_dir)
+        h = get_hour(now)
+        if not self.__need_clean(h):
+            return
+        logger.debug("TTL clean old")
+        self.last_index_check = h
+        # Forget the hours before the scan, so an hour added during it is still in the heap after
+        with self.lock:
+            while self.hours_heap and self.hours_heap[0] < h:
+                self.hours.discard(heapq.heappop(self.hours_heap))
         
-        for d in subdirs:
-            try:
-                bhour = int(d)
-            except ValueError:  # who add a dir that is not a int here...
-                continue
-            # Is the hour available for cleaning?
-            if bhour < h:
-                logger.log("TTL bhour is too low!", bhour)
-                # take the database and dump all keys in it
-                cdb = self.get_ttl_db(bhour)
-                to_del = cdb.RangeIter()
-                # Now ask the cluster to delete the key, whatever it is
-                for (k, v) in to_del:
-                    kvmgr.delete(k)
-                
-                # now we clean all old entries, remove the idx database
-                self.drop_db(bhour)
+        nb_deleted = 0
+        while not stopper.is_stop():
+            # We are deleting the start of the index, so each loop restart from its beginning
+            index_keys = []
+            for ikey in self.db.RangeIter(key_to=get_hour_key(h), include_value=False):
+                index_keys.append(ikey)
+                if len(index_keys) >= TTL_CLEAN_BATCH_SIZE:
+                    break
+            if not index_keys:
+                break
+            # Now ask the cluster to delete the keys, whatever they are, and then their index entries
+            keys = [ikey.split('/', 1)[1] for ikey in index_keys]
+            kvmgr.delete_batch(keys)
+            self.db.WriteBatch([], deletes=index_keys)
+            nb_deleted += len(keys)
+        
+        if nb_deleted:
+            logger.log("TTL deleted %d expired keys" % nb_deleted)
+            STATS.incr('kv.ttl-expired-keys', nb_deleted)
     
     
     # Thread that will manage the delete of the ttld-die key
@@ -1,5 +1,4 @@
 import os
-import socket
 import time
 import hashlib
 import tempfile
@@ -19,6 +18,8 @@ from .broadcast import broadcaster
 from .pubsub import pubsub
 from .util import copy_dir
 from .udprouter import udprouter
+from .udptransport import udptransport
+from .wirecodec import decode as wirecodec_decode
 
 logger = LoggerFactory.create_logger(DEFAULT_LOG_PART)
 logger_gossip = LoggerFactory.create_logger('gossip')
@@ -135,63 +136,58 @@ class UDPListener(object):
         # If we do not have the right, do not listen for UDP messages
         while not topiker.is_topic_enabled(TOPIC_SERVICE_DISCOVERY):
             time.sleep(1)
-        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
-        udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  # Allow Broadcast (useful for node discovery)
         logger.info("OPENING UDP", addr)
-        udp_sock.bind((listening_addr, port))
-        logger.info("UDP port open", port)
-        while not stopper.is_stop():
-            try:
-                data, addr = udp_sock.recvfrom(65535)  # buffer size is 1024 bytes
-            except socket.timeout:
-                continue  # nothing in few seconds? just loop again :)
-            
-            # No data? bail out :)
-            if len(data) == 0:
-                logger_gossip.debug("UDP: received void message from ", addr)
-                continue
-            
-            # Look if we use encryption
-            encrypter = libstore.get_encrypter()
-            data = encrypter.decrypt(data)
-            
-            logger_gossip.debug('Try to load package with zone %s' % gossiper.zone)
-            
-            # Maybe the decryption failed?
-            if data is None:
-                logger_gossip.error("UDP: received message with bad encryption key from %s" % str(addr))
+        udptransport.open_listener(listening_addr, port)
+        # The listener thread only read the messages, the decryption, json and routing are done
+        # in the transport decode workers
+        udptransport.set_datagram_handler(self.manage_datagram)
+        udptransport.launch_decode_workers()
+        udptransport.do_receive_loop()
+    
+    
+    def manage_datagram(self, data, addr):
+        # Look if we use encryption
+        encrypter = libstore.get_encrypter()
+        data = encrypter.decrypt(data)
+        
+        logger_gossip.debug('Try to load package with zone %s' % gossiper.zone)
+        
+        # Maybe the decryption failed?
+        if data is None:
+            logger_gossip.error("UDP: received message with bad encryption key from %s" % str(addr))
+            return
+        logger_gossip.debug("UDP: received message:", data, 'from', addr)
+        # Ok now we should have a json to parse :)
+        # it can be json or binary, depending on what the other node know we are managing
+        try:
+            raw = wirecodec_decode(data)
+        except ValueError:  # garbage
+            logger_gossip.error("UDP: received message that is not valid json:", data, 'from', addr)
+            return
+        
+        if isinstance(raw, list):
+            messages = raw
+        else:
+            messages = [raw]
+        for m in messages:
+            if not isinstance(m, dict):
                 continue
-            logger_gossip.debug("UDP: received message:", data, 'from', addr)
-            # Ok now we should have a json to parse :)
-            try:
-                raw = jsoner.loads(data)
-            except ValueError:  # garbage
-                logger_gossip.error("UDP: received message that is not valid json:", data, 'from', addr)
+            t = m.get('type', None)
+            if t is None:
                 continue
             
-            if isinstance(raw, list):
-                messages = raw
+            # TODO: remove this
+            # if t == '/ts/new':
+            #     key = m.get('key', '')
+            #     # Skip this message for classic nodes
+            #     if key == '':
+            #         continue
+            #     # if TS do not have it, it will propagate it
+            #     tsmgr.set_name_if_unset(key)
+            if t == 'event':
+                self.manage_event(m)
             else:
-                messages = [raw]
-            for m in messages:
-                if not isinstance(m, dict):
-                    continue
-                t = m.get('type', None)
-                if t is None:
-                    continue
-                
-                # TODO: remove this
-                # if t == '/ts/new':
-                #     key = m.get('key', '')
-                #     # Skip this message for classic nodes
-                #     if key == '':
-                #         continue
-                #     # if TS do not have it, it will propagate it
-                #     tsmgr.set_name_if_unset(key)
-                if t == 'event':
-                    self.manage_event(m)
-                else:
-                    udprouter.route_message(m, addr)
+                udprouter.route_message(m, addr)
     
     
     # Thread that will look for libexec/configuration change events,
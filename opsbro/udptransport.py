@@ -0,0 +1,128 @@
+import socket
+import threading
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+from .log import LoggerFactory
+from .stop import stopper
+
+# Global logger for this part
+logger = LoggerFactory.create_logger('gossip')
+
+# Number of threads that will decrypt/parse/route the received datagrams
+NB_DECODE_WORKERS = 4
+
+# Max number of datagrams waiting for a decode worker, after this we drop them (UDP is lossy anyway)
+MAX_DECODE_QUEUE = 10000
+
+
+# Share UDP sockets for all the agent:
+# * one long-lived socket for the listening address, also used to send so the others
+#   can answer us directly (like ping acks)
+# * a receive loop that only read datagrams and give them to decode workers. A source
+#   address is always managed by the same worker so its messages are still in order
+class UDPTransport(object):
+    def __init__(self):
+        self.listen_sock = None
+        self.send_sock = None
+        self.sock_lock = threading.RLock()
+        self.datagram_handler = None
+        self.decode_queues = []
+    
+    
+    # Open our listening socket, and it will be used to send too
+    def open_listener(self, listening_addr, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)  # Allow Broadcast (useful for node discovery)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1048576)
+        sock.bind((listening_addr, port))
+        sock.settimeout(1)
+        with self.sock_lock:
+            self.listen_sock = sock
+        logger.info("UDP port open", port)
+    
+    
+    def is_listening(self):
+        return self.listen_sock is not None
+    
+    
+    # If we do not listen, we still use only one socket to send
+    def __get_send_socket(self):
+        if self.listen_sock is not None:
+            return self.listen_sock
+        with self.sock_lock:
+            if self.send_sock is None:
+                self.send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP
+            return self.send_sock
+    
+    
+    def sendto(self, data, addr):
+        self.__get_send_socket().sendto(data, addr)
+    
+    
+    # Send a batch of (data, addr), a bad destination do not block the others
+    # NOTE: python do not have sendmmsg, so we just loop over the same socket
+    def send_many(self, packets):
+        sock = self.__get_send_socket()
+        nb_sent = 0
+        for (data, addr) in packets:
+            try:
+                sock.sendto(data, addr)
+                nb_sent += 1
+            except (socket.error, socket.gaierror) as exp:
+                logger.error('Cannot send UDP packet of len %d to %s: %s' % (len(data), str(addr), exp))
+        return nb_sent
+    
+    
+    # The handler will be called by the decode workers with (data, source_addr)
+    def set_datagram_handler(self, handler):
+        self.datagram_handler = handler
+    
+    
+    def launch_decode_workers(self):
+        from .threadmgr import threader
+        for i in range(NB_DECODE_WORKERS):
+            q = Queue(MAX_DECODE_QUEUE)
+            self.decode_queues.append(q)
+            threader.create_and_launch(self.do_decode_worker, name='UDP decoder %d' % i, essential=True, part='gossip', args=(q,))
+    
+    
+    def do_decode_worker(self, q):
+        while not stopper.is_stop():
+            try:
+                data, addr = q.get(timeout=1)
+            except Empty:
+                continue
+            # NOTE: as before, no try/except here, an error in a handler is a real error in an essential thread
+            self.datagram_handler(data, addr)
+    
+    
+    # Only read the datagrams and give them to the decode workers
+    def do_receive_loop(self):
+        sock = self.listen_sock
+        nb_workers = len(self.decode_queues)
+        while not stopper.is_stop():
+            try:
+                data, addr = sock.recvfrom(65535)
+            except socket.timeout:
+                continue  # nothing in few seconds? just loop again :)
+            except socket.error as exp:
+                logger.error('UDP: error while reading a message: %s' % exp)
+                continue
+            
+            # No data? bail out :)
+            if len(data) == 0:
+                logger.debug("UDP: received void message from ", addr)
+                continue
+            
+            q = self.decode_queues[hash(addr) % nb_workers]
+            try:
+                q.put_nowait((data, addr))
+            except Full:
+                logger.warning('UDP: too much messages to manage, dropping one from %s' % str(addr))
+
+
+udptransport = UDPTransport()
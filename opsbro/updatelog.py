@@ -0,0 +1,328 @@
+import os
+import sys
+import time
+import struct
+import zlib
+import threading
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from .log import LoggerFactory
+from .stop import stopper
+from .threadmgr import threader
+
+PY3 = (sys.version_info[0] == 3)
+
+# Global logger for this part
+logger = LoggerFactory.create_logger('key-value')
+
+# When the log is synced on the disk:
+# * always: after each group of records, before they go in the database
+# * interval: at most every FSYNC_INTERVAL seconds
+# * never: let the system do it
+FSYNC_POLICIES = ('always', 'interval', 'never')
+FSYNC_INTERVAL = 1.0
+
+# A new segment file is started when the current one is bigger than this
+SEGMENT_MAX_SIZE = 16 * 1024 * 1024
+
+# Closed segments we keep. Older ones are already in the database, so we remove them
+KEEP_SEGMENTS = 1
+
+SEGMENT_EXTENSION = '.wal'
+
+# Record: payload size, payload crc32, sequence number, then the payload
+RECORD_HEADER = struct.Struct('>IIQ')
+# Payload: number of puts and deletes, then the puts (key size, value size, key, value) and
+# then the deletes (key size, key)
+_COUNTS = struct.Struct('>II')
+_PUT_SIZES = struct.Struct('>II')
+_DELETE_SIZE = struct.Struct('>I')
+
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf8')
+
+
+def _to_native_str(b):
+    if PY3:
+        return b.decode('utf8', 'ignore')
+    return b
+
+
+def encode_payload(puts, deletes):
+    parts = [_COUNTS.pack(len(puts), len(deletes))]
+    for (key, value) in puts:
+        key = _to_bytes(key)
+        value = _to_bytes(value)
+        parts.append(_PUT_SIZES.pack(len(key), len(value)))
+        parts.append(key)
+        parts.append(value)
+    for key in deletes:
+        key = _to_bytes(key)
+        parts.append(_DELETE_SIZE.pack(len(key)))
+        parts.append(key)
+    return b''.join(parts)
+
+
+def encode_record(seqno, payload):
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff, seqno) + payload
+
+
+def decode_payload(payload):
+    nb_puts, nb_deletes = _COUNTS.unpack_from(payload, 0)
+    pos = _COUNTS.size
+    puts = []
+    for _ in range(nb_puts):
+        key_size, value_size = _PUT_SIZES.unpack_from(payload, pos)
+        pos += _PUT_SIZES.size
+        key = payload[pos:pos + key_size]
+        pos += key_size
+        puts.append((_to_native_str(key), payload[pos:pos + value_size]))
+        pos += value_size
+    deletes = []
+    for _ in range(nb_deletes):
+        key_size = _DELETE_SIZE.unpack_from(payload, pos)[0]
+        pos += _DELETE_SIZE.size
+        deletes.append(_to_native_str(payload[pos:pos + key_size]))
+        pos += key_size
+    return puts, deletes
+
+
+# Give the (seqno, puts, deletes) of a segment file, and the size of its valid part. A record
+# that is truncated or with a bad crc (crash during a write) is the end of the valid part
+def read_segment(path):
+    records = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    pos = 0
+    while pos + RECORD_HEADER.size <= len(data):
+        size, crc, seqno = RECORD_HEADER.unpack_from(data, pos)
+        payload = data[pos + RECORD_HEADER.size:pos + RECORD_HEADER.size + size]
+        if len(payload) != size or zlib.crc32(payload) & 0xffffffff != crc:
+            break
+        try:
+            puts, deletes = decode_payload(payload)
+        except struct.error:
+            break
+        records.append((seqno, puts, deletes))
+        pos += RECORD_HEADER.size + size
+    return records, pos
+
+
+# Append only log of the key/value updates, in segment files named by their first sequence number.
+# * the records are written by a writer thread, so all the records stacked at the same time are
+#   written with only one write (and one fsync)
+# * at startup, the records that are not in the database are replayed
+# * the old segments are removed only when their records are in the database, and sync_db() did
+#   sync the database on the disk (the database writes are not synced)
+class UpdateLog(object):
+    def __init__(self, log_dir, fsync_policy='interval', sync_db=None):
+        if fsync_policy not in FSYNC_POLICIES:
+            logger.error('Unknown key/value fsync policy %s, using interval (possible values: %s)' % (fsync_policy, ', '.join(FSYNC_POLICIES)))
+            fsync_policy = 'interval'
+        self.log_dir = log_dir
+        self.fsync_policy = fsync_policy
+        self.sync_db = sync_db
+        self.queue = Queue()
+        self.append_lock = threading.RLock()
+        self.next_seqno = 1
+        
+        # The writer thread tells when records are written
+        self.written_condition = threading.Condition()
+        self.written_seqno = 0
+        # and the records are applied in the log order
+        self.applied_condition = threading.Condition()
+        self.applied_seqno = 0
+        
+        self.segment = None
+        self.segment_size = 0
+        self.last_fsync = 0
+        # some written records are not synced yet (interval policy)
+        self.need_fsync = False
+    
+    
+    # The (first seqno, path) of the segments, ordered
+    def __get_segments(self):
+        r = []
+        for name in os.listdir(self.log_dir):
+            if not name.endswith(SEGMENT_EXTENSION):
+                continue
+            try:
+                first_seqno = int(name[:-len(SEGMENT_EXTENSION)])
+            except ValueError:
+                continue
+            r.append((first_seqno, os.path.join(self.log_dir, name)))
+        r.sort()
+        return r
+    
+    
+    # Replay the records after applied_seqno with apply(puts, deletes, seqno), then start a new segment
+    # and the writer thread
+    def open(self, applied_seqno, apply):
+        if not os.path.exists(self.log_dir):
+            os.mkdir(self.log_dir)
+        # Old versions did have a text file by minute with the updated keys, they are useless now
+        for name in os.listdir(self.log_dir):
+            if name.endswith('.lst'):
+                os.unlink(os.path.join(self.log_dir, name))
+        
+        last_seqno = applied_seqno
+        nb_replayed = 0
+        for (_, path) in self.__get_segments():
+            records, valid_size = read_segment(path)
+            if valid_size != os.path.getsize(path):
+                logger.warning('The update log %s is truncated after %d bytes (was the agent killed?)' % (path, valid_size))
+                with open(path, 'r+b') as f:
+                    f.truncate(valid_size)
+            for (seqno, puts, deletes) in records:
+                last_seqno = max(last_seqno, seqno)
+                if seqno <= applied_seqno:
+                    continue
+                apply(puts, deletes, seqno)
+                nb_replayed += 1
+        if nb_replayed:
+            logger.info('Did replay %d updates from the update log' % nb_replayed)
+        self.next_seqno = last_seqno + 1
+        self.written_seqno = last_seqno
+        self.applied_seqno = last_seqno
+        self.__open_segment(self.next_seqno)
+        threader.create_and_launch(self.do_writer_thread, name='Key/value update log writer', essential=True, part='key-value')
+    
+    
+    def __open_segment(self, first_seqno):
+        if self.segment is not None:
+            self.segment.flush()
+            if self.fsync_policy != 'never':
+                os.fsync(self.segment.fileno())
+                self.need_fsync = False
+            self.segment.close()
+        path = os.path.join(self.log_dir, '%020d%s' % (first_seqno, SEGMENT_EXTENSION))
+        self.segment = open(path, 'ab')
+        self.segment_size = 0
+        self.__compact()
+    
+    
+    # The closed segments records are already in the database, so only keep the last ones
+    def __compact(self):
+        segments = self.__get_segments()
+        # the last one is the current one
+        to_remove = segments[:-(KEEP_SEGMENTS + 1)]
+        if not to_remove:
+            return
+        # All the records before the first kept segment must be in the database, if not we will
+        # look again at the next segment
+        first_kept_seqno = segments[-(KEEP_SEGMENTS + 1)][0]
+        if self.applied_seqno < first_kept_seqno - 1:
+            return
+        # and the database must be on the disk before we lose the records
+        if self.sync_db is not None and self.fsync_policy != 'never':
+            try:
+                self.sync_db()
+            except Exception as exp:
+                logger.error('Cannot sync the key/value database, the old update logs are kept: %s' % exp)
+                return
+        for (_, path) in to_remove:
+            logger.debug('Removing the old update log %s' % path)
+            try:
+                os.unlink(path)
+            except OSError as exp:
+                logger.error('Cannot remove the old update log %s: %s' % (path, exp))
+    
+    
+    # Log the updates, and when they are written (and synced with the always policy) give them
+    # to apply(puts, deletes, seqno), in the same order than in the log.
+    # All the updates stacked while the writer thread is writing are written together
+    # NOTE: the updates are encoded before taking a sequence number, and a taken one is always
+    # released, so an error cannot block the next writes
+    def write(self, puts, deletes, apply):
+        payload = encode_payload(puts, deletes)
+        with self.append_lock:
+            seqno = self.next_seqno
+            self.next_seqno += 1
+            self.queue.put((seqno, encode_record(seqno, payload)))
+        
+        try:
+            with self.written_condition:
+                while self.written_seqno < seqno and not stopper.is_stop():
+                    self.written_condition.wait(1)
+            
+            with self.applied_condition:
+                while self.applied_seqno < seqno - 1 and not stopper.is_stop():
+                    self.applied_condition.wait(1)
+                apply(puts, deletes, seqno)
+        finally:
+            with self.applied_condition:
+                self.applied_seqno = max(self.applied_seqno, seqno)
+                self.applied_condition.notify_all()
+    
+    
+    # Write all the records waiting in the queue at once
+    def __write_group(self, first):
+        group = [first]
+        while True:
+            try:
+                group.append(self.queue.get_nowait())
+            except Empty:
+                break
+        try:
+            if self.segment_size >= SEGMENT_MAX_SIZE:
+                self.__open_segment(group[0][0])
+            data = b''.join([record for (_, record) in group])
+            self.segment.write(data)
+            self.segment.flush()
+            self.segment_size += len(data)
+            now = time.time()
+            if self.fsync_policy == 'always' or (self.fsync_policy == 'interval' and now - self.last_fsync >= FSYNC_INTERVAL):
+                os.fsync(self.segment.fileno())
+                self.last_fsync = now
+                self.need_fsync = False
+            elif self.fsync_policy == 'interval':
+                self.need_fsync = True
+        finally:
+            # even on error, the writes must not wait forever
+            with self.written_condition:
+                self.written_seqno = group[-1][0]
+                self.written_condition.notify_all()
+    
+    
+    # With the interval policy, the last records of a burst are synced when the writer is idle,
+    # or they can wait forever for a next write
+    def __sync_if_late(self):
+        now = time.time()
+        if not self.need_fsync or now - self.last_fsync < FSYNC_INTERVAL:
+            return
+        os.fsync(self.segment.fileno())
+        self.last_fsync = now
+        self.need_fsync = False
+    
+    
+    def do_writer_thread(self):
+        while not stopper.is_stop():
+            # do not wait more than the interval when some records are not synced
+            timeout = 1
+            if self.need_fsync:
+                timeout = min(1, max(0.01, self.last_fsync + FSYNC_INTERVAL - time.time()))
+            try:
+                first = self.queue.get(timeout=timeout)
+            except Empty:
+                try:
+                    self.__sync_if_late()
+                except (IOError, OSError) as exp:
+                    logger.error('Cannot sync the update log: %s' % exp)
+                continue
+            try:
+                self.__write_group(first)
+            except (IOError, OSError) as exp:
+                logger.error('Cannot write in the update log: %s' % exp)
+        # Do not lose what was stacked before the stop
+        try:
+            first = self.queue.get_nowait()
+            self.__write_group(first)
+        except (Empty, IOError, OSError):
+            pass
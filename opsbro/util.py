@@ -7,6 +7,8 @@ import hashlib
 import time
 import uuid as libuuid
 import base64
+import threading
+from collections import OrderedDict
 
 PY3 = sys.version_info >= (3,)
 if PY3:
@@ -50,7 +52,8 @@ def make_dir(path):
     os.mkdir(path)
 
 
-def exec_command(cmd):
+# If timeout is set, the command (and its sons) is killed after this time
+def exec_command(cmd, timeout=None):
     import subprocess
     # If we have a list, we should not call with a shell
     shell = False if isinstance(cmd, list) else True
@@ -61,12 +64,33 @@ def exec_command(cmd):
     # There is no setsid function on windows
     preexec_fn = getattr(os, 'setsid', None)
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=close_fds, preexec_fn=preexec_fn, shell=shell)
-    stdout, stderr = p.communicate()
+    killer = None
+    if timeout:
+        killer = threading.Timer(timeout, _kill_process, args=(p, preexec_fn is not None))
+        killer.daemon = True
+        killer.start()
+    try:
+        stdout, stderr = p.communicate()
+    finally:
+        if killer is not None:
+            killer.cancel()
     stdout = bytes_to_unicode(stdout)
     stderr = bytes_to_unicode(stderr)
     return p.returncode, stdout, stderr
 
 
+# The process was launched with a setsid, so we can kill all its process group (shell and its sons)
+def _kill_process(p, is_group_leader):
+    import signal
+    try:
+        if is_group_leader:
+            os.killpg(p.pid, signal.SIGKILL)
+        else:
+            p.kill()
+    except OSError:  # already dead
+        pass
+
+
 def my_sort(lst, cmp_f):
     if not PY3:
         lst = sorted(lst, cmp=cmp_f)
@@ -105,6 +129,22 @@ def to_best_int_float(val):
     return f
 
 
+_DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+# Get the seconds of a duration like 10, '10', '10s', '5m', '1h' or '1d'. Raise ValueError if not valid
+def parse_duration(value):
+    if not hasattr(value, 'strip'):  # already a number
+        return value
+    value = value.strip()
+    multiplier = _DURATION_UNITS.get(value[-1:], None)
+    if multiplier is not None:
+        value = value[:-1]
+    else:
+        multiplier = 1
+    return to_best_int_float(float(value) * multiplier)
+
+
 # get a dict but with key as lower
 def lower_dict(d):
     r = {}
@@ -200,6 +240,52 @@ def byteify(input):
         return input
 
 
+# Small thread safe LRU dict: the most recently used entries are kept, and the
+# oldest ones are dropped when we go over the max size
+class LRUCache(object):
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+    
+    
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            # put it back at the end, as the most recent one
+            self._entries[key] = value
+            return value
+    
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+    
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    
+    def __contains__(self, key):
+        return key in self._entries
+
+
 PAGESIZE = 0
 
 
@@ -0,0 +1,281 @@
+import struct
+
+from .jsonmgr import jsoner
+from .util import bytes_to_unicode
+
+# If msgpack is installed we use it for the raw pack/unpack, if not we have our own version of
+# the part of msgpack we are using (same wire format)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Compact binary encoding of the UDP messages: a msgpack payload where the well known keys
+# are replaced by small int ids, between a start and a end marker. 0xc1 is never used in msgpack,
+# and the end marker is need because the decryption is stripping the padding spaces
+BINARY_MAGIC = b'\xc1'
+BINARY_END = b'\xc1'
+
+# The version we do manage. Nodes are giving it in their node entry (key codec) so
+# others nodes know they can send them binary messages. 0 means json only
+BINARY_CODEC_VERSION = 1
+
+BINARY_HEADER = BINARY_MAGIC + struct.pack('>B', BINARY_CODEC_VERSION)
+
+# The known keys ids. NOTE: never change the order, only add at the end, it's the wire format
+# (and so increase BINARY_CODEC_VERSION)
+KEYS = (
+    # nodes
+    'type', 'uuid', 'name', 'display_name', 'addr', 'port', 'incarnation', 'state', 'groups',
+    'services', 'checks', 'zone', 'is_proxy', 'codec',
+    # ping and co
+    'from', 'from_zone', 'seqno', 'node', 'tgt',
+    # events
+    'payload', 'ctime', 'eventid', 'path', 'hash',
+    # kv
+    'k', 'v', 'ttl', 'fw',
+    # raft
+    'election_turn', 'candidate', 'leader',
+)
+KEY_IDS = dict((k, i) for (i, k) in enumerate(KEYS))
+
+try:
+    _integer_types = (int, long)
+    _string_types = (str, unicode)
+except NameError:  # python3
+    _integer_types = (int,)
+    _string_types = (str, bytes)
+
+_B = struct.Struct('>B')
+_H = struct.Struct('>H')
+_I = struct.Struct('>I')
+_Q = struct.Struct('>Q')
+_b = struct.Struct('>b')
+_h = struct.Struct('>h')
+_i = struct.Struct('>i')
+_q = struct.Struct('>q')
+_d = struct.Struct('>d')
+
+
+# The keys are changed into their ids, and like json, the not string keys are changed into strings
+def _compact_keys(o):
+    if isinstance(o, dict):
+        r = {}
+        for (k, v) in o.items():
+            kid = KEY_IDS.get(k, None)
+            if kid is None:
+                kid = k if isinstance(k, _string_types) else str(k)
+            r[kid] = _compact_keys(v)
+        return r
+    if isinstance(o, (list, tuple)):
+        return [_compact_keys(v) for v in o]
+    return o
+
+
+def _expand_keys(o):
+    if isinstance(o, dict):
+        return dict(((KEYS[k] if isinstance(k, int) else k), _expand_keys(v)) for (k, v) in o.items())
+    if isinstance(o, list):
+        return [_expand_keys(v) for v in o]
+    return o
+
+
+def _pack_len(n, fix_mask, fix_max, t16, t32, out):
+    if n <= fix_max:
+        out.append(_B.pack(fix_mask | n))
+    elif n < 0x10000:
+        out.append(t16 + _H.pack(n))
+    else:
+        out.append(t32 + _I.pack(n))
+
+
+def _pack(o, out):
+    if o is None:
+        out.append(b'\xc0')
+    elif o is True:
+        out.append(b'\xc3')
+    elif o is False:
+        out.append(b'\xc2')
+    elif isinstance(o, _integer_types):
+        if 0 <= o < 0x80:
+            out.append(_B.pack(o))
+        elif -32 <= o < 0:
+            out.append(_b.pack(o))
+        elif 0 <= o < 0x100:
+            out.append(b'\xcc' + _B.pack(o))
+        elif 0 <= o < 0x10000:
+            out.append(b'\xcd' + _H.pack(o))
+        elif 0 <= o < 0x100000000:
+            out.append(b'\xce' + _I.pack(o))
+        elif 0 <= o < 0x10000000000000000:
+            out.append(b'\xcf' + _Q.pack(o))
+        elif -0x80 <= o < 0:
+            out.append(b'\xd0' + _b.pack(o))
+        elif -0x8000 <= o < 0:
+            out.append(b'\xd1' + _h.pack(o))
+        elif -0x80000000 <= o < 0:
+            out.append(b'\xd2' + _i.pack(o))
+        elif -0x8000000000000000 <= o < 0:
+            out.append(b'\xd3' + _q.pack(o))
+        else:
+            raise ValueError('Integer too big for the binary codec: %s' % o)
+    elif isinstance(o, float):
+        out.append(b'\xcb' + _d.pack(o))
+    elif isinstance(o, _string_types):
+        b = o if isinstance(o, bytes) else o.encode('utf8')
+        n = len(b)
+        if n < 32:
+            out.append(_B.pack(0xa0 | n))
+        elif n < 0x100:
+            out.append(b'\xd9' + _B.pack(n))
+        elif n < 0x10000:
+            out.append(b'\xda' + _H.pack(n))
+        else:
+            out.append(b'\xdb' + _I.pack(n))
+        out.append(b)
+    elif isinstance(o, (list, tuple)):
+        _pack_len(len(o), 0x90, 15, b'\xdc', b'\xdd', out)
+        for v in o:
+            _pack(v, out)
+    elif isinstance(o, dict):
+        _pack_len(len(o), 0x80, 15, b'\xde', b'\xdf', out)
+        for (k, v) in o.items():
+            _pack(k, out)
+            _pack(v, out)
+    else:
+        raise ValueError('Cannot encode the type %s in the binary codec' % type(o))
+
+
+def _unpack(data, pos):
+    c = ord(data[pos:pos + 1])
+    pos += 1
+    if c < 0x80:
+        return c, pos
+    if c >= 0xe0:
+        return c - 0x100, pos
+    if 0xa0 <= c <= 0xbf:
+        n = c & 0x1f
+        return bytes_to_unicode(data[pos:pos + n]), pos + n
+    if 0x90 <= c <= 0x9f:
+        return _unpack_array(data, pos, c & 0x0f)
+    if 0x80 <= c <= 0x8f:
+        return _unpack_map(data, pos, c & 0x0f)
+    if c == 0xc0:
+        return None, pos
+    if c == 0xc2:
+        return False, pos
+    if c == 0xc3:
+        return True, pos
+    if c == 0xcb:
+        return _d.unpack_from(data, pos)[0], pos + 8
+    if c == 0xca:
+        return struct.unpack_from('>f', data, pos)[0], pos + 4
+    if c in _INT_STRUCTS:
+        s = _INT_STRUCTS[c]
+        return s.unpack_from(data, pos)[0], pos + s.size
+    if c in (0xd9, 0xda, 0xdb, 0xc4, 0xc5, 0xc6):
+        s = _LEN_STRUCTS[c]
+        n = s.unpack_from(data, pos)[0]
+        pos += s.size
+        return bytes_to_unicode(data[pos:pos + n]), pos + n
+    if c in (0xdc, 0xdd):
+        s = _LEN_STRUCTS[c]
+        return _unpack_array(data, pos + s.size, s.unpack_from(data, pos)[0])
+    if c in (0xde, 0xdf):
+        s = _LEN_STRUCTS[c]
+        return _unpack_map(data, pos + s.size, s.unpack_from(data, pos)[0])
+    raise ValueError('Unknown binary codec type 0x%x' % c)
+
+
+_INT_STRUCTS = {0xcc: _B, 0xcd: _H, 0xce: _I, 0xcf: _Q, 0xd0: _b, 0xd1: _h, 0xd2: _i, 0xd3: _q}
+_LEN_STRUCTS = {0xd9: _B, 0xda: _H, 0xdb: _I, 0xc4: _B, 0xc5: _H, 0xc6: _I, 0xdc: _H, 0xdd: _I, 0xde: _H, 0xdf: _I}
+
+
+def _unpack_array(data, pos, n):
+    r = []
+    for _ in range(n):
+        v, pos = _unpack(data, pos)
+        r.append(v)
+    return r, pos
+
+
+def _unpack_map(data, pos, n):
+    r = {}
+    for _ in range(n):
+        k, pos = _unpack(data, pos)
+        v, pos = _unpack(data, pos)
+        r[k] = v
+    return r, pos
+
+
+def _raw_pack(o):
+    if msgpack is not None:
+        return msgpack.packb(o, use_bin_type=False)  # as our version, all strings are utf8 strings
+    out = []
+    _pack(o, out)
+    return b''.join(out)
+
+
+def _raw_unpack(data):
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False)
+    o, pos = _unpack(data, 0)
+    if pos != len(data):
+        raise ValueError('Extra data after the binary message')
+    return o
+
+
+# Encode one message, without the header. Used by the broadcaster so it can pack several
+# already encoded messages into one packet
+def encode_binary_item(msg):
+    return _raw_pack(_compact_keys(msg))
+
+
+# The size of the array header for n items
+def get_binary_array_header(n):
+    out = []
+    _pack_len(n, 0x90, 15, b'\xdc', b'\xdd', out)
+    return b''.join(out)
+
+
+# Create a full packet from already encoded items
+def make_binary_packet(encoded_items):
+    return BINARY_HEADER + get_binary_array_header(len(encoded_items)) + b''.join(encoded_items) + BINARY_END
+
+
+def encode_binary(msg):
+    return BINARY_HEADER + encode_binary_item(msg) + BINARY_END
+
+
+def is_binary(data):
+    return data[:1] == BINARY_MAGIC
+
+
+# Decode a packet, binary or json
+def decode(data):
+    if not is_binary(data):
+        return jsoner.loads(data)
+    if len(data) < len(BINARY_HEADER) + 1 or data[-1:] != BINARY_END:
+        raise ValueError('Truncated binary message')
+    version = _B.unpack_from(data, 1)[0]
+    if version > BINARY_CODEC_VERSION:
+        raise ValueError('Unknown binary codec version %d' % version)
+    try:
+        return _expand_keys(_raw_unpack(data[len(BINARY_HEADER):-1]))
+    except Exception as exp:  # truncated or garbage data can raise a lot of different errors
+        raise ValueError('Bad binary message: %s' % exp)
+
+
+# The node can receive binary messages if it did advertise it
+def is_node_binary_capable(node):
+    return node.get('codec', 0) >= BINARY_CODEC_VERSION
+
+
+# Encode a message for this node: binary if it manage it, json if not
+def encode_for_node(msg, node):
+    if node is not None and is_node_binary_capable(node):
+        try:
+            return encode_binary(msg)
+        except ValueError:  # something we cannot encode, json will do it
+            pass
+    return jsoner.dumps(msg)
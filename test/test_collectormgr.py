@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+from opsbro_test import *
+
+import threading
+import time
+
+from opsbro.collector import Collector
+from opsbro.collectormanager import CollectorManager
+from opsbro.stop import stopper
+
+
+class Dummy(Collector):
+    def launch(self):
+        return {}
+
+
+class Other(Collector):
+    def launch(self):
+        return {}
+
+
+class Delayed(Collector):
+    first_run_delay = 5
+    
+    
+    def launch(self):
+        return {}
+
+
+class TestCollectorManagerData(OpsBroTest):
+    def setUp(self):
+        self.mgr = CollectorManager()
+        self.mgr.load_collector(Dummy)
+        self.mgr.load_collector(Other)
+    
+    
+    def test_get_data(self):
+        mgr = self.mgr
+        self.assert_(mgr.get_data('dummy') is None)
+        self.assertRaises(KeyError, mgr.get_data, 'dummy.phys_used')
+        
+        version = mgr.get_data_version()
+        mgr.put_result('dummy', {'phys_used': 42, 'disks': {'sda': {'util%': 3}}, 'a.b': 1, 4: 'int key'}, [], '')
+        self.assert_(mgr.get_data_version() > version)
+        self.assert_(mgr.get_data('dummy.phys_used') == 42)
+        self.assert_(mgr.get_data('dummy.disks') == {'sda': {'util%': 3}})
+        self.assert_(mgr.get_data('dummy.disks.sda.util%') == 3)
+        # like with the path walk, keys with dots or not strings cannot be reached
+        self.assertRaises(KeyError, mgr.get_data, 'dummy.a.b')
+        self.assertRaises(KeyError, mgr.get_data, 'dummy.4')
+        
+        # same results: nothing did change
+        version = mgr.get_data_version()
+        mgr.put_result('dummy', {'phys_used': 42, 'disks': {'sda': {'util%': 3}}, 'a.b': 1, 4: 'int key'}, [], '')
+        self.assert_(mgr.get_data_version() == version)
+        
+        # old paths are removed
+        mgr.put_result('dummy', {'phys_used': 43}, [], '')
+        self.assert_(mgr.get_data_version() > version)
+        self.assert_(mgr.get_data('dummy.phys_used') == 43)
+        self.assertRaises(KeyError, mgr.get_data, 'dummy.disks.sda')
+        self.assertRaises(KeyError, mgr.get_data, 'unknown.phys_used')
+    
+    
+    # like the rate collectors, that need their baseline to be old enough
+    def test_first_run_delay(self):
+        mgr = self.mgr
+        now = time.time()
+        mgr.load_collector(Delayed)
+        self.assert_(mgr.collectors['delayed']['next_check'] >= now + 5)
+        self.assert_(mgr.collectors['dummy']['next_check'] <= now)
+    
+    
+    def test_other_collectors_index_kept(self):
+        mgr = self.mgr
+        mgr.put_result('other', {'load': 1}, [], '')
+        other_index = mgr.data_indexes['other']
+        mgr.put_result('dummy', {'phys_used': 42}, [], '')
+        self.assert_(mgr.data_indexes['other'] is other_index)
+        self.assert_(mgr.get_data('other.load') == 1)
+        self.assert_(mgr.get_data('dummy.phys_used') == 42)
+
+
+class Hang(Collector):
+    timeout = 1
+    release = threading.Event()
+    
+    
+    def launch(self):
+        self.release.wait(10)
+        return {}
+
+
+class TestCollectorManagerWorkers(OpsBroTest):
+    def setUp(self):
+        self.mgr = CollectorManager()
+        self.mgr.load_collector(Hang)
+    
+    
+    def tearDown(self):
+        Hang.release.set()
+    
+    
+    def test_overrun_replace_worker(self):
+        mgr = self.mgr
+        # the workers of the other managers
+        nb_others = len([t for t in threading.enumerate() if t.name.startswith('collector-worker-')])
+        mgr._CollectorManager__launch_workers()
+        nb_workers = mgr.nb_workers
+        mgr.collectors['hang']['queued'] = True
+        mgr.work_queue.put('hang')
+        time.sleep(0.5)
+        e = mgr.collectors['hang']
+        self.assert_(e['running_since'] != 0)
+        
+        # not too long for now
+        mgr._CollectorManager__look_for_overruns(time.time())
+        self.assert_(not e['overrun'])
+        self.assert_(mgr.nb_workers == nb_workers)
+        
+        # too long: flagged, and the lost worker is replaced, only once
+        mgr._CollectorManager__look_for_overruns(time.time() + 2)
+        self.assert_(e['overrun'])
+        self.assert_(e['nb_overruns'] == 1)
+        self.assert_(mgr.nb_workers == nb_workers + 1)
+        mgr._CollectorManager__look_for_overruns(time.time() + 3)
+        self.assert_(mgr.nb_workers == nb_workers + 1)
+        
+        # the run ends: its worker exits
+        Hang.release.set()
+        time.sleep(0.5)
+        self.assert_(e['running_since'] == 0)
+        self.assert_(not e['overrun'])
+        workers = [t for t in threading.enumerate() if t.name.startswith('collector-worker-')]
+        self.assert_(len(workers) == nb_others + nb_workers)
+
+
+
+class Broken(Collector):
+    def launch(self):
+        # a key that is not a string cannot be a metric name
+        return {1: 2}
+
+
+class TestCollectorManagerErrors(OpsBroTest):
+    def test_error_keep_worker(self):
+        mgr = CollectorManager()
+        mgr.load_collector(Broken)
+        mgr._CollectorManager__launch_workers()
+        workers = [t for t in threading.enumerate() if t.name.startswith('collector-worker-')]
+        mgr.collectors['broken']['queued'] = True
+        mgr.work_queue.put('broken')
+        time.sleep(0.5)
+        e = mgr.collectors['broken']
+        self.assert_(e['running_since'] == 0)
+        self.assert_(e['inst'].state == 'ERROR')
+        # the worker is still there, and the agent is not stopped
+        self.assert_(all(t.is_alive() for t in workers))
+        self.assert_(not stopper.is_stop())
+
+
+if __name__ == '__main__':
+    unittest.main()
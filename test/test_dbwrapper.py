@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+import os
+import shutil
+import tempfile
+
+from opsbro_test import *
+
+from opsbro.dbwrapper import SqliteDBBackend
+
+
+class TestSqliteDB(OpsBroTest):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = SqliteDBBackend(os.path.join(self.directory, 'db'))
+    
+    
+    def tearDown(self):
+        self.db.db.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+    
+    
+    def test_write_batch(self):
+        puts = [('key-%04d' % i, 'value-%d' % i) for i in range(2000)]
+        self.db.WriteBatch(puts)
+        self.db.WriteBatch([('key-0000', 'new')], deletes=['key-%04d' % i for i in range(1, 1500)])
+        self.assert_(not self.db.did_error)
+        keys = list(self.db.RangeIter(include_value=False))
+        self.assert_(len(keys) == 501)
+        self.assert_(self.db.Get('key-0000') == 'new')
+        self.assert_(list(self.db.RangeIter(key_from='key-1999', key_to='key-1999')) == [('key-1999', 'value-1999')])
+        self.db.Sync()
+
+
+if __name__ == '__main__':
+    unittest.main()
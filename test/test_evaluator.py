@@ -5,7 +5,14 @@
 import traceback
 from opsbro_test import *
 
-from opsbro.evaluater import evaluater
+from opsbro.evaluater import evaluater, ExprInputsTracker
+from opsbro.collector import Collector
+from opsbro.collectormanager import collectormgr
+
+
+class Hypervisor(Collector):
+    def launch(self):
+        return {}
 
 
 class TestEvaluater(OpsBroTest):
@@ -84,6 +91,56 @@ class TestEvaluater(OpsBroTest):
             print("Result: %s" % str(r))
             print("Is The same?: %s" % (r == expected))
             self.assert_(r == expected)
+    
+    
+    def test_evaluator_compiled_plans(self):
+        variables = {'load': 5, 'disks': {'/': 80, '/var': 95}, 'name': 'node1'}
+        rules = [
+            {'rule': '{{variables.load}} > 3', 'expected': True},
+            {'rule': '{{variables.load}} + {{variables.load}}', 'expected': 10},
+            {'rule': '{{variables.disks}}["/var"]', 'expected': 95},
+            {'rule': 'sorted({{variables.disks}}.keys())', 'expected': ['/', '/var']},
+            {'rule': '"%s is loaded" % {{variables.name}}', 'expected': 'node1 is loaded'},
+            # Inside a string, we must fall back to the text version
+            {'rule': '"{{variables.name}}"', 'expected': "'node1'"},
+        ]
+        for r in rules:
+            rule = r['rule']
+            expected = r['expected']
+            # Twice: the second one is with the cached plan
+            for i in range(2):
+                r = evaluater.eval_expr(rule, variables=variables)
+                print("Rule: %s => %s (expected %s)" % (rule, r, expected))
+                self.assert_(r == expected)
+        
+        # The value did change, the plan must see it
+        self.assert_(evaluater.eval_expr('{{variables.load}} > 3', variables={'load': 1}) is False)
+        
+        # The {{ }} values are the real objects, so modifying them is refused
+        self.assertRaises(TypeError, evaluater.eval_expr, '{{variables.disks}}.clear()', variables=variables)
+        self.assert_(len(variables['disks']) == 2)
+    
+    
+    def test_expr_inputs(self):
+        collectormgr.load_collector(Hypervisor)
+        collectormgr.put_result('hypervisor', {'hypervisor': 'KVMKVMKVM'}, [], '')
+        expr = "{{collector.hypervisor.hypervisor}} == 'KVMKVMKVM' and {{collector.dmidecode.product_name|UNKNOWN}} != 'VirtualBox'"
+        inputs = evaluater.get_expr_inputs(expr)
+        self.assert_(inputs == ('KVMKVMKVM', KeyError))
+        
+        tracker = ExprInputsTracker()
+        self.assert_(tracker.did_change(inputs))
+        tracker.set_evaluated(inputs)
+        self.assert_(not tracker.did_change(evaluater.get_expr_inputs(expr)))
+        collectormgr.put_result('hypervisor', {'hypervisor': 'XenVMMXenVMM'}, [], '')
+        self.assert_(tracker.did_change(evaluater.get_expr_inputs(expr)))
+        
+        # functions that look at the system cannot be followed, the groups ones can
+        self.assert_(evaluater.get_expr_inputs("file_exists('/etc/redis.conf')") is None)
+        self.assert_(evaluater.get_expr_inputs("len('abc') == 3") == ())
+        self.assert_(evaluater.get_plan("is_in_group('linux')").use_groups)
+        # templates: only the {{ }} are interesting
+        self.assert_(evaluater.get_expr_inputs('kv-store-backend:{{collector.hypervisor.hypervisor}}', only_placeholders=True) == ('XenVMMXenVMM',))
 
 
 if __name__ == '__main__':
@@ -4,9 +4,10 @@
 
 import threading
 import tempfile
+import json
 
 from opsbro_test import *
-from opsbro.gossip import gossiper
+from opsbro.gossip import gossiper, encode_push_pull_msg, decode_push_pull_msg
 
 
 class TestGossip(OpsBroTest):
@@ -19,6 +20,103 @@ class TestGossip(OpsBroTest):
     
     def test_gossip(self):
         pass
+    
+    
+    def test_group_rings(self):
+        def _node(uuid, groups):
+            return {'addr': '127.0.0.1', 'port': 6768, 'name': uuid, 'display_name': '', 'incarnation': 1, 'uuid': uuid,
+                    'state': 'alive', 'groups': groups, 'services': {}, 'checks': {}, 'zone': 'private', 'is_proxy': False}
+        
+        
+        gossiper.set_alive(_node('BBBB', ['kv']), bootstrap=True)
+        gossiper.set_alive(_node('DDDD', ['kv', 'ts']), bootstrap=True)
+        gossiper.set_alive(_node('FFFF', ['ts']), bootstrap=True)
+        
+        self.assert_(gossiper.find_group_nodes('kv') == ['BBBB', 'DDDD'])
+        self.assert_(gossiper.find_group_node('kv', 'CCCC') == 'BBBB')
+        self.assert_(gossiper.find_group_node('kv', 'EEEE') == 'DDDD')
+        # before the first one: we loop to the last one
+        self.assert_(gossiper.find_group_node('kv', 'AAAA') == 'DDDD')
+        # no such group: ourselve
+        self.assert_(gossiper.find_group_node('unknown', 'AAAA') == gossiper.uuid)
+        
+        # A dead node is no more in the ring
+        gossiper.set_dead({'uuid': 'DDDD', 'incarnation': 1})
+        self.assert_(gossiper.find_group_nodes('kv') == ['BBBB'])
+        self.assert_(gossiper.find_group_node('ts', 'EEEE') == 'FFFF')
+        
+        # it's back, with other groups
+        n = _node('DDDD', ['ts'])
+        n['incarnation'] = 2
+        gossiper.set_alive(n)
+        self.assert_(gossiper.find_group_nodes('kv') == ['BBBB'])
+        self.assert_(gossiper.find_group_nodes('ts') == ['DDDD', 'FFFF'])
+        
+        # deleted
+        gossiper.delete_node('FFFF')
+        self.assert_(gossiper.find_group_nodes('ts') == ['DDDD'])
+        
+        # and for our own groups
+        gossiper.add_group('kv', broadcast_when_change=False)
+        self.assert_(gossiper.uuid in gossiper.find_group_nodes('kv'))
+        gossiper.remove_group('kv', broadcast_when_change=False)
+        self.assert_(gossiper.uuid not in gossiper.find_group_nodes('kv'))
+    
+    
+    def test_push_pull_digest(self):
+        def _node(uuid, incarnation):
+            return {'addr': '127.0.0.1', 'port': 6768, 'name': uuid, 'display_name': '', 'incarnation': incarnation, 'uuid': uuid,
+                    'state': 'alive', 'groups': [], 'services': {}, 'checks': {}, 'zone': 'private', 'is_proxy': False}
+        
+        
+        gossiper.set_alive(_node('AAAA', 1), bootstrap=True)
+        gossiper.set_alive(_node('BBBB', 3), bootstrap=True)
+        gossiper.set_alive(_node('CCCC', 1), bootstrap=True)
+        
+        msg = {'type': 'push-pull-digest', 'ask-from-zone': 'private', 'events': ['unknown-event'],
+               'nodes': {'AAAA': [1, 'alive'], 'BBBB': [2, 'alive'], 'CCCC': [2, 'alive'], 'DDDD': [1, 'alive']}}
+        r = gossiper.get_push_pull_digest_response(msg)
+        # BBBB is newer on our side, and the other node do not know about us
+        self.assert_(sorted(r['nodes'].keys()) == sorted(['BBBB', gossiper.uuid]))
+        # CCCC is newer on its side and DDDD is unknown
+        self.assert_(sorted(r['ask-nodes']) == ['CCCC', 'DDDD'])
+        self.assert_(r['ask-events'] == ['unknown-event'])
+        
+        # messages can be compressed
+        big = {'type': 'push-pull-msg', 'nodes': dict((str(i), _node(str(i), 1)) for i in range(50))}
+        data = encode_push_pull_msg(big)
+        self.assert_(len(data) < len(json.dumps(big)))
+        self.assert_(decode_push_pull_msg(data) == big)
+        self.assert_(decode_push_pull_msg(encode_push_pull_msg({'type': 'small'})) == {'type': 'small'})
+    
+    
+    def test_broadcaster(self):
+        from opsbro.broadcast import Broadcaster
+        b = Broadcaster()
+        b.append({'send': 0, 'msg': {'type': 'normal', 'i': 1}})
+        b.append({'send': 0, 'msg': {'type': 'prio'}, 'prioritary': True})
+        b.append({'send': 0, 'msg': {'type': 'for-ts'}, 'group': 'ts'})
+        self.assert_(len(b) == 3)
+        
+        # prioritary first, and only the messages for our groups
+        packets = b.get_packets(['kv'], consume=False)
+        self.assert_(len(packets) == 1)
+        msgs = json.loads(packets[0])
+        self.assert_(msgs == [{'type': 'prio'}, {'type': 'normal', 'i': 1}])
+        self.assert_(len(b) == 3)
+        
+        # consumed messages are dropped after max_send
+        b.get_packets(['ts'], max_send=1)
+        self.assert_(len(b) == 0)
+        
+        # big messages are split in several packets
+        for i in range(10):
+            b.append({'send': 0, 'msg': {'type': 'normal', 'data': 'x' * 400}})
+        packets = b.get_packets([], max_size=1400)
+        self.assert_(len(packets) == 4)
+        for packet in packets:
+            self.assert_(len(packet) <= 1400)
+        self.assert_(sum([len(json.loads(packet)) for packet in packets]) == 10)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+import os
+import shutil
+import tempfile
+import time
+
+from opsbro_test import *
+
+import opsbro.historystore
+from opsbro.historystore import HistoryStore
+
+
+class TestHistory(OpsBroTest):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.segment_max_size = opsbro.historystore.HISTORY_SEGMENT_MAX_SIZE
+        opsbro.historystore.HISTORY_SEGMENT_MAX_SIZE = 100
+    
+    
+    def tearDown(self):
+        opsbro.historystore.HISTORY_SEGMENT_MAX_SIZE = self.segment_max_size
+        shutil.rmtree(self.directory, ignore_errors=True)
+    
+    
+    def test_append_and_read(self):
+        now = int(time.time())
+        # an entry of an old version
+        with open(os.path.join(self.directory, '%d.json' % (now - 10)), 'w') as f:
+            f.write('[{"type": "old"}]')
+        store = HistoryStore(self.directory)
+        store.open()
+        for i in range(10):
+            store.append(now + i, [{'type': 'node-state-change', 'idx': i}])
+        self.assert_(len(store.segments) > 1)
+        self.assert_(not [name for name in os.listdir(self.directory) if name.endswith('.json')])
+        
+        history = store.get_tail(max_size=1024 * 1024)
+        self.assert_([e['date'] for e in history] == [now - 10] + list(range(now, now + 10)))
+        self.assert_(history[0]['entries'] == [{'type': 'old'}])
+        # only the last entries
+        history = store.get_tail(max_size=100)
+        self.assert_(history[-1]['entries'] == [{'type': 'node-state-change', 'idx': 9}])
+        self.assert_(len(history) < 11)
+        
+        history = store.get_range(now + 2, now + 4)
+        self.assert_([e['entries'][0]['idx'] for e in history] == [2, 3, 4])
+        
+        # reopen, with an entry we did not finish to write
+        with open(store.segments[-1].path, 'ab') as f:
+            f.write(b'%d\t[{"type"' % (now + 20))
+        store = HistoryStore(self.directory)
+        store.open()
+        self.assert_([e['date'] for e in store.get_tail()] == [now - 10] + list(range(now, now + 10)))
+        history = store.get_range(now + 2, now + 4)
+        self.assert_([e['entries'][0]['idx'] for e in history] == [2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+import gzip
+import io
+
+from opsbro_test import *
+
+import opsbro.misc.bottle as bottle
+from opsbro.httpdaemon import http_export
+from opsbro.stats import STATS
+
+
+class TestHttpCache(OpsBroTest):
+    def setUp(self):
+        self.version = 1
+        self.nb_calls = 0
+        
+        @http_export('/test/cached', cache_version=lambda: self.version)
+        def cached():
+            self.nb_calls += 1
+            return {'values': ['value-%d' % i for i in range(200)], 'version': self.version}
+    
+    
+    def request(self, path, headers=None):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+                   'SERVER_PORT': '6770', 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(b'')}
+        for (k, v) in (headers or {}).items():
+            environ['HTTP_' + k.upper().replace('-', '_')] = v
+        r = {}
+        
+        
+        def start_response(status, response_headers, exc_info=None):
+            r['status'] = int(status.split()[0])
+            r['headers'] = dict(response_headers)
+        
+        
+        r['body'] = b''.join(bottle.app()(environ, start_response))
+        return r
+    
+    
+    def test_cache(self):
+        hits = STATS.get('http.cache-hit')
+        r = self.request('/test/cached')
+        self.assert_(r['status'] == 200)
+        self.assert_(b'value-199' in r['body'])
+        etag = r['headers']['Etag']
+        # Same version: the response is not computed again
+        r = self.request('/test/cached')
+        self.assert_(self.nb_calls == 1)
+        self.assert_(r['headers']['Etag'] == etag)
+        self.assert_(STATS.get('http.cache-hit') == hits + 1)
+        
+        # The client already have it
+        r = self.request('/test/cached', headers={'If-None-Match': etag})
+        self.assert_(r['status'] == 304)
+        self.assert_(r['body'] == b'')
+        
+        # gzip if asked
+        r = self.request('/test/cached', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assert_(r['headers']['Content-Encoding'] == 'gzip')
+        self.assert_(b'value-199' in gzip.GzipFile(fileobj=io.BytesIO(r['body'])).read())
+        self.assert_(self.nb_calls == 1)
+        
+        # New version: new response
+        self.version = 2
+        r = self.request('/test/cached', headers={'If-None-Match': etag})
+        self.assert_(r['status'] == 200)
+        self.assert_(r['headers']['Etag'] != etag)
+        self.assert_(self.nb_calls == 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+import os
+import shutil
+import tempfile
+
+from opsbro_test import *
+
+from opsbro.now import NOW
+from opsbro.dbwrapper import dbwrapper
+from opsbro.jsonmgr import jsoner
+from opsbro.kv import kvmgr, CHANGES_INDEX_PREFIX, CHANGES_INDEX_VERSION_KEY
+
+
+class TestKVChanges(OpsBroTest):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.now = NOW.now
+    
+    
+    def tearDown(self):
+        NOW.now = self.now
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+    
+    
+    def get_changes_keys(self):
+        return list(kvmgr.db.RangeIter(key_from=CHANGES_INDEX_PREFIX, key_to=CHANGES_INDEX_PREFIX + '\x7f', include_value=False))
+    
+    
+    def test_changes_index(self):
+        kvmgr.init(self.tmp_dir)
+        NOW.now = 1000
+        kvmgr.put_batch([('k1', 'v1', 0), ('k2', 'v2', 0), ('k3', 'v3', 0)])
+        self.assert_(self.get_changes_keys() == ['__changes/0000001000/k1', '__changes/0000001000/k2', '__changes/0000001000/k3'])
+        
+        # a new put: the old index entry is removed
+        NOW.now = 2000
+        kvmgr.put('k1', 'v1-new')
+        self.assert_(self.get_changes_keys() == ['__changes/0000001000/k2', '__changes/0000001000/k3', '__changes/0000002000/k1'])
+        
+        # a delete removes its index entry too
+        kvmgr.delete('k3')
+        self.assert_(self.get_changes_keys() == ['__changes/0000001000/k2', '__changes/0000002000/k1'])
+        
+        # all the changes, by pages
+        entries, cursor = kvmgr.get_changed_page(0, limit=1)
+        self.assert_([e[0] for e in entries] == ['k2'])
+        self.assert_(cursor == '__changes/0000001000/k2')
+        entries, cursor = kvmgr.get_changed_page(0, after=cursor, limit=1)
+        self.assert_([(e[0], e[1]) for e in entries] == [('k1', 'v1-new')])
+        self.assert_(entries[0][2]['modify_index'] == 2)
+        # it was the last page
+        self.assert_(cursor is None)
+        
+        # only the changes after a time
+        self.assert_([e[0] for e in kvmgr.changed_since(1000)] == ['k1'])
+    
+    
+    # Databases of old versions do not have the index
+    def test_build_changes_index(self):
+        db = dbwrapper.get_db(os.path.join(self.tmp_dir, 'kv'))
+        db.WriteBatch([('k1', 'v1'), ('__meta/k1', jsoner.dumps({'modify_index': 1, 'modify_time': 1500})),
+                       ('k2', 'v2'), ('__meta/k2', jsoner.dumps({'modify_index': 3, 'modify_time': 1200}))])
+        del db
+        
+        kvmgr.init(self.tmp_dir)
+        self.assert_(kvmgr.db.Get(CHANGES_INDEX_VERSION_KEY))
+        self.assert_(self.get_changes_keys() == ['__changes/0000001200/k2', '__changes/0000001500/k1'])
+        self.assert_([e[0] for e in kvmgr.changed_since(0)] == ['k2', 'k1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+from opsbro_test import *
+
+from opsbro.procfs import parse_stat, parse_diskstats, parse_meminfo, parse_net_dev, ProcFSSampler, ProcFSSample
+from opsbro.misc.monotonic import monotonic
+
+
+class TestProcFS(OpsBroTest):
+    def test_parse_stat(self):
+        lines = ['cpu  16495 72 13812 1662977 894 0 160 0 0 0',
+                 'cpu0 16495 72 13812 1662977 894 0 160 0 0 0',
+                 'intr 1234 0 0 12',
+                 'ctxt 4567',
+                 'processes 89']
+        r = parse_stat(lines)
+        self.assert_(r['cpus']['cpu_all'][r'%idle'] == 1662977)
+        self.assert_(r['cpus']['cpu0'][r'%user'] == 16495)
+        self.assert_(r['counters'] == {'ctxt': 4567, 'processes': 89})
+    
+    
+    def test_parse_diskstats(self):
+        lines = ['   8       0 sda 100 2 300 4 500 6 700 8 0 900 10',
+                 '   8       1 sda1 100 2 300 4 500 6 700 8 0 900 10 0 0 0 0',
+                 '   8       2 sdb1 1 2 3 4']
+        r = parse_diskstats(lines)
+        self.assert_(sorted(r.keys()) == ['sda', 'sda1'])
+        self.assert_(r['sda']['writes'] == 500)
+        self.assert_(r['sda']['write_sectors'] == 700)
+        self.assert_(r['sda']['total_io_ms'] == 900)
+    
+    
+    def test_parse_meminfo_and_net_dev(self):
+        r = parse_meminfo(['MemTotal:        6158152 kB', 'HugePages_Total:       0', 'Broken line'])
+        self.assert_(r == {'memtotal': 6158152, 'hugepages_total': 0})
+        
+        lines = ['Inter-|   Receive                |  Transmit',
+                 ' face |bytes    packets errs drop|bytes    packets errs drop',
+                 '  eth0: 1000 10 0 0 2000 20 0 0']
+        r = parse_net_dev(lines)
+        self.assert_(r['eth0'] == {'recv_bytes': 1000, 'recv_packets': 10, 'recv_errs': 0, 'recv_drop': 0,
+                                   'trans_bytes': 2000, 'trans_packets': 20, 'trans_errs': 0, 'trans_drop': 0})
+    
+    
+    def test_samples_since(self):
+        sampler = ProcFSSampler()
+        old = ProcFSSample({}, 0.0)
+        # a young sample is shared and the file is not read again
+        current = ProcFSSample({}, monotonic() - 2)
+        sampler.samples['meminfo'] = (current, old)
+        self.assert_(sampler.get_sample('meminfo') is current)
+        # new collector: will have the sampler previous sample
+        self.assert_(sampler.get_samples_since('meminfo', None) == (current, old))
+        # a collector with its own previous sample will use it
+        mine = ProcFSSample({}, 5.0)
+        self.assert_(sampler.get_samples_since('meminfo', mine) == (current, mine))
+        # but if it did already use the current one, the file is read again
+        new, since = sampler.get_samples_since('meminfo', current)
+        self.assert_(new is not current and since is current)
+        self.assert_('memtotal' in new.values)
+    
+    
+    # The collectors take a baseline when loaded, so their first run have two samples, and
+    # the run does not wait for them to be far enough
+    def test_baseline(self):
+        sampler = ProcFSSampler()
+        baseline = sampler.get_baseline('stat')
+        t0 = monotonic()
+        current, since = sampler.get_samples_since('stat', baseline)
+        self.assert_(monotonic() - t0 < 0.5)
+        self.assert_(since is baseline and current is not baseline)
+        self.assert_('cpu_all' in current.values['cpus'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+import os
+import shutil
+import tempfile
+
+from opsbro_test import *
+
+import opsbro.retention
+from opsbro.retention import RetentionLog
+
+
+class TestRetention(OpsBroTest):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'checks.retention')
+        self.old_path = os.path.join(self.directory, 'checks.dat')
+        self.compact_min_size = opsbro.retention.RETENTION_COMPACT_MIN_SIZE
+    
+    
+    def tearDown(self):
+        opsbro.retention.RETENTION_COMPACT_MIN_SIZE = self.compact_min_size
+        shutil.rmtree(self.directory, ignore_errors=True)
+    
+    
+    def test_import_old_and_append(self):
+        with open(self.old_path, 'w') as f:
+            f.write('{"c1": {"state_id": 0}, "c2": {"state_id": 2}}')
+        items = {'c1': {'state_id': 0}, 'c2': {'state_id': 2}}
+        log = RetentionLog(self.path, old_path=self.old_path)
+        self.assert_(log.load() == items)
+        # First write is a full one, and the old file is no more need
+        log.write({}, lambda: items)
+        self.assert_(not os.path.exists(self.old_path))
+        
+        # Then only the changes are appended
+        items['c2'] = {'state_id': 1}
+        size = os.path.getsize(self.path)
+        log.write({'c2': {'state_id': 1}}, lambda: self.fail('no full write expected'))
+        self.assert_(os.path.getsize(self.path) > size)
+        
+        # an entry we did not finish to write
+        with open(self.path, 'ab') as f:
+            f.write(b'"c1"\t{"state_')
+        log = RetentionLog(self.path, old_path=self.old_path)
+        self.assert_(log.load() == items)
+    
+    
+    def test_compact(self):
+        opsbro.retention.RETENTION_COMPACT_MIN_SIZE = 0
+        items = {'c1': {'state_id': 0}}
+        log = RetentionLog(self.path)
+        self.assert_(log.load() == {})
+        log.write({}, lambda: items)
+        size = os.path.getsize(self.path)
+        for state_id in range(10):
+            items['c1'] = {'state_id': state_id}
+            log.write({'c1': items['c1']}, lambda: items)
+        # the log is rewritten when it is too big
+        self.assert_(os.path.getsize(self.path) <= 2 * size)
+        log = RetentionLog(self.path)
+        self.assert_(log.load() == {'c1': {'state_id': 9}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+import threading
+
+from opsbro_test import *
+
+from opsbro.stats import Stats
+
+
+class TestStats(OpsBroTest):
+    def test_threads_shards(self):
+        stats = Stats()
+        
+        
+        def work():
+            for i in range(100):
+                stats.incr('loops')
+                stats.timer('work', 3)
+        
+        
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats.gauge('threads', 4)
+        
+        metrics = stats.get_metrics()
+        self.assert_(metrics['counters'] == {'loops': 400})
+        self.assert_(metrics['gauges'] == {'threads': 4})
+        timer = metrics['timers']['work']
+        self.assert_(timer['count'] == 400)
+        self.assert_(timer['avg'] == 3)
+        # 3ms is in the (1, 5] bucket
+        self.assert_(dict((str(b), n) for (b, n) in timer['buckets'])['5'] == 400)
+        self.assert_(stats.get('loops') == 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+from opsbro_test import *
+
+import pickle
+
+from opsbro.ts import TSBackend, consolidate
+
+
+class DummyDB(object):
+    def __init__(self):
+        self.keys = []
+    
+    
+    def Get(self, key, fill_cache=False):
+        if key not in self.keys:
+            raise KeyError(key)
+        return ''
+    
+    
+    def Put(self, key, value):
+        self.keys.append(key)
+    
+    
+    def RangeIter(self, key_from=None, key_to=None, include_value=True, fill_cache=True):
+        return sorted([k for k in self.keys if key_from <= k <= key_to])
+
+
+class TestTS(OpsBroTest):
+    def setUp(self):
+        self.tsb = TSBackend()
+        self.tsb.db = DummyDB()
+        self.records = {}
+        
+        
+        def push_key(k, v, ttl=0, local=False):
+            self.records[k] = v
+        
+        
+        self.tsb.push_key = push_key
+    
+    
+    def test_consolidate(self):
+        nan = float('nan')
+        values = [1, 2, nan, 4, 5, 6]
+        self.assert_(consolidate(values, 0, 60) == [(1, 0), (2, 60), (None, 120), (4, 180), (5, 240), (6, 300)])
+        self.assert_(consolidate(values, 0, 60, max_points=3) == [(1.5, 0), (4, 120), (5.5, 240)])
+        self.assert_(consolidate(values, 0, 60, max_points=2, func='max') == [(2, 0), (6, 180)])
+        self.assert_(consolidate(values, 0, 60, max_points=2, func='sum') == [(3, 0), (15, 180)])
+    
+    
+    def test_expand_targets(self):
+        for name in ('srv1.cpu.user', 'srv1.cpu.system', 'srv2.cpu.user', 'srv1.load'):
+            self.tsb.add_value(100, name, 1)
+        self.assert_(self.tsb.expand_targets(['srv1.cpu.*']) == ['srv1.cpu.system', 'srv1.cpu.user'])
+        self.assert_(self.tsb.expand_targets(['srv?.cpu.user', 'srv1.load']) == ['srv1.cpu.user', 'srv2.cpu.user', 'srv1.load'])
+    
+    
+    def test_minutes_range_from_memory(self):
+        # 3 minutes with values, the 4th one is the current one and is not archived
+        for t in range(7200, 7200 + 4 * 60, 30):
+            self.tsb.add_value(t, 'srv1.load', t // 60)
+        values = self.tsb.get_minutes_range('srv1.load', 7200, 7200 + 5 * 60)
+        datapoints = consolidate(values, 7200, 60)
+        self.assert_(datapoints == [(120, 7200), (121, 7260), (122, 7320), (None, 7380), (None, 7440)])
+    
+    
+    # After a restart the day in memory only have the new minutes, the previous ones are in the hours
+    def test_minutes_range_after_restart(self):
+        def get_record(key):
+            if key not in self.records:
+                return None
+            return pickle.loads(self.records[key])
+        
+        
+        self.tsb.get_record = get_record
+        # 3 minutes in the 90000 hour, then a value in the next hour so the hour is saved
+        for t in range(90000, 90000 + 3 * 60, 30):
+            self.tsb.add_value(t, 'srv1.load', t // 60)
+        self.tsb.add_value(93600, 'srv1.load', 1)
+        self.tsb.add_value(93660, 'srv1.load', 1)
+        self.assert_('srv1.load::h90000' in self.records)
+        
+        # restart
+        self.tsb.series.clear()
+        for t in range(97200, 97200 + 3 * 60, 30):
+            self.tsb.add_value(t, 'srv1.load', t // 60)
+        values = self.tsb.get_minutes_range('srv1.load', 90000, 90000 + 3 * 60)
+        self.assert_(consolidate(values, 90000, 60) == [(1500, 90000), (1501, 90060), (1502, 90120)])
+        values = self.tsb.get_minutes_range('srv1.load', 97200, 97200 + 3 * 60)
+        self.assert_(consolidate(values, 97200, 60) == [(1620, 97200), (1621, 97260), (None, 97320)])
+
+    
+    
+    # Names from json or perfdata can be unicode, and the day averages keep their precision
+    def test_unicode_name_and_day_precision(self):
+        big = 123456789.123
+        for t in range(86400, 86400 + 3 * 60, 30):
+            self.tsb.add_value(t, u'srv1.counter', big, local=True)
+        serie = self.tsb.series[u'srv1.counter']
+        self.assert_(serie.day is not None)
+        self.assert_(serie.day.values.typecode == 'd')
+        self.assert_(serie.day.values[0] == big)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+import os
+import shutil
+import tempfile
+
+from opsbro_test import *
+
+from opsbro.now import NOW
+from opsbro.dbwrapper import dbwrapper
+from opsbro.kv import kvmgr
+from opsbro.ttldatabase import TTLDatabase
+from opsbro.updatelog import UpdateLog
+
+
+class TestTTL(OpsBroTest):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        kvmgr.db = dbwrapper.get_db(os.path.join(self.tmp_dir, 'kv'))
+        kvmgr.update_log = UpdateLog(os.path.join(self.tmp_dir, 'updates'))
+        kvmgr.update_log.open(0, lambda puts, deletes, seqno: None)
+        self.now = NOW.now
+    
+    
+    def tearDown(self):
+        NOW.now = self.now
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+    
+    
+    def test_clean_old(self):
+        ttldb = TTLDatabase(os.path.join(self.tmp_dir, 'ttl'))
+        NOW.now = 100000
+        kvmgr.db.WriteBatch([('k1', 'v1'), ('k2', 'v2'), ('k3', 'v3'), ('k4', 'v4')])
+        ttldb.set_ttls([('k1', 100000 + 60), ('k2', 100000 + 120), ('k3', 100000 + 7200)])
+        self.assert_(ttldb.hours_heap[0] == 97200)
+        
+        # k1 and k2 are expiring in this hour, the others must stay
+        ttldb.clean_old()
+        self.assert_([k for k in kvmgr.db.RangeIter(include_value=False) if not k.startswith('__')] == ['k3', 'k4'])
+        self.assert_(list(ttldb.db.RangeIter(include_value=False)) == ['0000104400/k3'])
+        self.assert_(ttldb.hours_heap == [104400])
+        
+        NOW.now = 100000 + 7200
+        ttldb.clean_old()
+        self.assert_([k for k in kvmgr.db.RangeIter(include_value=False) if not k.startswith('__')] == ['k4'])
+        self.assert_(list(ttldb.db.RangeIter(include_value=False)) == [])
+    
+    
+    def test_migrate_old_dbs(self):
+        ttl_dir = os.path.join(self.tmp_dir, 'ttl')
+        os.mkdir(ttl_dir)
+        old_db = dbwrapper.get_db(os.path.join(ttl_dir, '97200'))
+        old_db.WriteBatch([('k1', ''), ('k2', '')])
+        del old_db
+        
+        ttldb = TTLDatabase(ttl_dir)
+        self.assert_(list(ttldb.db.RangeIter(include_value=False)) == ['0000097200/k1', '0000097200/k2'])
+        self.assert_(ttldb.hours_heap == [97200])
+        self.assert_(not [d for d in os.listdir(ttl_dir) if d.startswith('97200')])
+
+
+if __name__ == '__main__':
+    unittest.main()
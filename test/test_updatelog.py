@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+import os
+import shutil
+import tempfile
+import time
+
+from opsbro_test import *
+
+from opsbro.updatelog import UpdateLog, read_segment, encode_record, encode_payload
+
+
+class TestUpdateLog(OpsBroTest):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.applied = []
+    
+    
+    def tearDown(self):
+        shutil.rmtree(self.log_dir, ignore_errors=True)
+    
+    
+    def apply(self, puts, deletes, seqno):
+        self.applied.append((seqno, puts, list(deletes)))
+    
+    
+    def test_write_and_replay(self):
+        log = UpdateLog(self.log_dir, fsync_policy='always')
+        log.open(0, self.apply)
+        log.write([('k1', 'v1'), ('k2', 'v2')], [], self.apply)
+        log.write([], ['k1'], self.apply)
+        self.assert_(self.applied == [(1, [('k1', 'v1'), ('k2', 'v2')], []), (2, [], ['k1'])])
+        segment = os.path.join(self.log_dir, '%020d.wal' % 1)
+        records, size = read_segment(segment)
+        self.assert_(records == [(1, [('k1', b'v1'), ('k2', b'v2')], []), (2, [], ['k1'])])
+        self.assert_(size == os.path.getsize(segment))
+        
+        # a crash during a write: the last record is only partly there
+        with open(segment, 'ab') as f:
+            f.write(encode_record(3, encode_payload([('k3', 'v3')], []))[:-2])
+        
+        # only the record not in the database is replayed, and the truncated one is dropped
+        self.applied = []
+        log = UpdateLog(self.log_dir, fsync_policy='never')
+        log.open(1, self.apply)
+        self.assert_(self.applied == [(2, [], ['k1'])])
+        self.assert_(os.path.getsize(segment) == size)
+        self.assert_(log.next_seqno == 3)
+    
+    
+    def test_bad_update_do_not_block(self):
+        log = UpdateLog(self.log_dir, fsync_policy='never')
+        log.open(0, self.apply)
+        self.assertRaises(Exception, log.write, [('b', None)], [], self.apply)
+        # the next writes are not waiting for the bad one
+        log.write([('k1', 'v1')], [], self.apply)
+        self.assert_(self.applied == [(1, [('k1', 'v1')], [])])
+        
+        # and an error when applying does not block them either
+        def bad_apply(puts, deletes, seqno):
+            raise IOError('disk error')
+        
+        
+        self.assertRaises(IOError, log.write, [('k2', 'v2')], [], bad_apply)
+        log.write([('k3', 'v3')], [], self.apply)
+        self.assert_(self.applied[-1] == (3, [('k3', 'v3')], []))
+
+    
+    
+    # With the interval policy, a record written just after a sync is synced when the log is idle
+    def test_lone_record_synced(self):
+        log = UpdateLog(self.log_dir, fsync_policy='interval')
+        log.open(0, self.apply)
+        log.write([('k1', 'v1')], [], self.apply)
+        last_fsync = log.last_fsync
+        self.assert_(last_fsync != 0)
+        log.write([('k2', 'v2')], [], self.apply)
+        self.assert_(log.need_fsync)
+        self.assert_(log.last_fsync == last_fsync)
+        limit = time.time() + 3
+        while log.need_fsync and time.time() < limit:
+            time.sleep(0.1)
+        self.assert_(not log.need_fsync)
+        self.assert_(log.last_fsync > last_fsync)
+
+
+if __name__ == '__main__':
+    unittest.main()
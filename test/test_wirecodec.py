@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# Copyright (C) 2014:
+#    Gabes Jean, naparuba@gmail.com
+
+import json
+
+from opsbro_test import *
+
+from opsbro.wirecodec import encode_binary, decode, encode_for_node, is_binary, BINARY_CODEC_VERSION
+from opsbro.broadcast import Broadcaster
+
+
+class TestWireCodec(OpsBroTest):
+    def setUp(self):
+        self.node_msg = {'type'     : 'gossip::alive', 'uuid': 'c6f2a1a0b5e84f5f9d0d1e2b3c4d5e6f', 'name': 'srv-01', 'display_name': '',
+                         'addr'     : '10.0.0.1', 'port': 6768, 'incarnation': 1500000000, 'state': 'alive', 'groups': ['linux', 'kv'],
+                         'services' : {}, 'checks': {}, 'zone': 'internet', 'is_proxy': False, 'codec': BINARY_CODEC_VERSION,
+                         'something': [1.5, -3, -200, 70000, 2 ** 40, None, True, u'\u00e9' * 40, 'x' * 300]}
+    
+    
+    def test_binary_is_same_as_json(self):
+        data = encode_binary(self.node_msg)
+        self.assert_(is_binary(data))
+        self.assert_(len(data) < len(json.dumps(self.node_msg)))
+        self.assert_(decode(data) == json.loads(json.dumps(self.node_msg)))
+        # json is still managed
+        self.assert_(decode(json.dumps(self.node_msg)) == json.loads(json.dumps(self.node_msg)))
+        # like json, not string keys are strings
+        self.assert_(decode(encode_binary({3: 'int key'})) == {'3': 'int key'})
+    
+    
+    def test_bad_binary(self):
+        data = encode_binary(self.node_msg)
+        self.assertRaises(ValueError, decode, data[:-10])
+        self.assertRaises(ValueError, decode, data[:10] + data[11:])
+    
+    
+    def test_encode_for_node(self):
+        self.assert_(is_binary(encode_for_node(self.node_msg, {'codec': BINARY_CODEC_VERSION})))
+        # old nodes
+        self.assert_(not is_binary(encode_for_node(self.node_msg, {})))
+    
+    
+    def test_binary_broadcasts(self):
+        b = Broadcaster()
+        for i in range(20):
+            msg = dict(self.node_msg)
+            msg['incarnation'] = i
+            b.append({'send': 0, 'msg': msg})
+        json_packets = b.get_packets([], consume=False)
+        binary_packets = b.get_packets([], consume=False, binary=True)
+        self.assert_(len(binary_packets) < len(json_packets))
+        msgs = []
+        for packet in binary_packets:
+            self.assert_(len(packet) <= 1400)
+            msgs.extend(decode(packet))
+        self.assert_(sorted([m['incarnation'] for m in msgs]) == list(range(20)))
+
+
+if __name__ == '__main__':
+    unittest.main()